@@ -0,0 +1,303 @@
+"""
+Load test for the listing, user and public API services.
+
+Generates a dataset (or copies existing db files) into a temporary directory,
+starts the three services in child processes on ephemeral ports, then runs each
+workload against the public API for a fixed duration with a fixed number of
+concurrent clients (the listings, users and user workloads call the listing
+and user services directly instead). Throughput and latency percentiles are printed as JSON, so
+results can be compared across commits:
+
+    python benchmark.py --users=10000 --duration=10 --output=before.json
+
+Service options can be changed with --set, e.g. --set listings.group_commit_window=5
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import multiprocessing
+import urllib.parse
+import tornado.netutil
+import tornado.options
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httputil import url_concat
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, "services", "listings"))
+sys.path.append(os.path.join(ROOT, "services", "users"))
+import generate_data
+import listing_service
+import user_service
+
+def load_public_api():
+    # public-api.py can't be imported by name
+    spec = importlib.util.spec_from_file_location(
+        "public_api", os.path.join(ROOT, "services", "public-api", "public-api.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+public_api = load_public_api()
+
+SERVICES = {
+    "listings": listing_service,
+    "users": user_service,
+    "public-api": public_api,
+}
+
+WORKLOADS = ["feed", "user_feed", "listings", "users", "user", "create"]
+
+def service_options(service, overrides):
+    """Returns the options of a service, with the "--name=value" overrides applied to its defaults."""
+    options = tornado.options.OptionParser()
+    service.define_options(options)
+    options.parse_command_line(["benchmark", "--debug=false"] + overrides)
+    return options
+
+def run_service(name, options, sockets):
+    # Runs in a child process, serving the app on the sockets bound by the parent
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+    SERVICES[name].run(options, sockets)
+
+def start_services(workdir, shards, service_overrides):
+    """Starts every service in its own process, returns (processes, service name -> base url)."""
+    sockets = {name: tornado.netutil.bind_sockets(0, "127.0.0.1") for name in SERVICES}
+    urls = {
+        name: "http://127.0.0.1:{}".format(service_sockets[0].getsockname()[1])
+        for name, service_sockets in sockets.items()
+    }
+    public_api.LISTINGS_URL = urls["listings"] + "/listings"
+    public_api.USERS_URL = urls["users"] + "/users"
+
+    overrides = {
+        "listings": ["--db_path=" + os.path.join(workdir, "listings.db"), "--shards={}".format(shards)],
+        "users": ["--db_path=" + os.path.join(workdir, "users.db")],
+        "public-api": [],
+    }
+    for name, values in service_overrides.items():
+        overrides[name].extend(values)
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for name in SERVICES:
+        options = service_options(SERVICES[name], overrides[name])
+        process = context.Process(target=run_service, args=(name, options, sockets[name]), daemon=True)
+        process.start()
+        processes.append(process)
+    for service_sockets in sockets.values():
+        for sock in service_sockets:
+            sock.close()
+    return processes, urls
+
+async def wait_until_up(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await client.fetch(url, raise_error=False)
+            if response.code == 200:
+                return
+        except Exception:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("service did not come up: {}".format(url))
+        await asyncio.sleep(0.1)
+
+def build_workloads(args, urls, user_count):
+    """Returns (name, request factory) pairs for the selected workloads."""
+    feed_url = urls["public-api"] + "/public-api/listings"
+    workloads = []
+    if "feed" in args.workloads:
+        for page_size in args.page_sizes:
+            for page_num in args.page_depths:
+                url = url_concat(feed_url, {"page_num": page_num, "page_size": page_size})
+                workloads.append((
+                    "feed page_num={} page_size={}".format(page_num, page_size),
+                    lambda url=url: HTTPRequest(url),
+                ))
+    if "user_feed" in args.workloads:
+        workloads.append((
+            "user_feed",
+            lambda: HTTPRequest(url_concat(feed_url, {"user_id": random.randint(1, user_count)})),
+        ))
+    # First pages of the listing and user services, and single users, without the public API
+    if "listings" in args.workloads:
+        listings_url = url_concat(urls["listings"] + "/listings", {"page_size": 10})
+        workloads.append(("listings", lambda: HTTPRequest(listings_url)))
+    if "users" in args.workloads:
+        users_url = url_concat(urls["users"] + "/users", {"page_size": 10})
+        workloads.append(("users", lambda: HTTPRequest(users_url)))
+    if "user" in args.workloads:
+        workloads.append((
+            "user",
+            lambda: HTTPRequest(urls["users"] + "/users/{}".format(random.randint(1, user_count))),
+        ))
+    # Creates change the dataset, so they run last
+    if "create" in args.workloads:
+        workloads.append((
+            "create",
+            lambda: HTTPRequest(feed_url, method="POST", body=urllib.parse.urlencode({
+                "user_id": random.randint(1, user_count),
+                "listing_type": random.choice(["rent", "sale"]),
+                "price": random.randrange(3000, 20000, 500),
+            })),
+        ))
+    return workloads
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))], 3)
+
+async def run_workload(client, make_request, duration, concurrency):
+    """Sends requests from concurrency clients for duration seconds, returns the latencies and error count."""
+    latencies = []
+    errors = [0]
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        while time.monotonic() < deadline:
+            request = make_request()
+            start = time.perf_counter()
+            try:
+                response = await client.fetch(request, raise_error=False)
+                ok = response.code == 200
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors[0] += 1
+
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    return latencies, errors[0]
+
+async def run_benchmark(args, urls, user_count):
+    client = AsyncHTTPClient(force_instance=True, max_clients=args.concurrency)
+    # The feed is only served once all three services are up
+    await wait_until_up(client, urls["public-api"] + "/public-api/listings?page_size=1")
+
+    results = []
+    for name, make_request in build_workloads(args, urls, user_count):
+        if args.warmup > 0:
+            await run_workload(client, make_request, args.warmup, args.concurrency)
+        start = time.monotonic()
+        latencies, errors = await run_workload(client, make_request, args.duration, args.concurrency)
+        elapsed = time.monotonic() - start
+        latencies = sorted(latency * 1000 for latency in latencies)
+        result = {
+            "workload": name,
+            "requests": len(latencies),
+            "errors": errors,
+            "duration": round(elapsed, 3),
+            "throughput": round(len(latencies) / elapsed, 1),
+            "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+        }
+        logging.info("{workload}: {throughput} req/s, p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, {errors} errors".format(**result))
+        results.append(result)
+    client.close()
+    return results
+
+def prepare_dataset(args, workdir):
+    """Fills workdir with the listings and users dbs, returns the number of users."""
+    listings_db = os.path.join(workdir, "listings.db")
+    users_db = os.path.join(workdir, "users.db")
+    if args.listings_db and args.users_db:
+        for shard in range(args.shards):
+            shutil.copyfile(
+                listing_service.shard_path(args.listings_db, shard, args.shards),
+                listing_service.shard_path(listings_db, shard, args.shards)
+            )
+        shutil.copyfile(args.users_db, users_db)
+    else:
+        generate_data.generate(generate_data.parse_args([
+            "--users={}".format(args.users),
+            "--min-listings-per-user={}".format(args.min_listings_per_user),
+            "--max-listings-per-user={}".format(args.max_listings_per_user),
+            "--created-at-spread={}".format(args.created_at_spread),
+            "--seed={}".format(args.seed),
+            "--shards={}".format(args.shards),
+            "--listings-db=" + listings_db,
+            "--users-db=" + users_db,
+        ]))
+    db = sqlite3.connect(users_db)
+    try:
+        return db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        db.close()
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the listing, user and public API services")
+    parser.add_argument("--users", type=int, default=10000, help="users in the generated dataset (default: 10000)")
+    parser.add_argument("--min-listings-per-user", type=int, default=0, help="(default: 0)")
+    parser.add_argument("--max-listings-per-user", type=int, default=20, help="(default: 20)")
+    parser.add_argument("--created-at-spread", type=float, default=365, help="days (default: 365)")
+    parser.add_argument("--seed", type=int, default=1, help="dataset and request random seed (default: 1)")
+    parser.add_argument("--shards", type=int, default=1, help="listing db shards (default: 1)")
+    parser.add_argument("--listings-db", help="use a copy of this listings db (its shards with --shards) instead of generating one")
+    parser.add_argument("--users-db", help="use a copy of this users db instead of generating one")
+    parser.add_argument("--workloads", type=lambda value: value.split(","), default=WORKLOADS,
+        help="comma-separated workloads among {} (default: all)".format(", ".join(WORKLOADS)))
+    parser.add_argument("--page-sizes", type=lambda value: [int(v) for v in value.split(",")], default=[10, 100],
+        help="page sizes of the feed workloads (default: 10,100)")
+    parser.add_argument("--page-depths", type=lambda value: [int(v) for v in value.split(",")], default=[1, 100],
+        help="page numbers of the feed workloads (default: 1,100)")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients (default: 16)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds each workload runs (default: 10)")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of unrecorded load before each workload (default: 1)")
+    parser.add_argument("--set", action="append", default=[], metavar="SERVICE.OPTION=VALUE",
+        help="service option, e.g. listings.group_commit_window=5. Services: {}".format(", ".join(SERVICES)))
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s")
+    random.seed(args.seed)
+
+    service_overrides = {}
+    for value in args.set:
+        name, option = value.split(".", 1)
+        service_overrides.setdefault(name, []).append("--" + option)
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    processes = []
+    try:
+        logging.info("Preparing dataset in {}".format(workdir))
+        user_count = prepare_dataset(args, workdir)
+        processes, urls = start_services(workdir, args.shards, service_overrides)
+        results = asyncio.run(run_benchmark(args, urls, user_count))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(workdir)
+
+    report = json.dumps({
+        "commit": git_commit(),
+        "arguments": vars(args),
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
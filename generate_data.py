@@ -1,82 +1,250 @@
 import os
+import sys
 import sqlite3
 import time
 import random
+import argparse
+import multiprocessing
 import names
 
+# The services own their schemas, tables are created through their migrations
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "services", "listings"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "services", "users"))
+import listing_service
+import user_service
+
+LISTINGS_DB = "./services/listings/listings.db"
+USERS_DB = "./services/users/users.db"
+
+# Migration creating the tables only. Indexes come from the later migrations,
+# applied once the data is loaded since building them at the end is much faster.
+TABLES_MIGRATION = 1
+
+# Number of distinct first and last names drawn from the names package,
+# users are given random combinations of them
+NAME_POOL_SIZE = 500
+
 def create_connection(db_file):
     conn = None
     try:
         conn = sqlite3.connect(db_file)
+        # Durability is not needed while loading, the files are deleted on failure anyway
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA journal_mode=MEMORY")
+        conn.execute("PRAGMA cache_size=-262144")
     except sqlite3.Error as e:
         print(e)
     return conn
 
+def delete_db(db_file):
+    # Start from an empty db, so migrations rebuild every table
+    for path in [db_file, db_file + "-wal", db_file + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def delete_listings_shards(db_file):
+    # Shard dbs are numbered from 0, so the dbs of any previous number of shards are removed
+    shard = 0
+    while os.path.exists(listing_service.shard_path(db_file, shard, 2)):
+        delete_db(listing_service.shard_path(db_file, shard, 2))
+        shard += 1
+
 def init_listings_db(conn):
-    cursor = conn.cursor()
-    # Delete table if exists
-    cursor.execute("DROP TABLE IF EXISTS 'listings';")    
-    # Create table
-    cursor.execute(
-        "CREATE TABLE 'listings' ("
-        + "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
-        + "user_id INTEGER NOT NULL,"
-        + "listing_type TEXT NOT NULL,"
-        + "price INTEGER NOT NULL,"
-        + "created_at INTEGER NOT NULL,"
-        + "updated_at INTEGER NOT NULL"
-        + ");"
-    )
-    conn.commit() 
+    listing_service.migrate(conn, target_version=TABLES_MIGRATION)
 
 def init_users_db(conn):
-    cursor = conn.cursor()
-    # Delete table if exists
-    cursor.execute("DROP TABLE IF EXISTS 'users';")
-    # Create table
-    cursor.execute(
-        "CREATE TABLE 'users' ("
-        + "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
-        + "name TEXT NOT NULL,"
-        + "created_at INTEGER NOT NULL,"
-        + "updated_at INTEGER NOT NULL"
-        + ");"
-    )
-    conn.commit()
+    user_service.migrate(conn, target_version=TABLES_MIGRATION)
 
-def insert_random_users(conn, num):
-    insert_names_sql = "INSERT INTO users (name, created_at, updated_at) VALUES (?, ?, ?)"
-    cursor = conn.cursor()
-    for x in range(num):
-        time_now = int(time.time() * 1e6)
-        name = names.get_full_name()
-        cursor.execute(insert_names_sql, (name, time_now, time_now))
+def finish_listings_db(conn):
+    listing_service.migrate(conn)
+
+def finish_users_db(conn):
+    user_service.migrate(conn)
+
+def random_created_at(rng, start, end):
+    # Without a spread, rows are created now
+    if end <= start:
+        return int(time.time() * 1e6)
+    return rng.randint(start, end)
+
+def insert_batches(conn, sql, rows, batch_size):
+    # Inserting batch_size rows per executemany call and transaction
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            conn.executemany(sql, batch)
+            conn.commit()
+            count += len(batch)
+            batch = []
+    if len(batch) > 0:
+        conn.executemany(sql, batch)
         conn.commit()
-        print("INSERT NAME: name: {}".format(name))
+        count += len(batch)
+    return count
+
+def random_users(num, start, end):
+    first_names = [names.get_first_name() for i in range(NAME_POOL_SIZE)]
+    last_names = [names.get_last_name() for i in range(NAME_POOL_SIZE)]
+    for x in range(num):
+        created_at = random_created_at(random, start, end)
+        name = "{} {}".format(random.choice(first_names), random.choice(last_names))
+        yield (name, created_at, created_at)
+
+def random_listings(rng, user_ids, min_per_user, max_per_user, start, end):
+    for user_id in user_ids:
+        for i in range(rng.randint(min_per_user, max_per_user)):
+            created_at = random_created_at(rng, start, end)
+            price = rng.randrange(3000, 20000, 500)
+            listing_type = rng.choice(['rent', 'sale'])
+            yield (user_id, listing_type, price, created_at, created_at)
 
-def insert_random_listings(conn, num):
+def insert_random_users(conn, num, start, end, batch_size):
+    insert_names_sql = "INSERT INTO users (name, created_at, updated_at) VALUES (?, ?, ?)"
+    return insert_batches(conn, insert_names_sql, random_users(num, start, end), batch_size)
+
+def insert_random_listings(conn, user_ids, min_per_user, max_per_user, start, end, batch_size, seed):
     insert_listing_sql = "INSERT INTO listings (user_id, listing_type, price, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
-    cursor = conn.cursor()
-    for user_id in range(1, num):
-        for i in range(random.randrange(1, 5)):
-            time_now = int(time.time() * 1e6)
-            price = random.randrange(3000, 20000, 500)
-            listing_type = random.choice(['rent', 'sale'])
-            cursor.execute(insert_listing_sql, (user_id, listing_type, price, time_now, time_now))
-            conn.commit()
-            print("INSERT LISTING: user_id: {}, listing_type: {}, price: {}".format(user_id, listing_type, price))
+    rng = random.Random(seed)
+    listings = random_listings(rng, user_ids, min_per_user, max_per_user, start, end)
+    return insert_batches(conn, insert_listing_sql, listings, batch_size)
+
+def generate_listings_part(args):
+    # Runs in a worker process, writing the listings of a range of users to their own db file
+    part_db, user_ids, min_per_user, max_per_user, start, end, batch_size, seed = args
+    delete_db(part_db)
+    conn = create_connection(part_db)
+    init_listings_db(conn)
+    insert_random_listings(conn, user_ids, min_per_user, max_per_user, start, end, batch_size, seed)
+    conn.close()
+    return part_db
+
+def insert_random_listings_in_parallel(conn, db_file, user_ids, min_per_user, max_per_user, start, end, batch_size, seed, workers):
+    # Each worker generates the listings of a slice of the users, parts are then merged in order
+    part_size = -(-len(user_ids) // workers)
+    tasks = [
+        (
+            "{}.part{}".format(db_file, i), user_ids[i * part_size:(i + 1) * part_size],
+            min_per_user, max_per_user, start, end, batch_size, None if seed is None else seed + i + 1,
+        )
+        for i in range(workers)
+    ]
+    with multiprocessing.Pool(workers) as pool:
+        part_dbs = pool.map(generate_listings_part, tasks)
+
+    count = 0
+    for part_db in part_dbs:
+        conn.execute("ATTACH DATABASE ? AS part", (part_db,))
+        count += conn.execute(
+            "INSERT INTO listings (user_id, listing_type, price, created_at, updated_at) "
+            + "SELECT user_id, listing_type, price, created_at, updated_at FROM part.listings ORDER BY id"
+        ).rowcount
+        conn.commit()
+        conn.execute("DETACH DATABASE part")
+        delete_db(part_db)
+    return count
+
+def generate_listings_shard(args):
+    # Runs in a worker process if there are several, writing the listings of the users of a shard to its db file
+    db_file, shard, shards, user_ids, min_per_user, max_per_user, start, end, batch_size, seed = args
+    delete_db(db_file)
+    conn = create_connection(db_file)
+    init_listings_db(conn)
+    listing_service.seed_shard_ids(conn, shard)
+    conn.commit()
+    count = insert_random_listings(conn, user_ids, min_per_user, max_per_user, start, end, batch_size, seed)
+    finish_listings_db(conn)
+    listing_service.init_shard(conn, shard, shards)
+    conn.close()
+    os.chmod(db_file, 0o644)
+    return count
+
+def insert_random_listings_sharded(db_file, shards, user_ids, min_per_user, max_per_user, start, end, batch_size, seed, workers):
+    # Each shard db gets the listings of the users the listing service routes to it, up to workers shards at a time
+    tasks = [
+        (
+            listing_service.shard_path(db_file, i, shards), i, shards,
+            [user_id for user_id in user_ids if listing_service.shard_of(user_id, shards) == i],
+            min_per_user, max_per_user, start, end, batch_size, None if seed is None else seed + i + 1,
+        )
+        for i in range(shards)
+    ]
+    if workers > 1:
+        with multiprocessing.Pool(min(workers, shards)) as pool:
+            counts = pool.map(generate_listings_shard, tasks)
+    else:
+        counts = [generate_listings_shard(task) for task in tasks]
+    return sum(counts)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Initialize the listings and users databases with random data")
+    parser.add_argument("--users", type=int, default=50, help="number of users (default: 50)")
+    parser.add_argument("--min-listings-per-user", type=int, default=1, help="minimum number of listings per user (default: 1)")
+    parser.add_argument("--max-listings-per-user", type=int, default=4, help="maximum number of listings per user (default: 4)")
+    parser.add_argument("--created-at-spread", type=float, default=0,
+        help="spread created_at timestamps at random over this many days before now (default: 0, all created now)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed, for reproducible data")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows inserted per transaction (default: 10000)")
+    parser.add_argument("--workers", type=int, default=1,
+        help="processes generating listings, each writing a part merged at the end, or whole shards with --shards (default: 1)")
+    parser.add_argument("--shards", type=int, default=1,
+        help="listing db shards, by user_id, written next to the listings db as listings-0.db, ... "
+        + "The listing service must be started with the same --shards (default: 1, unsharded)")
+    parser.add_argument("--listings-db", default=LISTINGS_DB, help="listings db file (default: {})".format(LISTINGS_DB))
+    parser.add_argument("--users-db", default=USERS_DB, help="users db file (default: {})".format(USERS_DB))
+    return parser.parse_args(argv)
+
+def generate(args):
+    """Creates the dbs described by args (see parse_args), returns the numbers of users and listings inserted."""
+    random.seed(args.seed)
+    end = int(time.time() * 1e6)
+    start = end - int(args.created_at_spread * 86400 * 1e6)
+
+    delete_db(args.users_db)
+    users_conn = create_connection(args.users_db)
+    init_users_db(users_conn)
+    user_count = insert_random_users(users_conn, args.users, start, end, args.batch_size)
+    user_ids = list(range(1, user_count + 1))
+    finish_users_db(users_conn)
+    users_conn.close()
+    os.chmod(args.users_db, 0o644)
+
+    # The listing service refuses to start next to the dbs of another number of shards
+    delete_db(args.listings_db)
+    delete_listings_shards(args.listings_db)
+
+    # Sharded listings are generated straight into their shard dbs
+    if args.shards > 1:
+        listing_count = insert_random_listings_sharded(
+            args.listings_db, args.shards, user_ids, args.min_listings_per_user, args.max_listings_per_user,
+            start, end, args.batch_size, args.seed, args.workers
+        )
+        return user_count, listing_count
+
+    listings_conn = create_connection(args.listings_db)
+    init_listings_db(listings_conn)
+    if args.workers > 1:
+        listing_count = insert_random_listings_in_parallel(
+            listings_conn, args.listings_db, user_ids, args.min_listings_per_user, args.max_listings_per_user,
+            start, end, args.batch_size, args.seed, args.workers
+        )
+    else:
+        listing_count = insert_random_listings(
+            listings_conn, user_ids, args.min_listings_per_user, args.max_listings_per_user,
+            start, end, args.batch_size, args.seed
+        )
 
+    finish_listings_db(listings_conn)
+    listings_conn.close()
+    os.chmod(args.listings_db, 0o644)
+    return user_count, listing_count
 
 if __name__ == "__main__":
+    args = parse_args()
+    start_time = time.time()
     try:
-        listings_conn = create_connection("./services/listings/listings.db")
-        users_conn = create_connection("./services/users/users.db")
-        init_listings_db(listings_conn)
-        init_users_db(users_conn)
-
-        insert_random_listings(listings_conn, 50)
-        insert_random_users(users_conn, 50)
-        os.chmod("./services/listings/listings.db", 0o644)
-        os.chmod("./services/users/users.db", 0o644)
+        user_count, listing_count = generate(args)
+        print("Inserted {} users and {} listings in {:.1f}s".format(user_count, listing_count, time.time() - start_time))
     except Exception as e:
-        print ("Error: ", str(e))
\ No newline at end of file
+        print ("Error: ", str(e))
@@ -1,5 +1,9 @@
 #!/bin/bash
-python generate_data.py
+python generate_data.py "$@"
 
-chmod 664 ./services/listings/listings.db
-chmod 664 ./services/users/users.db
\ No newline at end of file
+# Listings are in listings.db, or in listings-0.db, ... with --shards
+for db in ./services/listings/listings.db ./services/listings/listings-*.db ./services/users/users.db; do
+    if [ -f "$db" ]; then
+        chmod 664 "$db"
+    fi
+done
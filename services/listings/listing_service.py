@@ -1,47 +1,967 @@
 import tornado.web
 import tornado.log
 import tornado.options
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+import os
 import sqlite3
 import logging
 import json
 import time
+import base64
+import threading
+import queue
+import concurrent.futures
+import asyncio
+import collections
+import bisect
+import heapq
+import itertools
+import operator
+import re
+import codecs
+import contextvars
+import cProfile
+
+# orjson serializes several times faster than the json module, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# uvloop is an optional, faster drop-in replacement for the asyncio event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# pyarrow is only needed for exports in the Arrow format
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+def json_dumps(obj):
+    """Returns obj serialized to JSON, as UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+    """Gzips responses at level 1, several times faster than tornado's default level 6 and nearly as small on JSON."""
+    GZIP_LEVEL = 1
+    # Bulk create and export responses are newline-delimited JSON
+    CONTENT_TYPES = tornado.web.GZipContentEncoding.CONTENT_TYPES | {"application/x-ndjson"}
+
+# Columns of the listing records returned by the API, in the order they are selected
+LISTING_COLUMNS = ("id", "user_id", "listing_type", "price", "created_at", "updated_at")
+SELECT_LISTINGS = "SELECT {} FROM listings".format(", ".join(LISTING_COLUMNS))
+# Sort keys of listings rows in feed order (descending) and in update order, for merging the rows of several shards
+FEED_ORDER = operator.itemgetter(4, 0)
+UPDATE_ORDER = operator.itemgetter(5, 0)
+
+def encode_cursor(created_at, id):
+    # Opaque keyset cursor pointing right after the (created_at, id) of the last row of a page
+    return base64.urlsafe_b64encode("{}:{}".format(created_at, id).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor):
+    created_at, id = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split(":")
+    return int(created_at), int(id)
+
+class JSONItemsParser(object):
+    """
+    Incrementally parses a request body that is either a JSON array of objects
+    or newline-delimited JSON objects, returning items as soon as they are complete.
+    An invalid line of newline-delimited JSON is returned as a ValueError in place
+    of its items, and parsing resumes at the next line.
+    """
+    # Whitespace, array brackets and separators skipped between items
+    SEPARATORS = " \t\r\n,[]"
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        # Whether the body is newline-delimited JSON rather than an array, known from its first character
+        self.ndjson = None
+
+    def feed(self, chunk):
+        """Returns the items completed by chunk."""
+        self.buffer += self.text_decoder.decode(chunk)
+        return self._parse(final=False)
+
+    def close(self):
+        """Returns the items left at the end of the body, with a ValueError if it ended in the middle of an item."""
+        self.buffer += self.text_decoder.decode(b"", final=True)
+        return self._parse(final=True)
+
+    def _parse(self, final):
+        if self.ndjson is None:
+            start = self.buffer.lstrip(" \t\r\n")
+            if start == "":
+                return []
+            self.ndjson = not start.startswith("[")
+
+        if not self.ndjson:
+            items, pos = self._decode(self.buffer)
+            self.buffer = self.buffer[pos:]
+            if final and self.buffer.strip(self.SEPARATORS) != "":
+                items.append(ValueError("invalid JSON: {}".format(self.buffer[:100])))
+            return items
+
+        # Lines are parsed once complete, the last one when the body ends
+        lines = self.buffer.split("\n")
+        self.buffer = "" if final else lines.pop()
+        items = []
+        for line in lines:
+            line_items, pos = self._decode(line)
+            items.extend(line_items)
+            if line[pos:].strip(self.SEPARATORS) != "":
+                items.append(ValueError("invalid JSON: {}".format(line[pos:pos + 100])))
+        return items
+
+    def _decode(self, text):
+        """Returns the items at the start of text, and the position of the first one that can't be decoded (yet)."""
+        items = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos] in self.SEPARATORS:
+                pos += 1
+            if pos == len(text):
+                break
+            try:
+                item, pos = self.decoder.raw_decode(text, pos)
+            except ValueError:
+                # Incomplete or invalid item
+                break
+            items.append(item)
+        return items, pos
+
+# Schema migrations, applied in order at startup and recorded in the schema_version table
+# Released migrations must not be edited, add a new one instead
+MIGRATIONS = [
+    # 1: listings table
+    [
+        "CREATE TABLE IF NOT EXISTS 'listings' ("
+        + "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+        + "user_id INTEGER NOT NULL,"
+        + "listing_type TEXT NOT NULL,"
+        + "price INTEGER NOT NULL,"
+        + "created_at INTEGER NOT NULL,"
+        + "updated_at INTEGER NOT NULL"
+        + ");",
+    ],
+    # 2: indexes for the feed order and for listings of a user
+    [
+        "CREATE INDEX IF NOT EXISTS idx_listings_created_at ON listings (created_at, id);",
+        "CREATE INDEX IF NOT EXISTS idx_listings_user_id_created_at ON listings (user_id, created_at);",
+    ],
+    # 3: index for syncing listings in update order
+    [
+        "CREATE INDEX IF NOT EXISTS idx_listings_updated_at ON listings (updated_at, id);",
+    ],
+    # 4: indexes for the listing_type and price filters, in feed order. Prices are part of the
+    # indexes so price ranges are checked while scanning them, without reading skipped rows.
+    # The feed order index is replaced by one that also has the price
+    [
+        "CREATE INDEX IF NOT EXISTS idx_listings_created_at_price ON listings (created_at, id, price);",
+        "DROP INDEX IF EXISTS idx_listings_created_at;",
+        "CREATE INDEX IF NOT EXISTS idx_listings_listing_type_created_at_price ON listings (listing_type, created_at, id, price);",
+    ],
+    # 5: number of listings, in total and per user, kept up to date by triggers so pages can report
+    # totals without counting rows. Listings loaded before the migration are counted once
+    [
+        "CREATE TABLE IF NOT EXISTS counts (name TEXT NOT NULL PRIMARY KEY, count INTEGER NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS listing_counts (user_id INTEGER NOT NULL PRIMARY KEY, count INTEGER NOT NULL);",
+        "INSERT INTO counts (name, count) SELECT 'listings', COUNT(*) FROM listings;",
+        "INSERT INTO listing_counts (user_id, count) SELECT user_id, COUNT(*) FROM listings GROUP BY user_id;",
+        "CREATE TRIGGER IF NOT EXISTS listings_count_insert AFTER INSERT ON listings BEGIN "
+        + "UPDATE counts SET count=count+1 WHERE name='listings'; "
+        + "INSERT INTO listing_counts (user_id, count) VALUES (NEW.user_id, 1) ON CONFLICT (user_id) DO UPDATE SET count=count+1; "
+        + "END;",
+        "CREATE TRIGGER IF NOT EXISTS listings_count_delete AFTER DELETE ON listings BEGIN "
+        + "UPDATE counts SET count=count-1 WHERE name='listings'; "
+        + "UPDATE listing_counts SET count=count-1 WHERE user_id=OLD.user_id; "
+        + "END;",
+        "CREATE TRIGGER IF NOT EXISTS listings_count_update AFTER UPDATE OF user_id ON listings "
+        + "WHEN NEW.user_id != OLD.user_id BEGIN "
+        + "UPDATE listing_counts SET count=count-1 WHERE user_id=OLD.user_id; "
+        + "INSERT INTO listing_counts (user_id, count) VALUES (NEW.user_id, 1) ON CONFLICT (user_id) DO UPDATE SET count=count+1; "
+        + "END;",
+    ],
+    # 6: shard a db holds, out of how many, when listings are sharded (see init_shard)
+    [
+        "CREATE TABLE IF NOT EXISTS shard ("
+        + "id INTEGER NOT NULL PRIMARY KEY CHECK (id = 0),"
+        + "shard INTEGER NOT NULL,"
+        + "shards INTEGER NOT NULL"
+        + ");",
+    ],
+]
+
+# Recount of the counts kept by the triggers of migration 5, run at startup in case they drifted
+# (e.g. rows changed with the triggers dropped, or a restored backup of the tables only)
+REBUILD_COUNTS = [
+    "DELETE FROM counts WHERE name='listings';",
+    "INSERT INTO counts (name, count) SELECT 'listings', COUNT(*) FROM listings;",
+    "DELETE FROM listing_counts;",
+    "INSERT INTO listing_counts (user_id, count) SELECT user_id, COUNT(*) FROM listings GROUP BY user_id;",
+]
+
+# Queries on the hot path, checked at startup to be served by an index without sorting
+HOT_QUERIES = [
+    (SELECT_LISTINGS + " ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", (10, 0)),
+    (SELECT_LISTINGS + " WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?", (0, 0, 10)),
+    (SELECT_LISTINGS + " WHERE user_id=? ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", (1, 10, 0)),
+    (SELECT_LISTINGS + " WHERE user_id=? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?", (1, 0, 0, 10)),
+    (SELECT_LISTINGS + " WHERE (updated_at, id) > (?, ?) ORDER BY updated_at, id LIMIT ?", (0, 0, 10)),
+    (SELECT_LISTINGS + " WHERE id>? ORDER BY id LIMIT ?", (0, 10)),
+    ("SELECT count FROM listing_counts WHERE user_id=?", (1,)),
+    (SELECT_LISTINGS + " WHERE price>=? AND price<=? ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", (1, 2, 10, 0)),
+    (SELECT_LISTINGS + " WHERE listing_type=? AND price>=? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?", ("rent", 1, 0, 0, 10)),
+]
+
+def migrate(db, target_version=None):
+    """
+    Applies the migrations db is missing, up to target_version (the latest by default).
+    Each migration runs in its own write transaction, so concurrent callers apply it once.
+    """
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS 'schema_version' ("
+        + "version INTEGER NOT NULL PRIMARY KEY,"
+        + "applied_at INTEGER NOT NULL"
+        + ");"
+    )
+    db.commit()
+
+    if target_version is None:
+        target_version = len(MIGRATIONS)
+    for version in range(1, target_version + 1):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            applied = db.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone()
+            if applied is None:
+                for statement in MIGRATIONS[version - 1]:
+                    db.execute(statement)
+                db.execute(
+                    "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                    (version, int(time.time() * 1e6))
+                )
+                logging.info("Applied listings db migration {}".format(version))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+def rebuild_counts(db):
+    """Recounts the listings in the counts tables, in a single write transaction."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in REBUILD_COUNTS:
+            db.execute(statement)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+# Listings can be sharded by user_id across several db files. Each shard gives out listing ids
+# from a range of its own, starting at (shard << SHARD_ID_BITS) + 1, so ids are unique across shards
+SHARD_ID_BITS = 40
+
+def shard_path(db_path, shard, shards):
+    """Returns the path of the db file of shard, listings-0.db, ... for db_path listings.db, or db_path itself unsharded."""
+    if shards == 1:
+        return db_path
+    root, ext = os.path.splitext(db_path)
+    return "{}-{}{}".format(root, shard, ext)
+
+def shard_of(user_id, shards):
+    """Returns the shard holding the listings of user_id."""
+    return user_id % shards
+
+def seed_shard_ids(db, shard):
+    """Makes the listings table give out ids from the range of shard, unless it already gave out some."""
+    db.execute(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'listings', ? "
+        + "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name='listings')",
+        (shard << SHARD_ID_BITS,)
+    )
+
+def init_shard(db, shard, shards):
+    """
+    Records that db holds shard out of shards, in a single write transaction. Raises ValueError
+    if it was created for other shards, as its listings would then be looked up in the wrong one.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute("SELECT shard, shards FROM shard").fetchone()
+        if row is None:
+            seed_shard_ids(db, shard)
+            db.execute("INSERT INTO shard (id, shard, shards) VALUES (0, ?, ?)", (shard, shards))
+        elif row != (shard, shards):
+            raise ValueError("listings db holds shard {} of {}, not shard {} of {}. Changing the number of shards requires regenerating the dbs".format(
+                row[0], row[1], shard, shards))
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+def check_shard_layout(db_path, shards):
+    """
+    Raises ValueError if the dbs next to db_path were created for another number of shards, sharded
+    or not, as their listings would then be hidden. Changes between numbers of shards above 1 are
+    caught by init_shard.
+    """
+    if shards > 1 and os.path.exists(db_path):
+        db = sqlite3.connect(db_path)
+        try:
+            has_listings = db.execute("SELECT 1 FROM listings LIMIT 1").fetchone() is not None
+        except sqlite3.OperationalError:
+            # No listings table yet
+            has_listings = False
+        finally:
+            db.close()
+        if has_listings:
+            raise ValueError("{} holds unsharded listings, not {} shards. Changing the number of shards requires regenerating the dbs".format(
+                db_path, shards))
+    if shards == 1 and os.path.exists(shard_path(db_path, 0, 2)):
+        raise ValueError("{} holds a shard of sharded listings, shards must be set. Changing the number of shards requires regenerating the dbs".format(
+            shard_path(db_path, 0, 2)))
+
+def check_query_plans(db):
+    """Returns the hot queries that would scan the table or sort their results."""
+    slow_queries = []
+    for query, args in HOT_QUERIES:
+        for row in db.execute("EXPLAIN QUERY PLAN " + query, args):
+            detail = row[3]
+            if "TEMP B-TREE" in detail or (detail.startswith("SCAN") and "INDEX" not in detail):
+                slow_queries.append(query)
+                break
+    return slow_queries
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """Latency histogram with counts per LATENCY_BUCKETS bucket, plus their sum and count."""
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self):
+        # The last bucket counts the values above every bound
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics(object):
+    """
+    Counters and latency histograms of this process, rendered in the Prometheus
+    text format by /metrics. Series are created on first use, one per tuple of
+    label values, so recording a value only updates a few numbers.
+    """
+
+    def __init__(self, worker=0):
+        # Worker process of the metrics, a worker label of every series
+        self.worker = worker
+        # Values are recorded from the event loop and from the db threads
+        self.lock = threading.Lock()
+        # name -> (type, help, label names)
+        self.definitions = collections.OrderedDict()
+        # name -> {label values: count or Histogram}
+        self.series = {}
+
+    def define(self, name, type, help, labels=()):
+        if name not in self.definitions:
+            self.definitions[name] = (type, help, labels)
+            self.series[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.series[name]
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (type, help, label_names) in self.definitions.items():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, type))
+                for labels, value in self.series[name].items():
+                    pairs = ['worker="{}"'.format(self.worker)] + ['{}="{}"'.format(label_name, escape_label_value(label))
+                        for label_name, label in zip(label_names, labels)]
+                    if type != "histogram":
+                        lines.append("{}{} {}".format(name, format_labels(pairs), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value.buckets):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(name, format_labels(pairs + ['le="{}"'.format(bound)]), cumulative))
+                    lines.append("{}_sum{} {}".format(name, format_labels(pairs), value.sum))
+                    lines.append("{}_count{} {}".format(name, format_labels(pairs), value.count))
+        return "\n".join(lines) + "\n"
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(pairs):
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def merge_metrics(texts):
+    """Returns the metrics rendered by several workers as a single text, with the series of every worker under each metric."""
+    # name -> (HELP and TYPE lines, series lines)
+    families = collections.OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = families.setdefault(line.split(" ")[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line != "":
+                family[1].append(line)
+    lines = []
+    for header, series in families.values():
+        lines.extend(header)
+        lines.extend(series)
+    return "\n".join(lines) + "\n"
+
+# Trace context of the request being handled: (trace id, id of the span new spans are children of)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# W3C trace context header: version-trace id-parent span id-flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+def parse_traceparent(value):
+    """Returns the (trace id, parent span id) of a traceparent header value, or None if it is missing or invalid."""
+    match = TRACEPARENT.match(value or "")
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+def format_traceparent(trace_id, span_id):
+    return "00-{}-{}-01".format(trace_id, span_id)
+
+class Tracer(object):
+    """
+    Keeps the last max_spans spans recorded by the service in a ring buffer,
+    to find out where the time of slow requests went. Spans are recorded from
+    the event loop and from other threads.
+    """
+
+    def __init__(self, service, max_spans, worker=0):
+        self.service = service
+        # Worker process recording the spans
+        self.worker = worker
+        self.enabled = max_spans > 0
+        # Appending to a bounded deque is thread-safe, and drops the oldest span once full
+        self.spans = collections.deque(maxlen=max_spans)
+
+    def record(self, trace, span_id, name, start, duration, **attributes):
+        """
+        Records a span of trace, a (trace id, parent span id) pair, started at start
+        (seconds since the epoch) and lasting duration seconds. Does nothing without a trace.
+        """
+        if not self.enabled or trace is None:
+            return
+        trace_id, parent_id = trace
+        self.spans.append({
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "service": self.service,
+            "worker": self.worker,
+            "name": name,
+            "start": int(start * 1e6),
+            "duration": int(duration * 1e6),
+            "attributes": attributes,
+        })
+
+    def get_spans(self, trace_id=None):
+        """Returns the recorded spans, oldest first, only those of trace_id if specified."""
+        spans = list(self.spans)
+        if trace_id is not None:
+            spans = [span for span in spans if span["trace_id"] == trace_id]
+        return spans
+
+    def to_chrome_trace(self, spans):
+        """
+        Returns spans in the Chrome trace event format, which chrome://tracing and Perfetto load.
+        The spans of each worker are shown as a process.
+        """
+        events = [
+            {"name": "process_name", "ph": "M", "pid": worker, "args": {"name": "{} worker {}".format(self.service, worker)}}
+            for worker in sorted({span["worker"] for span in spans})
+        ]
+        for span in spans:
+            events.append({
+                "name": span["name"],
+                "cat": span["service"],
+                "ph": "X",
+                "pid": span["worker"],
+                # One track per trace
+                "tid": int(span["trace_id"][:8], 16),
+                "ts": span["start"],
+                "dur": span["duration"],
+                "args": dict(span["attributes"], trace_id=span["trace_id"], span_id=span["span_id"], parent_id=span["parent_id"]),
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# Placeholder lists of "IN (?, ?, ...)" clauses, collapsed in the statement label of query metrics
+IN_PLACEHOLDERS = re.compile(r"IN \([?,\s]*\)")
+
+# Applied to every connection. The db itself is switched to WAL mode at startup,
+# so readers don't block the writer, and commits only fsync at checkpoints.
+DB_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+]
+
+class Database(object):
+    """
+    Runs SQLite statements off the event loop. Reads run on a bounded thread pool,
+    each thread with its own connection, while writes are serialized through a
+    single writer thread and connection. Methods return asyncio futures handlers can await.
+
+    With a group_commit_window (in seconds), the writer waits that long for more
+    writes after the first one and commits all of them in a single transaction.
+
+    Statement and commit durations are recorded in metrics, statements are also
+    recorded as spans of the trace they were run for in tracer.
+    """
+
+    def __init__(self, path, read_threads, group_commit_window=0, group_commit_max_size=256, metrics=None, tracer=None):
+        self.path = path
+        self.group_commit_window = group_commit_window
+        self.group_commit_max_size = group_commit_max_size
+        self.local = threading.local()
+        self.read_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=read_threads, thread_name_prefix="db-read"
+        )
+        self.write_queue = queue.Queue()
+
+        # Saturation metrics, updated from the event loop and the db threads
+        self.lock = threading.Lock()
+        self.stats = {
+            "reads": 0, "writes": 0, "write_transactions": 0,
+            "read_queue_depth": 0, "write_queue_depth": 0,
+            "read_wait_time": 0.0, "write_wait_time": 0.0,
+            "max_read_wait_time": 0.0, "max_write_wait_time": 0.0,
+        }
+        self.metrics = metrics or Metrics()
+        self.metrics.define("db_query_duration_seconds", "histogram",
+            "Time spent running SQL statements, excluding queue wait", ("statement",))
+        self.metrics.define("db_commit_duration_seconds", "histogram", "Time spent committing write transactions")
+        self.tracer = tracer or Tracer("db", 0)
+        # sql -> statement label
+        self.statement_labels = {}
+
+        self.writer = threading.Thread(target=self._write_loop, name="db-write", daemon=True)
+        self.writer.start()
+
+    def connect(self, check_same_thread=True):
+        # Rows are plain tuples, handlers map them to the columns they selected
+        db = sqlite3.connect(self.path, check_same_thread=check_same_thread)
+        for pragma in DB_PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def fetchall(self, sql, args=()):
+        """Returns a future resolving to the rows selected by sql."""
+        return self._read(sql, lambda db: db.execute(sql, args).fetchall())
+
+    def fetchone(self, sql, args=()):
+        """Returns a future resolving to the first row selected by sql, or None."""
+        return self._read(sql, lambda db: db.execute(sql, args).fetchone())
+
+    def execute_write(self, sql, args=()):
+        """Returns a future resolving to the lastrowid of sql, once committed."""
+        return self._write(sql, lambda db: db.execute(sql, args).lastrowid)
+
+    def executemany_write(self, sql, seq_of_args):
+        """
+        Returns a future resolving to the rowid of the last row inserted by sql, once committed.
+        Rows inserted in a single transaction get consecutive rowids.
+        """
+        def write(db):
+            db.executemany(sql, seq_of_args)
+            return db.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return self._write(sql, write)
+
+    def snapshot(self):
+        """Returns a Snapshot reading the db as of its first query."""
+        return Snapshot(self)
+
+    def _read(self, sql, fn):
+        submitted_at = time.monotonic()
+        trace = current_trace.get()
+        with self.lock:
+            self.stats["read_queue_depth"] += 1
+
+        def run():
+            self._record_wait("read", submitted_at)
+            db = getattr(self.local, "db", None)
+            if db is None:
+                db = self.local.db = self.connect()
+            start = time.perf_counter()
+            try:
+                return fn(db)
+            finally:
+                self._record_query(sql, start, trace)
+
+        # Handing out asyncio futures, concurrent futures can't be awaited
+        return asyncio.wrap_future(self.read_executor.submit(run))
+
+    def _write(self, sql, fn):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.stats["write_queue_depth"] += 1
+        self.write_queue.put((sql, fn, future, time.monotonic(), current_trace.get()))
+        return asyncio.wrap_future(future)
+
+    def _write_loop(self):
+        db = self.connect()
+        # Transactions are managed explicitly
+        db.isolation_level = None
+        stopping = False
+        while not stopping:
+            job = self.write_queue.get()
+            if job is None:
+                break
+            jobs = [job]
+
+            # Collecting the writes arriving within the group commit window
+            if self.group_commit_window > 0:
+                deadline = time.monotonic() + self.group_commit_window
+                while len(jobs) < self.group_commit_max_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        job = self.write_queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    jobs.append(job)
+
+            try:
+                self._run_writes(db, jobs)
+            except Exception as e:
+                # The writer thread must survive: the writes of the batch fail instead of hanging
+                logging.exception("Error while running %d db writes", len(jobs))
+                self._abort_writes(db, jobs, e)
+        db.close()
+
+    def _abort_writes(self, db, jobs, error):
+        try:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+        except Exception:
+            logging.exception("Error while rolling back db writes")
+        for sql, fn, future, submitted_at, trace in jobs:
+            if not future.done():
+                future.set_exception(error)
+
+    def _run_writes(self, db, jobs):
+        # Each write runs in a savepoint, so a failing one doesn't abort the others of the transaction
+        results = []
+        for sql, fn, future, submitted_at, trace in jobs:
+            self._record_wait("write", submitted_at)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for sql, fn, future, submitted_at, trace in jobs:
+                future.set_exception(e)
+            return
+
+        for sql, fn, future, submitted_at, trace in jobs:
+            db.execute("SAVEPOINT write")
+            start = time.perf_counter()
+            try:
+                result = fn(db)
+            except Exception as e:
+                db.execute("ROLLBACK TO write")
+                results.append((future, None, e))
+            else:
+                results.append((future, result, None))
+            self._record_query(sql, start, trace)
+            db.execute("RELEASE write")
+
+        start = time.perf_counter()
+        try:
+            db.execute("COMMIT")
+            self.metrics.observe("db_commit_duration_seconds", (), time.perf_counter() - start)
+        except Exception as e:
+            db.execute("ROLLBACK")
+            results = [(future, None, e) for future, _, _ in results]
+        with self.lock:
+            self.stats["write_transactions"] += 1
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _record_wait(self, kind, submitted_at):
+        wait_time = time.monotonic() - submitted_at
+        with self.lock:
+            self.stats[kind + "_queue_depth"] -= 1
+            self.stats[kind + "s"] += 1
+            self.stats[kind + "_wait_time"] += wait_time
+            self.stats["max_" + kind + "_wait_time"] = max(self.stats["max_" + kind + "_wait_time"], wait_time)
+
+    def _record_query(self, sql, start, trace):
+        duration = time.perf_counter() - start
+        label = self.statement_labels.get(sql)
+        if label is None:
+            label = self.statement_labels[sql] = " ".join(IN_PLACEHOLDERS.sub("IN (...)", sql).split())
+        self.metrics.observe("db_query_duration_seconds", (label,), duration)
+        self.tracer.record(trace, new_span_id(), "sql", time.time() - duration, duration, statement=label)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        self.write_queue.put(None)
+        self.writer.join()
+        self.read_executor.shutdown()
+
+class Snapshot(object):
+    """
+    Read transaction on a connection of its own, so all its queries see the db
+    as it was at the first one, whatever is written meanwhile. Queries run on
+    the read threads of database, one at a time. close() ends the transaction.
+
+    WAL checkpoints can't go past an open snapshot, the WAL file grows until it is closed.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.db = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def fetchall(self, sql, args=()):
+        """Returns a future resolving to the rows selected by sql."""
+        def read(thread_db):
+            with self.lock:
+                if self.closed:
+                    raise sqlite3.ProgrammingError("snapshot is closed")
+                if self.db is None:
+                    # The connection is used by whichever read thread runs the query
+                    self.db = self.database.connect(check_same_thread=False)
+                    self.db.isolation_level = None
+                    self.db.execute("BEGIN")
+                return self.db.execute(sql, args).fetchall()
+        return self.database._read(sql, read)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.db is not None:
+                # Closing the connection rolls the read transaction back
+                self.db.close()
+                self.db = None
+
+async def fetch_merged(dbs, sql, args, limit, offset=None, key=None, reverse=False):
+    """
+    Returns up to limit of the rows selected by sql from dbs, past the first offset ones if specified.
+    sql must select rows in key order (descending if reverse) and leave out LIMIT and OFFSET. A single
+    db runs it as is, several dbs each select their first offset + limit rows, then these are merged.
+    """
+    if len(dbs) == 1:
+        sql += " LIMIT ?"
+        args = list(args) + [limit]
+        if offset is not None:
+            sql += " OFFSET ?"
+            args.append(offset)
+        return await dbs[0].fetchall(sql, args)
+    offset = max(offset or 0, 0)
+    # SQLite has no limit for a negative LIMIT
+    shard_limit = offset + limit if limit >= 0 else -1
+    results = await asyncio.gather(*[db.fetchall(sql + " LIMIT ?", list(args) + [shard_limit]) for db in dbs])
+    rows = heapq.merge(*results, key=key, reverse=reverse)
+    return list(itertools.islice(rows, offset, offset + limit if limit >= 0 else None))
+
+def init_db(db_path, shard=0, shards=1):
+    db = sqlite3.connect(db_path)
+    try:
+        # WAL mode is persistent, it only needs to be set once
+        db.execute("PRAGMA journal_mode=WAL")
+
+        # Create or upgrade tables and indexes
+        migrate(db)
+        init_shard(db, shard, shards)
+
+        start = time.monotonic()
+        rebuild_counts(db)
+        logging.info("Rebuilt listing counts in {:.2f}s".format(time.monotonic() - start))
+
+        for query in check_query_plans(db):
+            logging.warning("Query is not served by an index: {}".format(query))
+    finally:
+        db.close()
+
+def init_shards(db_path, shards):
+    """Initializes the db of every shard, after checking they were created for shards."""
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+    check_shard_layout(db_path, shards)
+    for shard in range(shards):
+        init_db(shard_path(db_path, shard, shards), shard, shards)
+
+# Number of listings inserted per transaction by bulk creates
+BULK_CHUNK_SIZE = 1000
+
+# Pages with more listings than this are fetched and written this many listings at a time
+STREAM_CHUNK_SIZE = 1000
+
+# Number of listings read and written at a time by exports
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "arrow": "application/vnd.apache.arrow.stream"}
+# Arrow types of LISTING_COLUMNS
+ARROW_LISTINGS_SCHEMA = pyarrow.schema([
+    ("id", pyarrow.int64()),
+    ("user_id", pyarrow.int64()),
+    ("listing_type", pyarrow.string()),
+    ("price", pyarrow.int64()),
+    ("created_at", pyarrow.int64()),
+    ("updated_at", pyarrow.int64()),
+]) if pyarrow is not None else None
+# Arrow IPC stream end marker, a continuation marker followed by a zero message length
+ARROW_END_OF_STREAM = b"\xff\xff\xff\xff\x00\x00\x00\x00"
 
 class App(tornado.web.Application):
 
-    def __init__(self, handlers, **kwargs):
+    def __init__(self, handlers, db_path, shards, db_read_threads, group_commit_window, trace_buffer_size,
+                 db_initialized=False, **kwargs):
         super().__init__(handlers, **kwargs)
+        # Metrics and spans are recorded per worker process
+        worker = tornado.process.task_id() or 0
+        self.metrics = Metrics(worker)
+        self.metrics.define("http_request_duration_seconds", "histogram",
+            "Time spent serving requests", ("handler", "method", "status"))
+        self.tracer = Tracer("listings", trace_buffer_size, worker)
+        # Whether a request is being profiled, a single one can be at a time
+        self.profiling = False
 
-        # Initialising db connection
-        self.db = sqlite3.connect("listings.db")
-        self.db.row_factory = sqlite3.Row
-        self.init_db()
-
-    def init_db(self):
-        cursor = self.db.cursor()
-
-        # Create table
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS 'listings' ("
-            + "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
-            + "user_id INTEGER NOT NULL,"
-            + "listing_type TEXT NOT NULL,"
-            + "price INTEGER NOT NULL,"
-            + "created_at INTEGER NOT NULL,"
-            + "updated_at INTEGER NOT NULL"
-            + ");"
-        )
-        self.db.commit()
+        # Initialising db access, with a db per shard. The dbs are migrated unless the entry point
+        # already did before forking workers
+        if not db_initialized:
+            init_shards(db_path, shards)
+        self.shards = [
+            Database(shard_path(db_path, shard, shards), db_read_threads, group_commit_window, metrics=self.metrics, tracer=self.tracer)
+            for shard in range(shards)
+        ]
+
+    def shard(self, user_id):
+        """Returns the db of the shard holding the listings of user_id."""
+        return self.shards[shard_of(user_id, len(self.shards))]
+
+    def close(self):
+        for db in self.shards:
+            db.close()
 
 class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self):
+        # Continuing the trace of the caller's traceparent header, or starting a new one
+        trace = parse_traceparent(self.request.headers.get("traceparent"))
+        if trace is not None:
+            self.trace_id, self.parent_span_id = trace
+        else:
+            self.trace_id, self.parent_span_id = new_trace_id(), None
+        self.span_id = new_span_id()
+        self.profile = None
+
+    def prepare(self):
+        # Spans recorded while handling the request, on the event loop and in other threads, are children of its span
+        current_trace.set((self.trace_id, self.span_id))
+        self.set_header("X-Trace-Id", self.trace_id)
+
+        # Profiling the request when asked to with __profile=1, if profiling is enabled.
+        # The profiler sees everything the event loop runs meanwhile, including other requests
+        if self.settings["profile_dir"] is not None and self.get_query_argument("__profile", None) == "1":
+            if self.application.profiling:
+                logging.warning("Not profiling {}, another request is being profiled".format(self.request.uri))
+            else:
+                self.application.profiling = True
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+
+    def on_finish(self):
+        request_time = self.request.request_time()
+        self.application.metrics.observe(
+            "http_request_duration_seconds",
+            (type(self).__name__, self.request.method, self.get_status()),
+            request_time
+        )
+        self.application.tracer.record(
+            (self.trace_id, self.parent_span_id), self.span_id, type(self).__name__,
+            time.time() - request_time, request_time,
+            method=self.request.method, path=self.request.path, status=self.get_status()
+        )
+        self.stop_profile()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self.stop_profile()
+
+    def stop_profile(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.application.profiling = False
+        path = os.path.join(self.settings["profile_dir"], "{}-{}.prof".format(type(self).__name__, self.trace_id))
+        self.profile.dump_stats(path)
+        self.profile = None
+        logging.info("Profile of {} written to {}".format(self.request.uri, path))
+
+    def record_span(self, name, start, **attributes):
+        # Records a span of the request, from start (a time.perf_counter() value) to now
+        duration = time.perf_counter() - start
+        self.application.tracer.record(
+            (self.trace_id, self.span_id), new_span_id(), name, time.time() - duration, duration, **attributes
+        )
+
     def write_json(self, obj, status_code=200):
         self.set_header("Content-Type", "application/json")
         self.set_status(status_code)
-        self.write(json.dumps(obj))
+        start = time.perf_counter()
+        body = json_dumps(obj)
+        self.record_span("serialize", start, bytes=len(body))
+        self.write(body)
 
 # /listings
 class ListingsHandler(BaseHandler):
-    @tornado.gen.coroutine
-    def get(self):
+    async def get(self):
         # Parsing pagination params
         page_num = self.get_argument("page_num", 1)
         page_size = self.get_argument("page_size", 10)
@@ -59,6 +979,24 @@ class ListingsHandler(BaseHandler):
             self.write_json({"result": False, "errors": "invalid page_size"}, status_code=400)
             return
 
+        # Incremental sync when updated_since is specified: the listings updated after (updated_since, updated_since_id),
+        # in update order. Callers pass the updated_at and id of the last listing they got to get the next ones
+        updated_since = self.get_argument("updated_since", None)
+        if updated_since is not None:
+            try:
+                updated_since = int(updated_since)
+                updated_since_id = int(self.get_argument("updated_since_id", 0))
+            except:
+                self.write_json({"result": False, "errors": "invalid updated_since"}, status_code=400)
+                return
+            results = await fetch_merged(
+                self.application.shards,
+                SELECT_LISTINGS + " WHERE (updated_at, id) > (?, ?) ORDER BY updated_at, id",
+                (updated_since, updated_since_id), page_size, key=UPDATE_ORDER
+            )
+            self.write_json({"result": True, "listings": [dict(zip(LISTING_COLUMNS, row)) for row in results]})
+            return
+
         # Parsing user_id param
         user_id = self.get_argument("user_id", None)
         if user_id is not None:
@@ -68,36 +1006,151 @@ class ListingsHandler(BaseHandler):
                 self.write_json({"result": False, "errors": "invalid user_id"}, status_code=400)
                 return
 
-        # Building select statement
-        select_stmt = "SELECT * FROM listings"
+        # Parsing include_total param, adding the total number of listings and whether there is a next page
+        include_total = self.get_argument("include_total", "false").lower() in {"1", "true"}
+
+        # Parsing filter params
+        listing_type = self.get_argument("listing_type", None)
+        if listing_type is not None and listing_type not in {"rent", "sale"}:
+            self.write_json({"result": False, "errors": "invalid listing_type. Supported values: 'rent', 'sale'"}, status_code=400)
+            return
+        prices = {}
+        for name in ["min_price", "max_price"]:
+            price = self.get_argument(name, None)
+            if price is not None:
+                try:
+                    prices[name] = int(price)
+                except:
+                    self.write_json({"result": False, "errors": "invalid {}".format(name)}, status_code=400)
+                    return
+
+        # Parsing cursor param, seeks past the previous page instead of using page_num when specified
+        page_cursor = self.get_argument("cursor", None)
+        if page_cursor is not None:
+            try:
+                page_cursor = decode_cursor(page_cursor)
+            except:
+                self.write_json({"result": False, "errors": "invalid cursor"}, status_code=400)
+                return
+
+        # Listings of a user are all in its shard, the others are merged from every shard
+        dbs = [self.application.shard(user_id)] if user_id is not None else self.application.shards
+
+        # Building filter clauses
+        conditions = []
+        args = []
         # Adding user_id filter clause if param is specified
         if user_id is not None:
-            select_stmt += " WHERE user_id=?"
-        # Order by and pagination
+            conditions.append("user_id=?")
+            args.append(user_id)
+        # Adding filter clauses if params are specified
+        if listing_type is not None:
+            conditions.append("listing_type=?")
+            args.append(listing_type)
+        if "min_price" in prices:
+            conditions.append("price>=?")
+            args.append(prices["min_price"])
+        if "max_price" in prices:
+            conditions.append("price<=?")
+            args.append(prices["max_price"])
+
+        # Reading the total from the counts kept by the db, which has none for the listing_type and price filters
+        total = None
+        if include_total and listing_type is None and len(prices) == 0:
+            if user_id is None:
+                rows = await asyncio.gather(*[db.fetchone("SELECT count FROM counts WHERE name='listings'") for db in dbs])
+            else:
+                rows = [await dbs[0].fetchone("SELECT count FROM listing_counts WHERE user_id=?", (user_id,))]
+            total = sum(row[0] for row in rows if row is not None)
+
+        # Large pages, and all the listings at once with a negative page_size, are written as they are fetched
+        if page_size > STREAM_CHUNK_SIZE or page_size < 0:
+            await self._stream_listings(dbs, conditions, args, page_size, (page_num - 1) * page_size, page_cursor, include_total, total)
+            return
+
+        # Fetching listings from db, and one more when including the total to tell whether there is a next page
         limit = page_size
-        offset = (page_num - 1) * page_size
-        select_stmt += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+        if include_total and page_size >= 0:
+            limit += 1
+        results = await self._select_listings(dbs, conditions, args, limit, (page_num - 1) * page_size, page_cursor)
+        has_more = len(results) > page_size >= 0
+        if has_more:
+            results = results[:page_size]
 
-        # Fetching listings from db
-        if user_id is not None:
-            args = (user_id, limit, offset)
-        else:
-            args = (limit, offset)
-        cursor = self.application.db.cursor()
-        results = cursor.execute(select_stmt, args)
-
-        listings = []
-        for row in results:
-            fields = ["id", "user_id", "listing_type", "price", "created_at", "updated_at"]
-            listing = {
-                field: row[field] for field in fields
-            }
-            listings.append(listing)
-
-        self.write_json({"result": True, "listings": listings})
-
-    @tornado.gen.coroutine
-    def post(self):
+        listings = [dict(zip(LISTING_COLUMNS, row)) for row in results]
+
+        # Handing out a cursor to the next page unless this one was the last
+        next_cursor = None
+        if len(listings) == page_size and page_size > 0 and (has_more or not include_total):
+            next_cursor = encode_cursor(listings[-1]["created_at"], listings[-1]["id"])
+
+        page = {"result": True, "listings": listings, "next_cursor": next_cursor}
+        if include_total:
+            page["total"] = total
+            page["has_more"] = has_more
+        self.write_json(page)
+
+    def _select_listings(self, dbs, conditions, args, limit, offset, page_cursor):
+        """
+        Returns an awaitable resolving to up to limit listings rows of dbs matching conditions,
+        in feed order, past page_cursor if specified and past offset rows otherwise.
+        """
+        select_stmt = SELECT_LISTINGS
+        conditions = list(conditions)
+        args = list(args)
+        # Adding keyset clause if cursor is specified
+        if page_cursor is not None:
+            conditions.append("(created_at, id) < (?, ?)")
+            args.extend(page_cursor)
+        if len(conditions) > 0:
+            select_stmt += " WHERE " + " AND ".join(conditions)
+        # Order by, pagination is added by fetch_merged
+        select_stmt += " ORDER BY created_at DESC, id DESC"
+        return fetch_merged(dbs, select_stmt, args, limit, offset if page_cursor is None else None, key=FEED_ORDER, reverse=True)
+
+    async def _stream_listings(self, dbs, conditions, args, page_size, offset, page_cursor, include_total, total):
+        # Writes the same body as write_json, fetching and flushing STREAM_CHUNK_SIZE listings at a time
+        # so memory stays bounded whatever the page size. The first chunk seeks to the page with
+        # page_cursor or offset, the next ones continue from the last listing written. A negative
+        # page_size streams every listing
+        self.set_header("Content-Type", "application/json")
+        self.write(b'{"result":true,"listings":[')
+        remaining = page_size if page_size >= 0 else None
+        separator = b""
+        while remaining is None or remaining > 0:
+            limit = STREAM_CHUNK_SIZE if remaining is None else min(remaining, STREAM_CHUNK_SIZE)
+            results = await self._select_listings(dbs, conditions, args, limit, offset, page_cursor)
+            if len(results) == 0:
+                break
+            listings = [dict(zip(LISTING_COLUMNS, row)) for row in results]
+            # Items of the chunk, without the brackets of the list
+            self.write(separator + json_dumps(listings)[1:-1])
+            separator = b","
+            await self.flush()
+            if remaining is not None:
+                remaining -= len(listings)
+            page_cursor = (listings[-1]["created_at"], listings[-1]["id"])
+            if len(listings) < limit:
+                break
+
+        has_more = remaining == 0
+        if include_total and has_more:
+            # Looking for a listing past the page to tell whether there is a next one
+            results = await self._select_listings(dbs, conditions, args, 1, offset, page_cursor)
+            has_more = len(results) > 0
+
+        # Handing out a cursor to the next page unless this one was the last
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor(*page_cursor)
+        # Remaining keys of the page, after the list of listings
+        tail = {"next_cursor": next_cursor}
+        if include_total:
+            tail["total"] = total
+            tail["has_more"] = has_more
+        self.write(b"]," + json_dumps(tail)[1:])
+
+    async def post(self):
         # Collecting required params
         user_id = self.get_argument("user_id")
         listing_type = self.get_argument("listing_type")
@@ -116,22 +1169,20 @@ class ListingsHandler(BaseHandler):
             return
 
         # Proceed to store the listing in our db
-        cursor = self.application.db.cursor()
-        cursor.execute(
+        lastrowid = await self.application.shard(user_id_val).execute_write(
             "INSERT INTO 'listings' "
             + "('user_id', 'listing_type', 'price', 'created_at', 'updated_at') "
             + "VALUES (?, ?, ?, ?, ?)",
             (user_id_val, listing_type_val, price_val, time_now, time_now)
         )
-        self.application.db.commit()
 
         # Error out if we fail to retrieve the newly created listing
-        if cursor.lastrowid is None:
+        if lastrowid is None:
             self.write_json({"result": False, "errors": ["Error while adding listing to db"]}, status_code=500)
             return
 
         listing = dict(
-            id=cursor.lastrowid,
+            id=lastrowid,
             user_id=user_id_val,
             listing_type=listing_type_val,
             price=price_val,
@@ -172,36 +1223,376 @@ class ListingsHandler(BaseHandler):
         else:
             return price
 
+# /listings/bulk
+@tornado.web.stream_request_body
+class BulkListingsHandler(ListingsHandler):
+    """
+    Creates listings from a JSON array or newline-delimited JSON objects, as the
+    body is received. Listings are inserted BULK_CHUNK_SIZE per transaction and
+    their results streamed back as newline-delimited JSON, one line per item.
+    """
+    SUPPORTED_METHODS = ("POST",)
+
+    def prepare(self):
+        super().prepare()
+        self.parser = JSONItemsParser()
+        self.item_count = 0
+        # (item index, insert args) of the validated listings waiting to be inserted
+        self.pending = []
+        # (item index, result line) of the rejected items, written with the results of their chunk
+        self.rejected = []
+        self.set_header("Content-Type", "application/x-ndjson")
+
+    async def data_received(self, chunk):
+        for item in self.parser.feed(chunk):
+            self._add_item(item)
+        if len(self.pending) >= BULK_CHUNK_SIZE:
+            await self._insert_pending()
+
+    async def post(self):
+        for item in self.parser.close():
+            self._add_item(item)
+        await self._insert_pending()
+
+    def _add_item(self, item):
+        index = self.item_count
+        self.item_count += 1
+        if isinstance(item, ValueError):
+            self.rejected.append((index, {"index": index, "result": False, "errors": [str(item)]}))
+            return
+        if not isinstance(item, dict):
+            self.rejected.append((index, {"index": index, "result": False, "errors": ["listing must be a JSON object"]}))
+            return
+
+        # Validating inputs
+        errors = []
+        user_id_val = self._validate_user_id(item.get("user_id"), errors)
+        listing_type_val = self._validate_listing_type(item.get("listing_type"), errors)
+        price_val = self._validate_price(item.get("price"), errors)
+        time_now = int(time.time() * 1e6) # Converting current time to microseconds
+        if len(errors) > 0:
+            self.rejected.append((index, {"index": index, "result": False, "errors": errors}))
+            return
+
+        self.pending.append((index, (user_id_val, listing_type_val, price_val, time_now, time_now)))
+
+    async def _insert_pending(self):
+        pending, self.pending = self.pending, []
+        lines, self.rejected = self.rejected, []
+        if len(pending) == 0 and len(lines) == 0:
+            return
+
+        # Inserting the listings of each shard in a transaction of that shard, shards in parallel
+        pending_by_shard = collections.OrderedDict()
+        for index, args in pending:
+            pending_by_shard.setdefault(self.application.shard(args[0]), []).append((index, args))
+        results = await asyncio.gather(*[
+            self._insert_shard(db, shard_pending) for db, shard_pending in pending_by_shard.items()
+        ])
+        lines.extend(itertools.chain.from_iterable(results))
+
+        # Writing results in item order
+        for index, line in sorted(lines, key=operator.itemgetter(0)):
+            self._write_line(line)
+        await self.flush()
+
+    async def _insert_shard(self, db, pending):
+        # Returns the (item index, result line) of the listings of pending, all of the shard of db
+        try:
+            lastrowid = await db.executemany_write(
+                "INSERT INTO 'listings' "
+                + "('user_id', 'listing_type', 'price', 'created_at', 'updated_at') "
+                + "VALUES (?, ?, ?, ?, ?)",
+                [args for index, args in pending]
+            )
+        except Exception as e:
+            logging.exception("Error while adding listings to db")
+            return [
+                (index, {"index": index, "result": False, "errors": ["Error while adding listing to db"]})
+                for index, args in pending
+            ]
+
+        # Rows of a single transaction are given consecutive ids
+        first_id = lastrowid - len(pending) + 1
+        lines = []
+        for i, (index, args) in enumerate(pending):
+            user_id_val, listing_type_val, price_val, created_at, updated_at = args
+            listing = dict(
+                id=first_id + i,
+                user_id=user_id_val,
+                listing_type=listing_type_val,
+                price=price_val,
+                created_at=created_at,
+                updated_at=updated_at
+            )
+            lines.append((index, {"index": index, "result": True, "listing": listing}))
+        return lines
+
+    def _write_line(self, obj):
+        self.write(json_dumps(obj) + b"\n")
+
+# /listings/export
+class ExportListingsHandler(BaseHandler):
+    """
+    Streams the listings with an id greater than after_id, in id order, as
+    newline-delimited JSON or an Arrow IPC stream. Listings are read
+    EXPORT_CHUNK_SIZE at a time in a single read transaction, so the export is
+    consistent as of its start and memory use doesn't grow with the table.
+    An interrupted export resumes by passing the last id received as after_id.
+
+    Sharded listings are exported shard after shard, whose id ranges follow each
+    other. Each shard is read in a transaction of its own, started together.
+    """
+
+    def prepare(self):
+        super().prepare()
+        self.snapshots = []
+
+    async def get(self):
+        export_format = self.get_argument("format", "ndjson")
+        if export_format not in EXPORT_FORMATS:
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'ndjson', 'arrow'"}, status_code=400)
+            return
+        if export_format == "arrow" and pyarrow is None:
+            self.write_json({"result": False, "errors": "the arrow format requires pyarrow"}, status_code=400)
+            return
+        try:
+            after_id = int(self.get_argument("after_id", 0))
+        except:
+            self.write_json({"result": False, "errors": "invalid after_id"}, status_code=400)
+            return
+
+        self.set_header("Content-Type", EXPORT_FORMATS[export_format])
+        if export_format == "arrow":
+            self.write(ARROW_LISTINGS_SCHEMA.serialize().to_pybytes())
+
+        self.snapshots = [db.snapshot() for db in self.application.shards]
+        if len(self.snapshots) > 1:
+            # Starting the read transactions of every shard before exporting the first one
+            await asyncio.gather(*[snapshot.fetchall("SELECT 1 FROM listings LIMIT 1") for snapshot in self.snapshots])
+        for snapshot in self.snapshots:
+            while True:
+                results = await snapshot.fetchall(
+                    SELECT_LISTINGS + " WHERE id>? ORDER BY id LIMIT ?", (after_id, EXPORT_CHUNK_SIZE)
+                )
+                if len(results) == 0:
+                    break
+                if export_format == "arrow":
+                    self.write(self._arrow_batch(results))
+                else:
+                    self.write(b"".join(json_dumps(dict(zip(LISTING_COLUMNS, row))) + b"\n" for row in results))
+                # Waiting for the chunk to be sent before reading the next one
+                await self.flush()
+                after_id = results[-1][0]
+                if len(results) < EXPORT_CHUNK_SIZE:
+                    break
+
+        if export_format == "arrow":
+            self.write(ARROW_END_OF_STREAM)
+
+    def _arrow_batch(self, rows):
+        # Record batch message of the rows, columns in LISTING_COLUMNS order
+        columns = [
+            pyarrow.array(values, type=field.type)
+            for values, field in zip(zip(*rows), ARROW_LISTINGS_SCHEMA)
+        ]
+        return pyarrow.record_batch(columns, schema=ARROW_LISTINGS_SCHEMA).serialize().to_pybytes()
+
+    def on_connection_close(self):
+        for snapshot in self.snapshots:
+            snapshot.close()
+        super().on_connection_close()
+
+    def on_finish(self):
+        for snapshot in self.snapshots:
+            snapshot.close()
+        super().on_finish()
+
+async def fetch_from_workers(ports, path):
+    """Returns the bodies of path fetched from the metrics port of every worker, leaving out workers that failed to respond."""
+    client = AsyncHTTPClient()
+    responses = await asyncio.gather(*[
+        client.fetch("http://127.0.0.1:{}{}".format(port, path)) for port in ports
+    ], return_exceptions=True)
+    bodies = []
+    for port, response in zip(ports, responses):
+        if isinstance(response, Exception):
+            logging.warning("Worker metrics port {} failed to respond: {}".format(port, response))
+            continue
+        bodies.append(response.body)
+    return bodies
+
+# /listings/traces
+class TracesHandler(BaseHandler):
+    async def get(self):
+        export_format = self.get_argument("format", "json")
+        if export_format not in {"json", "chrome"}:
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'json', 'chrome'"}, status_code=400)
+            return
+        tracer = self.application.tracer
+        trace_id = self.get_argument("trace_id", None)
+        worker_ports = self.settings.get("worker_ports")
+        if worker_ports is None:
+            spans = tracer.get_spans(trace_id)
+        else:
+            # Spans of every worker, from their metrics ports
+            path = url_concat("/listings/traces", {"trace_id": trace_id} if trace_id is not None else None)
+            spans = []
+            for body in await fetch_from_workers(worker_ports, path):
+                spans.extend(json.loads(body)["spans"])
+            spans.sort(key=lambda span: span["start"])
+        if export_format == "chrome":
+            self.write_json(tracer.to_chrome_trace(spans))
+        else:
+            self.write_json({"result": True, "spans": spans})
+
+# /metrics
+class MetricsHandler(BaseHandler):
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        worker_ports = self.settings.get("worker_ports")
+        if worker_ports is None:
+            self.write(self.application.metrics.render())
+            return
+        # Series of every worker, from their metrics ports
+        bodies = await fetch_from_workers(worker_ports, "/metrics")
+        self.write(merge_metrics([body.decode("utf-8") for body in bodies]))
+
+# /listings/stats
+class StatsHandler(BaseHandler):
+    async def get(self):
+        shard_stats = [db.get_stats() for db in self.application.shards]
+        # Totals of every shard, and the longest of their max wait times
+        stats = {"result": True, "db": {
+            name: (max if name.startswith("max_") else sum)(shard[name] for shard in shard_stats)
+            for name in shard_stats[0]
+        }}
+        if len(shard_stats) > 1:
+            stats["shards"] = shard_stats
+        self.write_json(stats)
+
 # /listings/ping
-class PingHandler(tornado.web.RequestHandler):
-    @tornado.gen.coroutine
-    def get(self):
+class PingHandler(BaseHandler):
+    async def get(self):
         self.write("pong!")
 
-def make_app(options):
+class WorkerApp(tornado.web.Application):
+    """Serves the metrics and spans recorded by app, those of this worker alone, on the metrics port of the worker."""
+
+    def __init__(self, app):
+        super().__init__([
+            (r"/listings/traces", TracesHandler),
+            (r"/metrics", MetricsHandler),
+        ], profile_dir=None)
+        self.metrics = app.metrics
+        self.tracer = app.tracer
+        self.profiling = False
+
+def make_app(options, db_initialized=False):
     return App([
         (r"/listings/ping", PingHandler),
+        (r"/listings/stats", StatsHandler),
+        (r"/listings/traces", TracesHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/listings/bulk", BulkListingsHandler),
+        (r"/listings/export", ExportListingsHandler),
         (r"/listings", ListingsHandler),
-    ], debug=options.debug)
+    ], options.db_path, options.shards, options.db_read_threads,
+        options.group_commit_window / 1000.0, options.trace_buffer_size, db_initialized,
+        debug=options.debug, profile_dir=options.profile_dir,
+        worker_ports=[options.metrics_port + worker for worker in range(options.workers or 1)] if options.metrics_port is not None else None,
+        transforms=[GZipContentEncoding] if options.compress_response else [])
 
-if __name__ == "__main__":
+def define_options(options):
     # Define settings/options for the web app
     # Specify the port number to start the web app on (default value is port 6000)
-    tornado.options.define("port", default=6000)
+    options.define("port", default=6000)
     # Specify whether the app should run in debug mode
-    # Debug mode restarts the app automatically on file changes
-    tornado.options.define("debug", default=True)
+    # Debug mode restarts the app automatically on file changes, it requires a single worker
+    # Defaults to on with a single worker, off otherwise
+    options.define("debug", default=None, type=bool)
+    # Number of worker processes sharing the port (0 starts one per CPU)
+    options.define("workers", default=0)
+    # Number of threads (each with its own db connection) running read queries, per shard
+    options.define("db_read_threads", default=4)
+    # Milliseconds the db writer waits for more writes to commit together in one transaction (0 disables it)
+    options.define("group_commit_window", default=0.0)
+    # Path of the SQLite db file
+    options.define("db_path", default="listings.db")
+    # Number of db files listings are sharded across by user_id, named after db_path (listings-0.db, ...)
+    # Changing it requires regenerating the dbs, e.g. with generate_data.py --shards
+    options.define("shards", default=1)
+    # Gzip responses for clients that accept it
+    options.define("compress_response", default=True)
+    # Number of recent spans kept for GET /listings/traces (0 disables tracing)
+    options.define("trace_buffer_size", default=10000)
+    # Base of the ports workers serve their own /metrics and /listings/traces on, worker i on metrics_port + i.
+    # /metrics and /listings/traces on port then merge those of every worker, unset they only cover the worker serving the request
+    options.define("metrics_port", default=None, type=int)
+    # Directory the profiles of requests made with __profile=1 are written to, profiling is disabled unless set
+    options.define("profile_dir", default=None, type=str)
+    # Run on uvloop instead of the default asyncio event loop, if installed
+    options.define("uvloop", default=False)
+
+async def serve(options, sockets, db_initialized=False):
+    """
+    Serves the app on sockets until cancelled, stopping the db threads once it stops.
+    The dbs are initialized first unless db_initialized.
+    """
+    app = make_app(options, db_initialized)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    # Serving the metrics and spans of this worker alone on its own port
+    worker_server = None
+    if options.metrics_port is not None:
+        worker_server = tornado.httpserver.HTTPServer(WorkerApp(app))
+        worker_server.listen(options.metrics_port + (tornado.process.task_id() or 0))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        if worker_server is not None:
+            worker_server.stop()
+        app.close()
+
+def run(options, sockets, db_initialized=False):
+    """Runs serve() on a new event loop, a uvloop one with the uvloop option."""
+    if options.uvloop:
+        if uvloop is None:
+            logging.warning("uvloop is not installed, running on the default asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(serve(options, sockets, db_initialized))
+
+if __name__ == "__main__":
+    define_options(tornado.options.options)
 
     # Read settings/options from command line
     tornado.options.parse_command_line()
 
     # Access the settings defined
     options = tornado.options.options
+    workers = options.workers or os.cpu_count() or 1
+    if not hasattr(os, "fork"):
+        workers = 1
+    if options.debug is None:
+        options.debug = workers == 1
+    elif options.debug and workers != 1:
+        logging.warning("Debug mode runs a single worker")
+        workers = 1
+    options.workers = workers
+    if workers != 1 and options.metrics_port is None:
+        logging.warning("/metrics and /listings/traces only cover the worker serving the request, set metrics_port to merge those of every worker")
 
-    # Create web app
-    app = make_app(options)
-    app.listen(options.port)
-    logging.info("Starting listing service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
+    # Migrating the dbs once, before workers start
+    init_shards(options.db_path, options.shards)
+
+    # Binding the port before forking, so workers accept connections on the same sockets
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if workers != 1:
+        logging.info("Starting {} listing service workers".format(workers))
+        tornado.process.fork_processes(workers)
 
-    # Start event loop
-    tornado.ioloop.IOLoop.instance().start()
+    # Serving the app, each worker opening its own db connections and threads
+    logging.info("Starting listing service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
+    run(options, sockets, db_initialized=True)
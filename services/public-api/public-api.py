@@ -1,86 +1,1450 @@
 import os
-import tornado.ioloop
+import asyncio
 import tornado.web
 import tornado.log
 import tornado.options
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httputil import url_concat
 import logging
 import json
 import urllib
+import collections
+import time
+import codecs
+import re
+import contextvars
+import cProfile
+import hashlib
+import gzip
+import threading
+import bisect
+import sqlite3
+import base64
+
+# orjson parses and serializes several times faster than the json module, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# uvloop is an optional, faster drop-in replacement for the asyncio event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+def json_dumps(obj):
+    """Returns obj serialized to JSON, as UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+    """Gzips responses at level 1, several times faster than tornado's default level 6 and nearly as small on JSON."""
+    GZIP_LEVEL = 1
+
+def json_loads(data):
+    """Parses JSON from UTF-8 bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 LISTINGS_URL = os.getenv('LISTINGS_URL', "http://localhost:6000/listings")
 USERS_URL = os.getenv('USERS_URL', "http://localhost:6001/users")
 
+# Number of listings checked and forwarded to the listing service at a time by bulk creates
+BULK_CHUNK_SIZE = 1000
+
+# Number of user ids looked up per GET /users?ids=... call, keeping its URL well under server limits
+# Larger pages are resolved with several concurrent calls
+MAX_IDS_PER_QUERY = 1000
+
+# Pages with more listings than this are fetched from the listing service and written this many
+# listings at a time, without being cached
+STREAM_CHUNK_SIZE = 1000
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """Latency histogram with counts per LATENCY_BUCKETS bucket, plus their sum and count."""
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self):
+        # The last bucket counts the values above every bound
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics(object):
+    """
+    Counters and latency histograms of this process, rendered in the Prometheus
+    text format by /metrics. Series are created on first use, one per tuple of
+    label values, so recording a value only updates a few numbers.
+    """
+
+    def __init__(self, worker=0):
+        # Worker process of the metrics, a worker label of every series
+        self.worker = worker
+        # Values are recorded from the event loop and from the db threads
+        self.lock = threading.Lock()
+        # name -> (type, help, label names)
+        self.definitions = collections.OrderedDict()
+        # name -> {label values: count or Histogram}
+        self.series = {}
+
+    def define(self, name, type, help, labels=()):
+        if name not in self.definitions:
+            self.definitions[name] = (type, help, labels)
+            self.series[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.series[name]
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (type, help, label_names) in self.definitions.items():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, type))
+                for labels, value in self.series[name].items():
+                    pairs = ['worker="{}"'.format(self.worker)] + ['{}="{}"'.format(label_name, escape_label_value(label))
+                        for label_name, label in zip(label_names, labels)]
+                    if type != "histogram":
+                        lines.append("{}{} {}".format(name, format_labels(pairs), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value.buckets):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(name, format_labels(pairs + ['le="{}"'.format(bound)]), cumulative))
+                    lines.append("{}_sum{} {}".format(name, format_labels(pairs), value.sum))
+                    lines.append("{}_count{} {}".format(name, format_labels(pairs), value.count))
+        return "\n".join(lines) + "\n"
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(pairs):
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def merge_metrics(texts):
+    """Returns the metrics rendered by several workers as a single text, with the series of every worker under each metric."""
+    # name -> (HELP and TYPE lines, series lines)
+    families = collections.OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = families.setdefault(line.split(" ")[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line != "":
+                family[1].append(line)
+    lines = []
+    for header, series in families.values():
+        lines.extend(header)
+        lines.extend(series)
+    return "\n".join(lines) + "\n"
+
+# Trace context of the request being handled: (trace id, id of the span new spans are children of)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# W3C trace context header: version-trace id-parent span id-flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+def parse_traceparent(value):
+    """Returns the (trace id, parent span id) of a traceparent header value, or None if it is missing or invalid."""
+    match = TRACEPARENT.match(value or "")
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+def format_traceparent(trace_id, span_id):
+    return "00-{}-{}-01".format(trace_id, span_id)
+
+class Tracer(object):
+    """
+    Keeps the last max_spans spans recorded by the service in a ring buffer,
+    to find out where the time of slow requests went. Spans are recorded from
+    the event loop and from other threads.
+    """
+
+    def __init__(self, service, max_spans, worker=0):
+        self.service = service
+        # Worker process recording the spans
+        self.worker = worker
+        self.enabled = max_spans > 0
+        # Appending to a bounded deque is thread-safe, and drops the oldest span once full
+        self.spans = collections.deque(maxlen=max_spans)
+
+    def record(self, trace, span_id, name, start, duration, **attributes):
+        """
+        Records a span of trace, a (trace id, parent span id) pair, started at start
+        (seconds since the epoch) and lasting duration seconds. Does nothing without a trace.
+        """
+        if not self.enabled or trace is None:
+            return
+        trace_id, parent_id = trace
+        self.spans.append({
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "service": self.service,
+            "worker": self.worker,
+            "name": name,
+            "start": int(start * 1e6),
+            "duration": int(duration * 1e6),
+            "attributes": attributes,
+        })
+
+    def get_spans(self, trace_id=None):
+        """Returns the recorded spans, oldest first, only those of trace_id if specified."""
+        spans = list(self.spans)
+        if trace_id is not None:
+            spans = [span for span in spans if span["trace_id"] == trace_id]
+        return spans
+
+    def to_chrome_trace(self, spans):
+        """
+        Returns spans in the Chrome trace event format, which chrome://tracing and Perfetto load.
+        The spans of each worker are shown as a process.
+        """
+        events = [
+            {"name": "process_name", "ph": "M", "pid": worker, "args": {"name": "{} worker {}".format(self.service, worker)}}
+            for worker in sorted({span["worker"] for span in spans})
+        ]
+        for span in spans:
+            events.append({
+                "name": span["name"],
+                "cat": span["service"],
+                "ph": "X",
+                "pid": span["worker"],
+                # One track per trace
+                "tid": int(span["trace_id"][:8], 16),
+                "ts": span["start"],
+                "dur": span["duration"],
+                "args": dict(span["attributes"], trace_id=span["trace_id"], span_id=span["span_id"], parent_id=span["parent_id"]),
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+class UpstreamError(Exception):
+    pass
+
+class UserNotFoundError(Exception):
+    pass
+
+class CircuitBreaker(object):
+    """
+    Fails calls to an upstream fast while it looks down. Opens after failure_threshold
+    consecutive failures, then lets a single trial call through every reset_timeout
+    seconds, closing again once one succeeds. A failure_threshold of 0 never opens.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        """Returns whether a call can go through now."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            # Calls made while the trial is in flight are still rejected
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.failure_threshold > 0 and self.failures >= self.failure_threshold):
+            if self.state != self.OPEN:
+                logging.warning("Circuit opened after {} consecutive failures".format(self.failures))
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+class UpstreamUnavailableError(UpstreamError):
+    pass
+
+# Latencies of recent successful calls kept per upstream, to estimate their 95th percentile
+HEDGE_SAMPLE_SIZE = 1000
+# Calls to an upstream are only hedged once this many latencies were recorded
+HEDGE_MIN_SAMPLES = 100
+
+class UpstreamClient(object):
+    """
+    Single HTTP client shared by every handler of the app, so connections to the
+    listing and user services are pooled instead of being set up on every call.
+    Uses the curl client (with keep-alive) when pycurl is installed.
+    Request durations and errors are recorded per upstream in metrics. Calls made
+    while handling a traced request are recorded as its spans in tracer, and pass
+    the trace on to the upstream in a traceparent header.
+
+    Each upstream has its own timeouts and circuit breaker. With hedge_requests,
+    fetches made with hedge=True (idempotent GETs) send a second request if the
+    first one is slower than the upstream's 95th percentile latency, and return
+    whichever response comes back first.
+    """
+
+    def __init__(self, max_clients, timeouts, metrics, failure_threshold=5, reset_timeout=5.0, hedge_requests=False,
+                 decompress_response=False, tracer=None):
+        # Timeouts are (connect_timeout, request_timeout) pairs keyed by upstream name
+        self.timeouts = timeouts
+        # Whether upstream responses are requested gzipped
+        self.decompress_response = decompress_response
+        self.breakers = {upstream: CircuitBreaker(failure_threshold, reset_timeout) for upstream in timeouts}
+        self.hedge_requests = hedge_requests
+        self.latencies = {upstream: collections.deque(maxlen=HEDGE_SAMPLE_SIZE) for upstream in timeouts}
+        # The same latencies kept sorted, so their 95th percentile is updated on every call
+        self.sorted_latencies = {upstream: [] for upstream in timeouts}
+        # upstream -> delay before hedging, None until enough latencies were recorded
+        self.hedge_delays = {upstream: None for upstream in timeouts}
+        try:
+            import pycurl
+            AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+            self.curl = True
+        except ImportError:
+            logging.warning("pycurl is not installed, upstream connections will not be kept alive")
+            self.curl = False
+        self.max_clients = max_clients
+        self.http_client = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        self.stats = {
+            upstream: {"requests": 0, "errors": 0, "in_flight": 0, "rejected": 0, "hedged": 0} for upstream in timeouts
+        }
+        self.metrics = metrics
+        self.tracer = tracer or Tracer("public-api", 0)
+        self.metrics.define("upstream_request_duration_seconds", "histogram",
+            "Time spent on requests to the listing and user services", ("upstream", "status"))
+        self.metrics.define("upstream_errors_total", "counter",
+            "Requests to the listing and user services that failed or got a 5xx response", ("upstream",))
+        self.metrics.define("upstream_rejected_total", "counter",
+            "Requests to the listing and user services failed fast by an open circuit breaker", ("upstream",))
+        self.metrics.define("upstream_hedged_total", "counter",
+            "Second requests sent to the listing and user services by hedged fetches", ("upstream",))
+
+    async def fetch(self, upstream, url, hedge=False, **kwargs):
+        """
+        Returns the response of the upstream, whatever its status code. Raises
+        UpstreamUnavailableError without calling it while its circuit is open.
+        """
+        breaker = self.breakers[upstream]
+        if not breaker.allow():
+            self.stats[upstream]["rejected"] += 1
+            self.metrics.inc("upstream_rejected_total", (upstream,))
+            raise UpstreamUnavailableError("{} service unavailable".format(upstream))
+
+        try:
+            hedge_delay = self.hedge_delays[upstream]
+            if hedge and self.hedge_requests and hedge_delay is not None:
+                response = await self._fetch_hedged(upstream, url, hedge_delay, **kwargs)
+            else:
+                response = await self._fetch(upstream, url, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+        if response.code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    async def _fetch_hedged(self, upstream, url, hedge_delay, **kwargs):
+        first = asyncio.ensure_future(self._fetch(upstream, url, **kwargs))
+        done, pending = await asyncio.wait([first], timeout=hedge_delay)
+        if first in done:
+            return first.result()
+
+        # The first request is slow, the first of the two to get a non 5xx response wins and the other one is cancelled
+        self.stats[upstream]["hedged"] += 1
+        self.metrics.inc("upstream_hedged_total", (upstream,))
+        second = asyncio.ensure_future(self._fetch(upstream, url, **kwargs))
+        pending = {first, second}
+        result = None
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        result = e
+                        continue
+                    if response.code < 500:
+                        return response
+                    result = response
+        finally:
+            for future in pending:
+                future.cancel()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def _fetch(self, upstream, url, **kwargs):
+        connect_timeout, request_timeout = self.timeouts[upstream]
+        kwargs.setdefault("connect_timeout", connect_timeout)
+        kwargs.setdefault("request_timeout", request_timeout)
+        kwargs.setdefault("decompress_response", self.decompress_response)
+
+        # Passing the trace on, this call's span being the parent of the upstream's spans
+        trace = current_trace.get()
+        span_id = new_span_id()
+        if trace is not None and self.tracer.enabled:
+            headers = dict(kwargs.get("headers") or {})
+            headers["traceparent"] = format_traceparent(trace[0], span_id)
+            kwargs["headers"] = headers
+
+        stats = self.stats[upstream]
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        start = time.perf_counter()
+        # Requests that did not get a response (timeouts, connection errors) are labelled "error"
+        status = "error"
+        try:
+            response = await self.http_client.fetch(url, raise_error=False, **kwargs)
+            status = response.code
+        except asyncio.CancelledError:
+            # The slower of hedged requests, not an error of the upstream
+            status = "cancelled"
+            raise
+        except Exception:
+            stats["errors"] += 1
+            self.metrics.inc("upstream_errors_total", (upstream,))
+            raise
+        finally:
+            stats["in_flight"] -= 1
+            duration = time.perf_counter() - start
+            self.metrics.observe("upstream_request_duration_seconds", (upstream, status), duration)
+            self.tracer.record(
+                trace, span_id, "upstream", time.time() - duration, duration,
+                upstream=upstream, method=kwargs.get("method", "GET"), url=url, status=status
+            )
+        if response.code >= 500:
+            stats["errors"] += 1
+            self.metrics.inc("upstream_errors_total", (upstream,))
+        else:
+            self._record_latency(upstream, time.perf_counter() - start)
+        return response
+
+    def _record_latency(self, upstream, latency):
+        latencies = self.latencies[upstream]
+        sorted_latencies = self.sorted_latencies[upstream]
+        if len(latencies) == latencies.maxlen:
+            # The oldest latency is dropped from both
+            del sorted_latencies[bisect.bisect_left(sorted_latencies, latencies[0])]
+        latencies.append(latency)
+        bisect.insort(sorted_latencies, latency)
+        if len(sorted_latencies) >= HEDGE_MIN_SAMPLES:
+            self.hedge_delays[upstream] = sorted_latencies[int(len(sorted_latencies) * 0.95)]
+
+    def get_stats(self):
+        return {
+            upstream: dict(
+                stats,
+                circuit=self.breakers[upstream].state,
+                hedge_delay=self.hedge_delays[upstream],
+            )
+            for upstream, stats in self.stats.items()
+        }
+
+    def pool_stats(self):
+        # Requests past max_clients wait in the client's queue for a connection
+        in_flight = sum(stats["in_flight"] for stats in self.stats.values())
+        return {
+            "keep_alive": self.curl,
+            "max_clients": self.max_clients,
+            "active": min(in_flight, self.max_clients),
+            "queued": max(in_flight - self.max_clients, 0),
+        }
+
+    def close(self):
+        self.http_client.close()
+
+class UserCache(object):
+    """
+    Bounded LRU cache of user records, expiring entries after ttl seconds.
+    Ids with no user are cached as None for negative_ttl seconds, and
+    concurrent misses for the same id share a single upstream lookup.
+    """
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # user id -> (expires_at, user or None), least recently used first
+        self.entries = collections.OrderedDict()
+        # user id -> future of the lookup in flight for that id
+        self.pending = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, user_id):
+        """Returns a (found, user) pair, user being None for ids cached as missing."""
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return False, None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self.entries[user_id]
+            self.stats["expirations"] += 1
+            return False, None
+        self.entries.move_to_end(user_id)
+        return True, user
+
+    def set(self, user_id, user):
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if user is not None else self.negative_ttl
+        self.entries[user_id] = (time.monotonic() + ttl, user)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, user_id):
+        """Drops the cached user of user_id, so it is looked up again."""
+        self.entries.pop(user_id, None)
+
+    async def resolve(self, user_ids, fetch_users):
+        """
+        Returns a dict of user id -> user (or None) for user_ids. Ids that are
+        neither cached nor being looked up are passed to the fetch_users
+        coroutine, which must return the same kind of dict.
+        """
+        users = {}
+        waiting = {}
+        misses = []
+        for user_id in user_ids:
+            found, user = self.get(user_id)
+            if found:
+                self.stats["hits"] += 1
+                users[user_id] = user
+            elif user_id in self.pending:
+                self.stats["coalesced"] += 1
+                waiting[user_id] = self.pending[user_id]
+            else:
+                self.stats["misses"] += 1
+                misses.append(user_id)
+
+        if len(misses) > 0:
+            # Pending futures resolve to the user, or to the exception the lookup failed with
+            for user_id in misses:
+                self.pending[user_id] = asyncio.Future()
+            try:
+                fetched = await fetch_users(misses)
+            except BaseException as e:
+                # Cancellation included, so no lookup is left pending for later misses to wait on forever
+                for user_id in misses:
+                    self.pending.pop(user_id).set_result(e)
+                raise
+            for user_id in misses:
+                user = fetched.get(user_id)
+                self.set(user_id, user)
+                self.pending.pop(user_id).set_result(user)
+                users[user_id] = user
+
+        for user_id, future in waiting.items():
+            user = await future
+            if isinstance(user, BaseException):
+                raise user
+            users[user_id] = user
+
+        # Keeping the order of user_ids
+        return {user_id: users[user_id] for user_id in user_ids}
+
+# Highest user id KnownUsers keeps a bit for, bounding its bitmap to 16MB
+KNOWN_USERS_MAX_ID = 2 ** 27
+# Request timeout in seconds of the user id dump KnownUsers is warmed with
+KNOWN_USERS_WARMUP_TIMEOUT = 300.0
+# Seconds before a failed warmup is tried again, e.g. when the user service is not up yet
+KNOWN_USERS_WARMUP_RETRY_DELAY = 5.0
+
+class KnownUsers(object):
+    """
+    Ids of the users known to exist, as a bitmap indexed by user id. Users are
+    never deleted and their ids are dense autoincrement integers, so a bit per
+    id is enough, and unlike a Bloom filter an id is never mistaken for an
+    existing user. Warmed with the ids streamed by GET /users/ids, then kept up
+    to date with the users created or confirmed to exist.
+    """
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.size = 0
+        self.warmup = None
+        self.stats = {"hits": 0, "misses": 0, "warmup_duration": None, "warmup_errors": 0}
+
+    def add(self, user_id):
+        if user_id < 0 or user_id > KNOWN_USERS_MAX_ID:
+            return
+        index = user_id >> 3
+        if index >= len(self.bits):
+            # Growing by half at least, so adding increasing ids doesn't copy the bitmap every time,
+            # but never past the byte of KNOWN_USERS_MAX_ID
+            size = min(max(index + 1, len(self.bits) * 3 // 2), (KNOWN_USERS_MAX_ID >> 3) + 1)
+            self.bits.extend(bytes(size - len(self.bits)))
+        mask = 1 << (user_id & 7)
+        if not self.bits[index] & mask:
+            self.bits[index] |= mask
+            self.size += 1
+
+    def __contains__(self, user_id):
+        index = user_id >> 3
+        return 0 <= index < len(self.bits) and bool(self.bits[index] & (1 << (user_id & 7)))
+
+    def start(self, upstream):
+        """Warms the known users in the background."""
+        self.warmup = asyncio.ensure_future(self.warm(upstream))
+
+    def stop(self):
+        if self.warmup is not None:
+            self.warmup.cancel()
+
+    async def warm(self, upstream):
+        """Adds the ids of every user, streamed by the user service, trying again until it succeeds."""
+        start = time.monotonic()
+        # Partial line at the end of the last chunk received
+        remainder = [b""]
+
+        def add_ids(chunk):
+            lines = (remainder[0] + chunk).split(b"\n")
+            remainder[0] = lines.pop()
+            for line in lines:
+                self.add(int(line))
+
+        while True:
+            try:
+                response = await upstream.fetch(
+                    "users", USERS_URL + "/ids", streaming_callback=add_ids, request_timeout=KNOWN_USERS_WARMUP_TIMEOUT
+                )
+                if response.code != 200:
+                    raise UpstreamError("user service responded with {}".format(response.code))
+                break
+            except Exception as e:
+                # Unknown users are looked up on the user service meanwhile, the warmup only saves those lookups
+                logging.error("Known users warmup failed, retrying in {}s: {}".format(KNOWN_USERS_WARMUP_RETRY_DELAY, e))
+                self.stats["warmup_errors"] += 1
+                remainder[0] = b""
+                await asyncio.sleep(KNOWN_USERS_WARMUP_RETRY_DELAY)
+        self.stats["warmup_duration"] = time.monotonic() - start
+        logging.info("Loaded {} known users in {:.2f}s".format(self.size, self.stats["warmup_duration"]))
+
+    def get_stats(self):
+        return dict(self.stats, size=self.size, bytes=len(self.bits))
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of serialized responses, their ETags and gzipped bodies,
+    expiring entries after ttl seconds. invalidate() drops every entry when the data they were
+    built from changes, and bumps generation so responses built from data read
+    before the change are not stored.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (stored_at, body, etag, gzipped), least recently used first
+        self.entries = collections.OrderedDict()
+        self.generation = 0
+        self.stats = {
+            "hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0,
+            "evictions": 0, "expirations": 0, "hit_age_total": 0.0, "max_hit_age": 0.0,
+        }
+
+    def get(self, key):
+        """Returns a (body, etag, gzipped body or None, age in seconds) tuple, or None if key has no fresh entry."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        stored_at, body, etag, gzipped = entry
+        age = time.monotonic() - stored_at
+        if age > self.ttl:
+            del self.entries[key]
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        self.stats["hit_age_total"] += age
+        self.stats["max_hit_age"] = max(self.stats["max_hit_age"], age)
+        return body, etag, gzipped, age
+
+    def accepts(self, generation):
+        """Returns whether a response built from data read at generation would be stored."""
+        # Responses read before the last invalidation may already be stale
+        return self.max_size > 0 and generation == self.generation
+
+    def set(self, key, body, etag, gzipped, generation):
+        if not self.accepts(generation):
+            return
+        self.entries[key] = (time.monotonic(), body, etag, gzipped)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self):
+        self.generation += 1
+        self.stats["invalidations"] += 1
+        self.entries.clear()
+
+    def get_stats(self):
+        stats = dict(self.stats, size=len(self.entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups > 0 else None
+        stats["mean_hit_age"] = stats["hit_age_total"] / stats["hits"] if stats["hits"] > 0 else None
+        return stats
+
+class JSONItemsParser(object):
+    """
+    Incrementally parses a request body that is either a JSON array of objects
+    or newline-delimited JSON objects, returning items as soon as they are complete.
+    An invalid line of newline-delimited JSON is returned as a ValueError in place
+    of its items, and parsing resumes at the next line.
+    """
+    # Whitespace, array brackets and separators skipped between items
+    SEPARATORS = " \t\r\n,[]"
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        # Whether the body is newline-delimited JSON rather than an array, known from its first character
+        self.ndjson = None
+
+    def feed(self, chunk):
+        """Returns the items completed by chunk."""
+        self.buffer += self.text_decoder.decode(chunk)
+        return self._parse(final=False)
+
+    def close(self):
+        """Returns the items left at the end of the body, with a ValueError if it ended in the middle of an item."""
+        self.buffer += self.text_decoder.decode(b"", final=True)
+        return self._parse(final=True)
+
+    def _parse(self, final):
+        if self.ndjson is None:
+            start = self.buffer.lstrip(" \t\r\n")
+            if start == "":
+                return []
+            self.ndjson = not start.startswith("[")
+
+        if not self.ndjson:
+            items, pos = self._decode(self.buffer)
+            self.buffer = self.buffer[pos:]
+            if final and self.buffer.strip(self.SEPARATORS) != "":
+                items.append(ValueError("invalid JSON: {}".format(self.buffer[:100])))
+            return items
+
+        # Lines are parsed once complete, the last one when the body ends
+        lines = self.buffer.split("\n")
+        self.buffer = "" if final else lines.pop()
+        items = []
+        for line in lines:
+            line_items, pos = self._decode(line)
+            items.extend(line_items)
+            if line[pos:].strip(self.SEPARATORS) != "":
+                items.append(ValueError("invalid JSON: {}".format(line[pos:pos + 100])))
+        return items
+
+    def _decode(self, text):
+        """Returns the items at the start of text, and the position of the first one that can't be decoded (yet)."""
+        items = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos] in self.SEPARATORS:
+                pos += 1
+            if pos == len(text):
+                break
+            try:
+                item, pos = self.decoder.raw_decode(text, pos)
+            except ValueError:
+                # Incomplete or invalid item
+                break
+            items.append(item)
+        return items, pos
+
+def encode_cursor(created_at, id):
+    # Same opaque keyset cursors as the listing service, so pages from either source chain together
+    return base64.urlsafe_b64encode("{}:{}".format(created_at, id).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor):
+    created_at, id = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split(":")
+    return int(created_at), int(id)
+
+# Columns of the listing and user records, in the order the listing and user services return them
+LISTING_COLUMNS = ("id", "user_id", "listing_type", "price", "created_at", "updated_at")
+USER_COLUMNS = ("id", "name", "created_at", "updated_at")
+
+# Params filtering listings pages, passed through to the listing service
+LISTING_FILTERS = ("listing_type", "min_price", "max_price")
+
+def parse_listing_filters(filters):
+    """Returns filters with prices as ints. Raises ValueError for filters the listing service would reject."""
+    parsed = {}
+    for name, value in filters.items():
+        if name == "listing_type":
+            if value not in ("rent", "sale"):
+                raise ValueError("invalid listing_type")
+            parsed[name] = value
+        else:
+            parsed[name] = int(value)
+    return parsed
+
+# Seconds of updates read again on every sync. Rows are synced in (updated_at, id) order, and a row
+# committed after rows with a later updated_at (e.g. by another worker) would otherwise be skipped
+READ_MODEL_SYNC_OVERLAP = 5
+
+class ReadModel(object):
+    """
+    In-memory SQLite copy of the listings and users, so listings pages are served
+    with a single indexed query instead of calls to the listing and user services.
+    Every sync_interval seconds, rows updated since the last sync are fetched from
+    the services (which stay the source of truth) and upserted.
+    """
+
+    SCHEMA = [
+        "CREATE TABLE listings (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, listing_type TEXT NOT NULL,"
+        + " price INTEGER NOT NULL, created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL)",
+        "CREATE INDEX idx_listings_created_at_price ON listings (created_at, id, price)",
+        "CREATE INDEX idx_listings_user_id_created_at ON listings (user_id, created_at, id)",
+        "CREATE INDEX idx_listings_listing_type_created_at_price ON listings (listing_type, created_at, id, price)",
+        "CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT NOT NULL,"
+        + " created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL)",
+    ]
+
+    # Rows only replace older versions of themselves, so overlapping syncs don't count as changes
+    UPSERTS = {
+        "listings": "INSERT INTO listings ({0}) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+            + "user_id=excluded.user_id, listing_type=excluded.listing_type, price=excluded.price, "
+            + "created_at=excluded.created_at, updated_at=excluded.updated_at "
+            + "WHERE excluded.updated_at > listings.updated_at",
+        "users": "INSERT INTO users ({0}) VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+            + "name=excluded.name, created_at=excluded.created_at, updated_at=excluded.updated_at "
+            + "WHERE excluded.updated_at > users.updated_at",
+    }
+    COLUMNS = {"listings": LISTING_COLUMNS, "users": USER_COLUMNS}
+
+    def __init__(self, upstream, sync_interval, sync_batch_size=5000):
+        self.upstream = upstream
+        self.sync_interval = sync_interval
+        self.sync_batch_size = sync_batch_size
+        # Only used from the event loop, queries on an in-memory db take well under a millisecond
+        self.db = sqlite3.connect(":memory:")
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        # table -> (updated_at, id) of the last row synced
+        self.synced = {"users": (0, 0), "listings": (0, 0)}
+        # Pages are served from upstream until the first full sync completes
+        self.ready = False
+        self.syncing = False
+        self.last_sync_at = None
+        self.periodic_sync = None
+        self.on_user_change = None
+        self.stats = {"syncs": 0, "sync_errors": 0, "rows_changed": 0, "last_sync_duration": None}
+
+    def start(self, on_change, on_user_change=None):
+        """
+        Syncs now and every sync_interval seconds, calling on_change after syncs that changed rows,
+        and on_user_change with the id of every user created or updated since the previous sync.
+        """
+        self.on_user_change = on_user_change
+
+        async def sync_periodically():
+            while True:
+                changes = await self.sync()
+                if changes > 0:
+                    on_change()
+                await asyncio.sleep(self.sync_interval)
+
+        self.periodic_sync = asyncio.ensure_future(sync_periodically())
+
+    def stop(self):
+        if self.periodic_sync is not None:
+            self.periodic_sync.cancel()
+
+    async def sync(self):
+        """Fetches the users, then the listings, updated since the last sync. Returns the number of rows changed."""
+        if self.syncing:
+            return 0
+        self.syncing = True
+        start = time.monotonic()
+        changes = 0
+        try:
+            # Users first, so the users of new listings are there when the listings show up
+            for table, url in [("users", USERS_URL), ("listings", LISTINGS_URL)]:
+                changes += await self.sync_table(table, url)
+            self.ready = True
+            self.last_sync_at = time.monotonic()
+            self.stats["syncs"] += 1
+        except Exception as e:
+            logging.error("Read model sync failed: {}".format(e))
+            self.stats["sync_errors"] += 1
+        finally:
+            self.syncing = False
+            self.stats["last_sync_duration"] = time.monotonic() - start
+        self.stats["rows_changed"] += changes
+        return changes
+
+    async def sync_table(self, table, url):
+        previous = self.synced[table]
+        since = (max(0, previous[0] - READ_MODEL_SYNC_OVERLAP * 1000000), 0)
+        changes = 0
+        while True:
+            response = await self.upstream.fetch(table, url_concat(url, {
+                "updated_since": since[0], "updated_since_id": since[1], "page_size": self.sync_batch_size,
+            }))
+            body = json_loads(response.body)
+            if not body["result"]:
+                raise UpstreamError(body["errors"])
+            rows = body[table]
+            changes += self.apply(table, rows)
+            if table == "users" and self.on_user_change is not None:
+                # Rows the overlap fetched again were reported by the previous sync
+                for row in rows:
+                    if (row["updated_at"], row["id"]) > previous:
+                        self.on_user_change(row["id"])
+            if len(rows) > 0:
+                since = (rows[-1]["updated_at"], rows[-1]["id"])
+                self.synced[table] = max(self.synced[table], since)
+            if len(rows) < self.sync_batch_size:
+                return changes
+
+    def apply(self, table, rows):
+        """Upserts rows (records as returned by the services) into table, returns the number of rows changed."""
+        if len(rows) == 0:
+            return 0
+        columns = self.COLUMNS[table]
+        before = self.db.total_changes
+        self.db.executemany(
+            self.UPSERTS[table].format(", ".join(columns)),
+            [tuple(row[column] for column in columns) for row in rows]
+        )
+        self.db.commit()
+        return self.db.total_changes - before
+
+    def get_listings(self, user_id, page_num, page_size, cursor, filters):
+        """
+        Returns a (listings with their user, next cursor) page, like the listing service
+        would for these params. Returns None when the page can't be served from the read
+        model: before the first sync, for invalid params and when a user is not synced yet.
+        """
+        if not self.ready:
+            return None
+        try:
+            user_id = int(user_id) if user_id is not None else None
+            page_cursor = decode_cursor(cursor) if cursor is not None else None
+            filters = parse_listing_filters(filters)
+        except:
+            return None
+        if user_id is not None and self.db.execute("SELECT 1 FROM users WHERE id=?", (user_id,)).fetchone() is None:
+            return None
+
+        # Selecting the page of listings first, so rows skipped by the offset are not joined
+        page_stmt = "SELECT * FROM listings"
+        conditions = []
+        args = []
+        if user_id is not None:
+            conditions.append("user_id=?")
+            args.append(user_id)
+        if "listing_type" in filters:
+            conditions.append("listing_type=?")
+            args.append(filters["listing_type"])
+        if "min_price" in filters:
+            conditions.append("price>=?")
+            args.append(filters["min_price"])
+        if "max_price" in filters:
+            conditions.append("price<=?")
+            args.append(filters["max_price"])
+        if page_cursor is not None:
+            conditions.append("(created_at, id) < (?, ?)")
+            args.extend(page_cursor)
+        if len(conditions) > 0:
+            page_stmt += " WHERE " + " AND ".join(conditions)
+        page_stmt += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        args.append(page_size)
+        if page_cursor is None:
+            page_stmt += " OFFSET ?"
+            args.append((page_num - 1) * page_size)
+        select_stmt = (
+            "SELECT " + ", ".join("l." + column for column in LISTING_COLUMNS) + ", "
+            + ", ".join("u." + column for column in USER_COLUMNS)
+            + " FROM (" + page_stmt + ") l LEFT JOIN users u ON u.id = l.user_id"
+            + " ORDER BY l.created_at DESC, l.id DESC"
+        )
+
+        listings = []
+        user_column_count = len(LISTING_COLUMNS)
+        for row in self.db.execute(select_stmt, args):
+            if row[user_column_count] is None:
+                return None
+            listing = dict(zip(LISTING_COLUMNS, row))
+            listing["user"] = dict(zip(USER_COLUMNS, row[user_column_count:]))
+            listings.append(listing)
+
+        next_cursor = None
+        if len(listings) == page_size and page_size > 0:
+            next_cursor = encode_cursor(listings[-1]["created_at"], listings[-1]["id"])
+        return listings, next_cursor
+
+    def get_stats(self):
+        return dict(
+            self.stats,
+            ready=self.ready,
+            listings=self.db.execute("SELECT COUNT(*) FROM listings").fetchone()[0],
+            users=self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            seconds_since_sync=time.monotonic() - self.last_sync_at if self.last_sync_at is not None else None,
+        )
+
+class App(tornado.web.Application):
+
+    def __init__(self, handlers, metrics, tracer, upstream, user_cache, response_cache, read_model, known_users,
+                 **kwargs):
+        super().__init__(handlers, **kwargs)
+        self.metrics = metrics
+        self.metrics.define("http_request_duration_seconds", "histogram",
+            "Time spent serving requests", ("handler", "method", "status"))
+        self.tracer = tracer
+        # Whether a request is being profiled, a single one can be at a time
+        self.profiling = False
+        self.upstream = upstream
+        self.user_cache = user_cache
+        self.response_cache = response_cache
+        self.read_model = read_model
+        if read_model is not None:
+            # Cached pages may be missing the rows the read model just got, and cached users may be
+            # outdated or cached as missing
+            read_model.start(on_change=response_cache.invalidate, on_user_change=user_cache.invalidate)
+        self.known_users = known_users
+        if known_users is not None:
+            known_users.start(upstream)
+
+    def close(self):
+        if self.read_model is not None:
+            self.read_model.stop()
+        if self.known_users is not None:
+            self.known_users.stop()
+        self.upstream.close()
+
 class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self):
+        # Continuing the trace of the caller's traceparent header, or starting a new one
+        trace = parse_traceparent(self.request.headers.get("traceparent"))
+        if trace is not None:
+            self.trace_id, self.parent_span_id = trace
+        else:
+            self.trace_id, self.parent_span_id = new_trace_id(), None
+        self.span_id = new_span_id()
+        self.profile = None
+
+    def prepare(self):
+        # Spans recorded while handling the request, on the event loop and in other threads, are children of its span
+        current_trace.set((self.trace_id, self.span_id))
+        self.set_header("X-Trace-Id", self.trace_id)
+
+        # Profiling the request when asked to with __profile=1, if profiling is enabled.
+        # The profiler sees everything the event loop runs meanwhile, including other requests
+        if self.settings["profile_dir"] is not None and self.get_query_argument("__profile", None) == "1":
+            if self.application.profiling:
+                logging.warning("Not profiling {}, another request is being profiled".format(self.request.uri))
+            else:
+                self.application.profiling = True
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+
+    def on_finish(self):
+        request_time = self.request.request_time()
+        self.application.metrics.observe(
+            "http_request_duration_seconds",
+            (type(self).__name__, self.request.method, self.get_status()),
+            request_time
+        )
+        self.application.tracer.record(
+            (self.trace_id, self.parent_span_id), self.span_id, type(self).__name__,
+            time.time() - request_time, request_time,
+            method=self.request.method, path=self.request.path, status=self.get_status()
+        )
+        self.stop_profile()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self.stop_profile()
+
+    def stop_profile(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.application.profiling = False
+        path = os.path.join(self.settings["profile_dir"], "{}-{}.prof".format(type(self).__name__, self.trace_id))
+        self.profile.dump_stats(path)
+        self.profile = None
+        logging.info("Profile of {} written to {}".format(self.request.uri, path))
+
+    def record_span(self, name, start, **attributes):
+        # Records a span of the request, from start (a time.perf_counter() value) to now
+        duration = time.perf_counter() - start
+        self.application.tracer.record(
+            (self.trace_id, self.span_id), new_span_id(), name, time.time() - duration, duration, **attributes
+        )
+
     def write_json(self, obj, status_code=200):
         self.set_header("Content-Type", "application/json")
         self.set_status(status_code)
-        self.write(json.dumps(obj))
+        start = time.perf_counter()
+        body = json_dumps(obj)
+        self.record_span("serialize", start, bytes=len(body))
+        self.write(body)
+
+    def write_json_with_etag(self, body, etag, gzipped=None):
+        # Answering conditional requests for the same version of the response with a bodyless 304
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.application.response_cache.stats["not_modified"] += 1
+            self.set_status(304)
+            return
+        # Sending the body gzipped along with the cached page as is, rather than compressing it on every write
+        if gzipped is not None and "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            body = gzipped
+        self.write(body)
 
 class ListingsHandler(BaseHandler):
-    @tornado.gen.coroutine
-    def get_user(self, user_id, http_client):
-        logging.info(user_id)
+    async def get_user(self, user_id):
         userURL = USERS_URL + "/" + str(user_id)
-        logging.info(userURL)
-        usersResp = yield http_client.fetch(userURL, raise_error=False)
-        userJSON = json.loads(usersResp.body.decode('utf-8'))
-        if not userJSON['result']:
-            http_client.close()
-            self.write_json(userJSON, status_code=400)
+        userResp = await self.application.upstream.fetch("users", userURL, hedge=True)
+        if userResp.code == 404:
             return None
+        userJSON = json_loads(userResp.body)
+        if not userJSON['result']:
+            raise UpstreamError(userJSON['errors'])
         return userJSON['user']
-    
-    @tornado.gen.coroutine
-    def get_listings(self, user_id, page_num, page_size, http_client):
+
+    async def get_users(self, user_ids):
+        """
+        Resolves the distinct users among user_ids, through the app's user cache.
+        Returns a dict of user id -> user, with None for ids that have no user.
+        """
+        # Deduplicating ids so each user is looked up once per page
+        unique_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        if len(unique_ids) == 0:
+            return {}
+
+        if self.settings["user_batch_lookup"]:
+            fetch_users = self.get_users_in_batch
+        else:
+            fetch_users = self.get_users_concurrently
+        users = await self.application.user_cache.resolve(unique_ids, fetch_users)
+        if self.application.known_users is not None:
+            for user_id, user in users.items():
+                if user is not None:
+                    self.application.known_users.add(user_id)
+        return users
+
+    async def user_exists(self, user_id):
+        """Returns whether there is a user under user_id, without calling the user service for known users."""
+        known_users = self.application.known_users
+        if known_users is not None:
+            if user_id in known_users:
+                known_users.stats["hits"] += 1
+                return True
+            known_users.stats["misses"] += 1
+
+        userResp = await self.application.upstream.fetch("users", USERS_URL + "/" + str(user_id), method="HEAD", hedge=True)
+        if userResp.code == 404:
+            return False
+        if userResp.code != 200:
+            raise UpstreamError("user service responded with {}".format(userResp.code))
+        if known_users is not None:
+            known_users.add(user_id)
+        return True
+
+    async def get_users_in_batch(self, user_ids):
+        # Resolving users in batch lookups of up to MAX_IDS_PER_QUERY ids, made concurrently
+        results = await asyncio.gather(*[
+            self.get_users_chunk(user_ids[i:i + MAX_IDS_PER_QUERY]) for i in range(0, len(user_ids), MAX_IDS_PER_QUERY)
+        ])
+        users = {}
+        for chunk_users in results:
+            users.update(chunk_users)
+        return users
+
+    async def get_users_chunk(self, user_ids):
+        usersURL = url_concat(USERS_URL, {"ids": ",".join(str(user_id) for user_id in user_ids)})
+        usersResp = await self.application.upstream.fetch("users", usersURL, hedge=True)
+        start = time.perf_counter()
+        usersJSON = json_loads(usersResp.body)
+        self.record_span("parse", start, bytes=len(usersResp.body))
+        if not usersJSON['result']:
+            raise UpstreamError(usersJSON['errors'])
+
+        users = {user['id']: user for user in usersJSON['users']}
+        return {user_id: users.get(user_id) for user_id in user_ids}
+
+    async def get_users_concurrently(self, user_ids):
+        # Fetching users one by one, with at most user_fetch_concurrency requests in flight
+        semaphore = asyncio.Semaphore(self.settings["user_fetch_concurrency"])
+
+        async def fetch_user(user_id):
+            async with semaphore:
+                try:
+                    user = await self.get_user(user_id)
+                except Exception as e:
+                    return e
+            return user
+
+        results = await asyncio.gather(*[fetch_user(user_id) for user_id in user_ids])
+
+        # Raising the failure of the first id in page order, whichever request failed first
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return dict(zip(user_ids, results))
+
+    async def get_listings(self, user_id, page_num, page_size, cursor, filters, include_total=False):
+        # Returns the page of the listing service, or None after writing its errors
+        listingsJSON = await self.fetch_listings(user_id, page_num, page_size, cursor, filters, include_total)
+        if not listingsJSON['result']:
+            self.write_json(listingsJSON, status_code=400)
+            return None
+        return listingsJSON
+
+    async def fetch_listings(self, user_id, page_num, page_size, cursor, filters, include_total=False):
         listingParams = {"page_num": page_num, "page_size": page_size}
+        listingParams.update(filters)
         if user_id is not None:
             listingParams["user_id"] = user_id
+        if cursor is not None:
+            listingParams["cursor"] = cursor
+        if include_total:
+            listingParams["include_total"] = "true"
         listingsURL = url_concat(LISTINGS_URL, listingParams)
-        listingsResp = yield http_client.fetch(listingsURL, raise_error=False)
-        listingsJSON = json.loads(listingsResp.body.decode('utf-8'))
-        if not listingsJSON['result']:
-            http_client.close()
-            self.write_json(listingsJSON, status_code=400)
-            return None
-        return listingsJSON['listings']
+        listingsResp = await self.application.upstream.fetch("listings", listingsURL, hedge=True)
+        start = time.perf_counter()
+        listingsJSON = json_loads(listingsResp.body)
+        self.record_span("parse", start, bytes=len(listingsResp.body))
+        return listingsJSON
 
-    @tornado.gen.coroutine
-    def get(self):
+    async def add_users(self, listings, user_id):
+        """
+        Adds their user to listings, also resolving the user_id filter so unknown ids still error out.
+        Raises UserNotFoundError if a user doesn't exist. Returns False if the listings are served
+        without their users instead, because users couldn't be resolved and degrade_on_user_errors is on.
+        """
+        user_ids = [listing['user_id'] for listing in listings]
+        if user_id is not None:
+            user_ids.append(user_id)
+        try:
+            users = await self.get_users(user_ids)
+        except Exception as e:
+            if not self.settings["degrade_on_user_errors"]:
+                raise
+            # Serving the listings without their users rather than failing the page
+            logging.warning("Serving listings without users: {}".format(e))
+            return False
+        if None in users.values():
+            raise UserNotFoundError("no user found under the id")
+        for listing in listings:
+            listing['user'] = users[listing['user_id']]
+        return True
+
+    async def get(self):
         # Parsing pagination params
         page_num = int(self.get_argument("page_num", 1))
         page_size = int(self.get_argument("page_size", 10))
         user_id = self.get_argument("user_id", None)
+        cursor = self.get_argument("cursor", None)
+        filters = {}
+        for name in LISTING_FILTERS:
+            value = self.get_argument(name, None)
+            if value is not None:
+                filters[name] = value
+        include_total = self.get_argument("include_total", "false").lower() in {"1", "true"}
 
-        http_client = AsyncHTTPClient()
-        try:
-            listings = yield self.get_listings(user_id, page_num, page_size, http_client)
-            if listings is None:
+        # Large pages are written as they are fetched, without going through the caches
+        if page_size > STREAM_CHUNK_SIZE or page_size < 0:
+            await self.stream_listings(user_id, page_num, page_size, cursor, filters, include_total)
+            return
+
+        # Serving the page from the response cache while a fresh copy is there
+        response_cache = self.application.response_cache
+        cache_key = self.get_cache_key(user_id, page_num, page_size, cursor, filters, include_total)
+        if cache_key is not None:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                body, etag, gzipped, age = cached
+                self.set_header("X-Cache", "HIT")
+                self.set_header("Age", int(age))
+                self.write_json_with_etag(body, etag, gzipped)
                 return
-            
-            if user_id is not None:
-                user = yield self.get_user(user_id, http_client)
-                if user is None:
+        generation = response_cache.generation
+
+        # Serving the page from the read model in a single query when it can, from the listing and user services otherwise
+        # The read model has no counts, pages with their total come from the listing service
+        page = None
+        page_meta = {}
+        if self.application.read_model is not None and not include_total:
+            start = time.perf_counter()
+            page = self.application.read_model.get_listings(user_id, page_num, page_size, cursor, filters)
+            self.record_span("read_model", start, hit=page is not None)
+        degraded = False
+        if page is not None:
+            listings, next_cursor = page
+        else:
+            try:
+                listingsJSON = await self.get_listings(user_id, page_num, page_size, cursor, filters, include_total)
+                if listingsJSON is None:
                     return
-            else:
-                for listing in listings:
-                    user = yield self.get_user(listing['user_id'], http_client)
-                    if user is None:
+                listings = listingsJSON['listings']
+                next_cursor = listingsJSON.get('next_cursor')
+                if include_total:
+                    page_meta = {"total": listingsJSON.get('total'), "has_more": listingsJSON.get('has_more')}
+                degraded = not await self.add_users(listings, user_id)
+            except UserNotFoundError as e:
+                self.write_json({"result": False, "errors": str(e)}, status_code=400)
+                return
+            except Exception as e:
+                logging.error(e)
+                self.write_json({"result": False, "errors": str(e)}, status_code=400)
+                return
+
+        start = time.perf_counter()
+        response = {"result": True, "listings": listings, "next_cursor": next_cursor}
+        response.update(page_meta)
+        if degraded:
+            response["degraded"] = True
+        body = json_dumps(response)
+        self.record_span("serialize", start, bytes=len(body))
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        gzipped = None
+        # Degraded pages are not cached, full ones are served again as soon as users can be resolved
+        if cache_key is not None and not degraded and response_cache.accepts(generation):
+            # Only pages served again from the cache are worth gzipping ahead, the GZipContentEncoding
+            # transform compresses the others if the client accepts it
+            if self.settings["compress_response"] and len(body) >= GZipContentEncoding.MIN_LENGTH:
+                gzipped = gzip.compress(body, GZipContentEncoding.GZIP_LEVEL)
+            response_cache.set(cache_key, body, etag, gzipped, generation)
+        self.set_header("X-Cache", "MISS")
+        self.write_json_with_etag(body, etag, gzipped)
+
+    async def stream_listings(self, user_id, page_num, page_size, cursor, filters, include_total):
+        # Writes the same body as a page served whole, fetching listings from the listing service and
+        # writing them STREAM_CHUNK_SIZE at a time, so memory stays bounded whatever the page size.
+        # A negative page_size streams every listing. The first chunk seeks to the page, the next ones
+        # continue from the cursor of the previous one. Errors once the body is started end the response early
+        remaining = page_size if page_size >= 0 else None
+        chunk_cursor = cursor
+        # Pages past the first are seeked with a single listing page, whose page_num is the offset of the page
+        seek_page_num = None
+        if cursor is None and remaining is not None and page_num > 1:
+            seek_page_num = (page_num - 1) * page_size + 1
+        started = False
+        separator = b""
+        degraded = False
+        total = None
+        listingsJSON = None
+        while remaining is None or remaining > 0:
+            chunk_size = STREAM_CHUNK_SIZE if remaining is None else min(remaining, STREAM_CHUNK_SIZE)
+            if not started:
+                try:
+                    if seek_page_num is not None:
+                        listingsJSON = await self.get_listings(user_id, seek_page_num, 1, None, filters, include_total)
+                    else:
+                        listingsJSON = await self.get_listings(user_id, 1, chunk_size, chunk_cursor, filters, include_total)
+                    if listingsJSON is None:
                         return
-                    listing['user'] = user
-        except Exception as e:
-            logging.error(e)
-            self.write_json({"result": False, "errors": str(e)}, status_code=400)
-            return
-        finally:
-            http_client.close()
+                    listings = listingsJSON['listings']
+                    total = listingsJSON.get('total')
+                    # Only the first chunk checks the filtered user exists
+                    degraded = not await self.add_users(listings, user_id)
+                except UserNotFoundError as e:
+                    self.write_json({"result": False, "errors": str(e)}, status_code=400)
+                    return
+                except Exception as e:
+                    logging.error(e)
+                    self.write_json({"result": False, "errors": str(e)}, status_code=400)
+                    return
+                self.set_header("Content-Type", "application/json")
+                self.write(b'{"result":true,"listings":[')
+                started = True
+            else:
+                listingsJSON = await self.fetch_listings(user_id, 1, chunk_size, chunk_cursor, filters, include_total)
+                if not listingsJSON['result']:
+                    raise UpstreamError(listingsJSON['errors'])
+                listings = listingsJSON['listings']
+                if not await self.add_users(listings, None):
+                    degraded = True
 
-        self.write_json({"result": True, "listings": listings}, status_code=200)
+            if len(listings) > 0:
+                start = time.perf_counter()
+                # Items of the chunk, without the brackets of the list
+                chunk = json_dumps(listings)[1:-1]
+                self.record_span("serialize", start, bytes=len(chunk))
+                self.write(separator + chunk)
+                separator = b","
+                await self.flush()
+            if remaining is not None:
+                remaining -= len(listings)
+            chunk_cursor = listingsJSON.get('next_cursor')
+            seek_page_num = None
+            if chunk_cursor is None:
+                break
 
-    @tornado.gen.coroutine
-    def post(self):
-        http_client = AsyncHTTPClient()
+        # Remaining keys of the page, after the list of listings
+        tail = {"next_cursor": listingsJSON.get('next_cursor') if remaining == 0 else None}
+        if include_total:
+            tail["total"] = total
+            tail["has_more"] = listingsJSON.get('has_more')
+        if degraded:
+            tail["degraded"] = True
+        self.write(b"]," + json_dumps(tail)[1:])
+
+    def get_cache_key(self, user_id, page_num, page_size, cursor, filters, include_total):
+        # Params normalized the way the listing service reads them, so equivalent requests share an entry
+        # Requests the listing service would reject are not cached
+        try:
+            user_id = int(user_id) if user_id is not None else None
+            filters = parse_listing_filters(filters)
+        except ValueError:
+            return None
+        # page_num is ignored when paging with a cursor
+        if cursor is not None:
+            page_num = None
+        return (user_id, page_num, page_size, cursor, tuple(sorted(filters.items())), include_total)
+
+    async def post(self):
         try:
             # Collecting required params
             user_id = self.get_argument("user_id")
@@ -88,12 +1452,15 @@ class ListingsHandler(BaseHandler):
             price = self.get_argument("price")
             
 
+            try:
+                user_id = int(user_id)
+            except ValueError:
+                self.write_json({"result": False, "errors": "invalid user_id"}, status_code=400)
+                return
+
             # Check if user exists
-            user_url = f"{USERS_URL}/{user_id}"
-            user_resp = yield http_client.fetch(user_url, raise_error=False)
-            user_json = json.loads(user_resp.body.decode('utf-8'))
-            if not user_json['result']:
-                http_client.close()
+            exists = await self.user_exists(user_id)
+            if not exists:
                 self.write_json({"result": False, "errors": "User does not exist"}, status_code=400)
                 return
             
@@ -104,53 +1471,364 @@ class ListingsHandler(BaseHandler):
                 "price": price
             }
             body = urllib.parse.urlencode(post_data)
-            listingResp = yield http_client.fetch(LISTINGS_URL, method="POST", headers=None, body=body, raise_error=False)
-            listing = json.loads(listingResp.body.decode('utf-8'))['listing']
+            listingResp = await self.application.upstream.fetch("listings", LISTINGS_URL, method="POST", headers=None, body=body)
+            listing = json_loads(listingResp.body)['listing']
         except Exception as e:
             logging.error(e)
             self.write_json({"result": False, "errors": str(e)}, status_code=400)
             return
-        finally:
-            http_client.close()
+
+        # Cached pages may be missing the new listing
+        self.application.response_cache.invalidate()
+        # Adding it to the read model right away, so it shows up in the feed before the next sync
+        if self.application.read_model is not None:
+            self.application.read_model.apply("listings", [listing])
 
         self.write_json({"result": True, "listing": listing}, status_code=200)
           
+# /public-api/listings/bulk
+@tornado.web.stream_request_body
+class BulkListingsHandler(ListingsHandler):
+    """
+    Creates listings from a JSON array or newline-delimited JSON objects. Items are
+    checked to belong to existing users, each distinct user being looked up once,
+    and forwarded BULK_CHUNK_SIZE at a time to the listing service bulk endpoint.
+    Results are streamed back as newline-delimited JSON, one line per item.
+    """
+    SUPPORTED_METHODS = ("POST",)
+
+    def prepare(self):
+        super().prepare()
+        self.parser = JSONItemsParser()
+        self.item_count = 0
+        # (item index, item) of the items waiting to be created, or rejected for being invalid JSON
+        self.pending = []
+        self.set_header("Content-Type", "application/x-ndjson")
+
+    async def data_received(self, chunk):
+        for item in self.parser.feed(chunk):
+            self._add_item(item)
+        if len(self.pending) >= BULK_CHUNK_SIZE:
+            await self._create_pending()
+
+    async def post(self):
+        for item in self.parser.close():
+            self._add_item(item)
+        await self._create_pending()
+
+    def _add_item(self, item):
+        # Invalid JSON is rejected with the results of its chunk, other items are checked by the listing service
+        self.pending.append((self.item_count, item))
+        self.item_count += 1
+
+    async def _create_pending(self):
+        pending, self.pending = self.pending, []
+        if len(pending) == 0:
+            return
+
+        results = []
+        items = []
+        for index, item in pending:
+            if isinstance(item, ValueError):
+                results.append({"index": index, "result": False, "errors": [str(item)]})
+            else:
+                items.append((index, item))
+
+        created = []
+        try:
+            # Checking users exist, items with an invalid user_id are left for the listing service to reject
+            # Only users not known to exist are looked up
+            user_ids = [self._parse_user_id(item) for index, item in items]
+            known_users = self.application.known_users
+            users = await self.get_users([
+                user_id for user_id in user_ids
+                if user_id is not None and (known_users is None or user_id not in known_users)
+            ])
+
+            forwarded_indexes = []
+            lines = []
+            for (index, item), user_id in zip(items, user_ids):
+                if user_id is not None and user_id in users and users[user_id] is None:
+                    created.append({"index": index, "result": False, "errors": ["User does not exist"]})
+                    continue
+                forwarded_indexes.append(index)
+                lines.append(json_dumps(item))
+
+            # Creating the listings, then mapping results back to the index of their item in our body
+            if len(lines) > 0:
+                listingsResp = await self.application.upstream.fetch(
+                    "listings", LISTINGS_URL + "/bulk", method="POST", body=b"\n".join(lines)
+                )
+                if listingsResp.code != 200:
+                    raise UpstreamError("listing service responded with {}".format(listingsResp.code))
+                for line in listingsResp.body.splitlines():
+                    result = json_loads(line)
+                    result["index"] = forwarded_indexes[result["index"]]
+                    created.append(result)
+                # Cached pages may be missing the new listings
+                self.application.response_cache.invalidate()
+                if self.application.read_model is not None:
+                    self.application.read_model.apply(
+                        "listings", [result["listing"] for result in created if result["result"]]
+                    )
+        except Exception as e:
+            logging.error(e)
+            created = [{"index": index, "result": False, "errors": [str(e)]} for index, item in items]
+
+        # Writing results in item order
+        results.extend(created)
+        results.sort(key=lambda result: result["index"])
+        for result in results:
+            self._write_line(result)
+        await self.flush()
+
+    def _parse_user_id(self, item):
+        try:
+            return int(item["user_id"])
+        except:
+            return None
+
+    def _write_line(self, obj):
+        self.write(json_dumps(obj) + b"\n")
 
 class UsersHandler(BaseHandler):
-    @tornado.gen.coroutine
-    def post(self):
-        http_client = AsyncHTTPClient()
+    async def post(self):
         try:
             post_data = {"name": self.get_argument("name")}
             body = urllib.parse.urlencode(post_data)
-            userResp = yield http_client.fetch(USERS_URL, method="POST", headers=None, body=body, raise_error=False)
-            user = json.loads(userResp.body.decode('utf-8'))['user']
+            userResp = await self.application.upstream.fetch("users", USERS_URL, method="POST", headers=None, body=body)
+            user = json_loads(userResp.body)['user']
         except Exception as e:
             logging.error(e)
             self.write_json({"result": False, "errors": str(e)}, status_code=400)
             return
-        finally:
-            http_client.close()
+
+        # Caching the new user, it is likely to be looked up soon
+        self.application.user_cache.set(user['id'], user)
+        if self.application.known_users is not None:
+            self.application.known_users.add(user['id'])
+        if self.application.read_model is not None:
+            self.application.read_model.apply("users", [user])
 
         self.write_json({"result": True, "user": user}, status_code=200)
 
+async def fetch_from_workers(ports, path):
+    """Returns the bodies of path fetched from the metrics port of every worker, leaving out workers that failed to respond."""
+    client = AsyncHTTPClient()
+    responses = await asyncio.gather(*[
+        client.fetch("http://127.0.0.1:{}{}".format(port, path)) for port in ports
+    ], return_exceptions=True)
+    bodies = []
+    for port, response in zip(ports, responses):
+        if isinstance(response, Exception):
+            logging.warning("Worker metrics port {} failed to respond: {}".format(port, response))
+            continue
+        bodies.append(response.body)
+    return bodies
+
+# /public-api/traces
+class TracesHandler(BaseHandler):
+    async def get(self):
+        export_format = self.get_argument("format", "json")
+        if export_format not in {"json", "chrome"}:
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'json', 'chrome'"}, status_code=400)
+            return
+        tracer = self.application.tracer
+        trace_id = self.get_argument("trace_id", None)
+        worker_ports = self.settings.get("worker_ports")
+        if worker_ports is None:
+            spans = tracer.get_spans(trace_id)
+        else:
+            # Spans of every worker, from their metrics ports
+            path = url_concat("/public-api/traces", {"trace_id": trace_id} if trace_id is not None else None)
+            spans = []
+            for body in await fetch_from_workers(worker_ports, path):
+                spans.extend(json.loads(body)["spans"])
+            spans.sort(key=lambda span: span["start"])
+        if export_format == "chrome":
+            self.write_json(tracer.to_chrome_trace(spans))
+        else:
+            self.write_json({"result": True, "spans": spans})
+
+# /metrics
+class MetricsHandler(BaseHandler):
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        worker_ports = self.settings.get("worker_ports")
+        if worker_ports is None:
+            self.write(self.application.metrics.render())
+            return
+        # Series of every worker, from their metrics ports
+        bodies = await fetch_from_workers(worker_ports, "/metrics")
+        self.write(merge_metrics([body.decode("utf-8") for body in bodies]))
+
+# /public-api/stats
+class StatsHandler(BaseHandler):
+    async def get(self):
+        upstream = self.application.upstream
+        self.write_json({
+            "result": True,
+            "http_client": upstream.pool_stats(),
+            "upstreams": upstream.get_stats(),
+            "user_cache": dict(self.application.user_cache.stats, size=len(self.application.user_cache.entries)),
+            "response_cache": self.application.response_cache.get_stats(),
+            "read_model": self.application.read_model.get_stats() if self.application.read_model is not None else None,
+            "known_users": self.application.known_users.get_stats() if self.application.known_users is not None else None,
+        })
+
+class WorkerApp(tornado.web.Application):
+    """Serves the metrics and spans recorded by app, those of this worker alone, on the metrics port of the worker."""
+
+    def __init__(self, app):
+        super().__init__([
+            (r"/public-api/traces", TracesHandler),
+            (r"/metrics", MetricsHandler),
+        ], profile_dir=None)
+        self.metrics = app.metrics
+        self.tracer = app.tracer
+        self.profiling = False
+
 # Path to the request handler
 def make_app(options):
-    return tornado.web.Application([
+    # Metrics and spans are recorded per worker process
+    worker = tornado.process.task_id() or 0
+    metrics = Metrics(worker)
+    tracer = Tracer("public-api", options.trace_buffer_size, worker)
+    upstream = UpstreamClient(options.max_clients, {
+        "listings": (options.listings_connect_timeout, options.listings_request_timeout),
+        "users": (options.users_connect_timeout, options.users_request_timeout),
+    }, metrics, options.circuit_failure_threshold, options.circuit_reset_timeout, options.hedge_requests,
+        options.upstream_compression, tracer)
+    user_cache = UserCache(options.user_cache_size, options.user_cache_ttl, options.user_cache_negative_ttl)
+    response_cache = ResponseCache(options.response_cache_size, options.response_cache_ttl)
+    read_model = None
+    if options.read_model:
+        read_model = ReadModel(upstream, options.read_model_sync_interval)
+    known_users = KnownUsers() if options.known_users else None
+    return App([
         (r"/public-api/listings", ListingsHandler),
+        (r"/public-api/listings/bulk", BulkListingsHandler),
         (r"/public-api/users", UsersHandler),
-    ], debug=options.debug)
+        (r"/public-api/stats", StatsHandler),
+        (r"/public-api/traces", TracesHandler),
+        (r"/metrics", MetricsHandler),
+    ], metrics, tracer, upstream, user_cache, response_cache, read_model, known_users, debug=options.debug,
+        profile_dir=options.profile_dir,
+        worker_ports=[options.metrics_port + worker for worker in range(options.workers or 1)] if options.metrics_port is not None else None,
+        transforms=[GZipContentEncoding] if options.compress_response else [],
+        compress_response=options.compress_response,
+        user_batch_lookup=options.user_batch_lookup,
+        user_fetch_concurrency=options.user_fetch_concurrency,
+        degrade_on_user_errors=options.degrade_on_user_errors)
+
+def define_options(options):
+    options.define("port", default=6002)
+    # Debug mode restarts the app on file changes, it requires a single worker
+    # Defaults to on with a single worker, off otherwise
+    options.define("debug", default=None, type=bool)
+    # Number of worker processes sharing the port (0 starts one per CPU)
+    # Caches and stats are kept per worker
+    options.define("workers", default=0)
+    # Resolve the users of a listings page with GET /users?ids=... calls of up to MAX_IDS_PER_QUERY users
+    # Turn off for user services without batch lookup, users are then fetched concurrently one by one
+    options.define("user_batch_lookup", default=True)
+    # Maximum number of concurrent user lookups per request when batch lookup is off
+    options.define("user_fetch_concurrency", default=10)
+    # Gzip responses for clients that accept it
+    options.define("compress_response", default=True)
+    # Ask the listing and user services for gzipped responses, worth it when they are across a slow network link
+    options.define("upstream_compression", default=False)
+    # Maximum number of simultaneous upstream requests (pooled connections) for the shared http client
+    options.define("max_clients", default=50)
+    # Connect/request timeouts in seconds, per upstream service
+    options.define("listings_connect_timeout", default=1.0)
+    options.define("listings_request_timeout", default=5.0)
+    options.define("users_connect_timeout", default=1.0)
+    options.define("users_request_timeout", default=2.0)
+    # Consecutive failures (errors, timeouts or 5xx responses) after which calls to an upstream fail fast (0 never fails fast)
+    options.define("circuit_failure_threshold", default=5)
+    # Seconds before a trial call goes through to an upstream that calls fail fast to
+    options.define("circuit_reset_timeout", default=5.0)
+    # Send a second request when GETs to an upstream take longer than its 95th percentile latency
+    options.define("hedge_requests", default=False)
+    # Serve listings without their user, flagged as degraded, when users can't be resolved
+    options.define("degrade_on_user_errors", default=False)
+    # Maximum number of users kept in the in-process user cache (0 disables caching)
+    options.define("user_cache_size", default=10000)
+    # Seconds before cached users, and ids cached as having no user, are looked up again
+    options.define("user_cache_ttl", default=60.0)
+    options.define("user_cache_negative_ttl", default=5.0)
+    # Keep track of the ids of existing users, loaded from the user service at startup, so listings of known
+    # users are created without checking with the user service
+    options.define("known_users", default=True)
+    # Maximum number of listings pages kept in the response cache (0 disables caching)
+    options.define("response_cache_size", default=1000)
+    # Seconds a cached listings page is served for. Creates through this process invalidate the cache
+    # right away, listings created in other ways show up once cached pages expire
+    options.define("response_cache_ttl", default=2.0)
+    # Number of recent spans kept for GET /public-api/traces (0 disables tracing and trace propagation)
+    options.define("trace_buffer_size", default=10000)
+    # Base of the ports workers serve their own /metrics and /public-api/traces on, worker i on metrics_port + i.
+    # /metrics and /public-api/traces on port then merge those of every worker, unset they only cover the worker serving the request
+    options.define("metrics_port", default=None, type=int)
+    # Directory the profiles of requests made with __profile=1 are written to, profiling is disabled unless set
+    options.define("profile_dir", default=None, type=str)
+    # Run on uvloop instead of the default asyncio event loop, if installed
+    options.define("uvloop", default=False)
+    # Serve listings pages from an in-memory copy of the listings and users, synced from the listing and user services
+    options.define("read_model", default=False)
+    # Seconds between read model syncs
+    options.define("read_model_sync_interval", default=1.0)
+
+async def serve(options, sockets):
+    """Serves the app on sockets until cancelled, closing the shared http client once it stops."""
+    app = make_app(options)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    # Serving the metrics and spans of this worker alone on its own port
+    worker_server = None
+    if options.metrics_port is not None:
+        worker_server = tornado.httpserver.HTTPServer(WorkerApp(app))
+        worker_server.listen(options.metrics_port + (tornado.process.task_id() or 0))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        if worker_server is not None:
+            worker_server.stop()
+        app.close()
+
+def run(options, sockets):
+    """Runs serve() on a new event loop, a uvloop one with the uvloop option."""
+    if options.uvloop:
+        if uvloop is None:
+            logging.warning("uvloop is not installed, running on the default asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(serve(options, sockets))
 
 if __name__ == "__main__":
-    tornado.options.define("port", default=6002)
-    tornado.options.define("debug", default=True)
+    define_options(tornado.options.options)
     tornado.options.parse_command_line()
     options = tornado.options.options
+    workers = options.workers or os.cpu_count() or 1
+    if not hasattr(os, "fork"):
+        workers = 1
+    if options.debug is None:
+        options.debug = workers == 1
+    elif options.debug and workers != 1:
+        logging.warning("Debug mode runs a single worker")
+        workers = 1
+    options.workers = workers
+    if workers != 1 and options.metrics_port is None:
+        logging.warning("/metrics and /public-api/traces only cover the worker serving the request, set metrics_port to merge those of every worker")
 
-    # Create web app
-    app = make_app(options)
-    app.listen(options.port)
-    logging.info("Starting public-api service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
+    # Binding the port before forking, so workers accept connections on the same sockets
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if workers != 1:
+        logging.info("Starting {} public-api workers".format(workers))
+        tornado.process.fork_processes(workers)
 
-    # Start event loop
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    # Serving the app, each worker with its own http client and caches
+    logging.info("Starting public-api service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
+    run(options, sockets)
\ No newline at end of file
@@ -1,46 +1,689 @@
-import tornado.ioloop
 import tornado.web
 import tornado.log
 import tornado.options
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+import os
 import sqlite3
 import logging
 import json
 import time
+import base64
+import threading
+import queue
+import concurrent.futures
+import asyncio
+import collections
+import bisect
+import re
+import contextvars
+import cProfile
+
+# orjson serializes several times faster than the json module, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# uvloop is an optional, faster drop-in replacement for the asyncio event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+def json_dumps(obj):
+    """Returns obj serialized to JSON, as UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+    """Gzips responses at level 1, several times faster than tornado's default level 6 and nearly as small on JSON."""
+    GZIP_LEVEL = 1
+
+# Columns of the user records returned by the API, in the order they are selected
+USER_COLUMNS = ("id", "name", "created_at", "updated_at")
+SELECT_USERS = "SELECT {} FROM users".format(", ".join(USER_COLUMNS))
+
+# Maximum number of ids bound to a single "WHERE id IN (...)" query
+MAX_IDS_PER_QUERY = 500
+
+def encode_cursor(created_at, id):
+    # Opaque keyset cursor pointing right after the (created_at, id) of the last row of a page
+    return base64.urlsafe_b64encode("{}:{}".format(created_at, id).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor):
+    created_at, id = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split(":")
+    return int(created_at), int(id)
+
+# Schema migrations, applied in order at startup and recorded in the schema_version table
+# Released migrations must not be edited, add a new one instead
+MIGRATIONS = [
+    # 1: users table
+    [
+        "CREATE TABLE IF NOT EXISTS 'users' ("
+        + "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+        + "name TEXT NOT NULL,"
+        + "created_at INTEGER NOT NULL,"
+        + "updated_at INTEGER NOT NULL"
+        + ");",
+    ],
+    # 2: index for the users list order
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at, id);",
+    ],
+    # 3: index for syncing users in update order
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users (updated_at, id);",
+    ],
+    # 4: number of users, kept up to date by triggers so pages can report the total without counting rows
+    [
+        "CREATE TABLE IF NOT EXISTS counts (name TEXT NOT NULL PRIMARY KEY, count INTEGER NOT NULL);",
+        "INSERT INTO counts (name, count) SELECT 'users', COUNT(*) FROM users;",
+        "CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users BEGIN "
+        + "UPDATE counts SET count=count+1 WHERE name='users'; "
+        + "END;",
+        "CREATE TRIGGER IF NOT EXISTS users_count_delete AFTER DELETE ON users BEGIN "
+        + "UPDATE counts SET count=count-1 WHERE name='users'; "
+        + "END;",
+    ],
+]
+
+# Recount of the count kept by the triggers of migration 4, run at startup in case it drifted
+REBUILD_COUNTS = [
+    "DELETE FROM counts WHERE name='users';",
+    "INSERT INTO counts (name, count) SELECT 'users', COUNT(*) FROM users;",
+]
+
+# Queries on the hot path, checked at startup to be served by an index without sorting
+HOT_QUERIES = [
+    (SELECT_USERS + " ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", (10, 0)),
+    (SELECT_USERS + " WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?", (0, 0, 10)),
+    (SELECT_USERS + " WHERE id IN (?, ?)", (1, 2)),
+    (SELECT_USERS + " WHERE (updated_at, id) > (?, ?) ORDER BY updated_at, id LIMIT ?", (0, 0, 10)),
+    ("SELECT id FROM users WHERE id>? ORDER BY id LIMIT ?", (0, 10)),
+]
+
+def migrate(db, target_version=None):
+    """
+    Applies the migrations db is missing, up to target_version (the latest by default).
+    Each migration runs in its own write transaction, so concurrent callers apply it once.
+    """
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS 'schema_version' ("
+        + "version INTEGER NOT NULL PRIMARY KEY,"
+        + "applied_at INTEGER NOT NULL"
+        + ");"
+    )
+    db.commit()
+
+    if target_version is None:
+        target_version = len(MIGRATIONS)
+    for version in range(1, target_version + 1):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            applied = db.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone()
+            if applied is None:
+                for statement in MIGRATIONS[version - 1]:
+                    db.execute(statement)
+                db.execute(
+                    "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                    (version, int(time.time() * 1e6))
+                )
+                logging.info("Applied users db migration {}".format(version))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+def rebuild_counts(db):
+    """Recounts the users in the counts table, in a single write transaction."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in REBUILD_COUNTS:
+            db.execute(statement)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+def check_query_plans(db):
+    """Returns the hot queries that would scan the table or sort their results."""
+    slow_queries = []
+    for query, args in HOT_QUERIES:
+        for row in db.execute("EXPLAIN QUERY PLAN " + query, args):
+            detail = row[3]
+            if "TEMP B-TREE" in detail or (detail.startswith("SCAN") and "INDEX" not in detail):
+                slow_queries.append(query)
+                break
+    return slow_queries
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """Latency histogram with counts per LATENCY_BUCKETS bucket, plus their sum and count."""
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self):
+        # The last bucket counts the values above every bound
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics(object):
+    """
+    Counters and latency histograms of this process, rendered in the Prometheus
+    text format by /metrics. Series are created on first use, one per tuple of
+    label values, so recording a value only updates a few numbers.
+    """
+
+    def __init__(self, worker=0):
+        # Worker process of the metrics, a worker label of every series
+        self.worker = worker
+        # Values are recorded from the event loop and from the db threads
+        self.lock = threading.Lock()
+        # name -> (type, help, label names)
+        self.definitions = collections.OrderedDict()
+        # name -> {label values: count or Histogram}
+        self.series = {}
+
+    def define(self, name, type, help, labels=()):
+        if name not in self.definitions:
+            self.definitions[name] = (type, help, labels)
+            self.series[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.series[name]
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (type, help, label_names) in self.definitions.items():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, type))
+                for labels, value in self.series[name].items():
+                    pairs = ['worker="{}"'.format(self.worker)] + ['{}="{}"'.format(label_name, escape_label_value(label))
+                        for label_name, label in zip(label_names, labels)]
+                    if type != "histogram":
+                        lines.append("{}{} {}".format(name, format_labels(pairs), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value.buckets):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(name, format_labels(pairs + ['le="{}"'.format(bound)]), cumulative))
+                    lines.append("{}_sum{} {}".format(name, format_labels(pairs), value.sum))
+                    lines.append("{}_count{} {}".format(name, format_labels(pairs), value.count))
+        return "\n".join(lines) + "\n"
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(pairs):
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def merge_metrics(texts):
+    """Returns the metrics rendered by several workers as a single text, with the series of every worker under each metric."""
+    # name -> (HELP and TYPE lines, series lines)
+    families = collections.OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = families.setdefault(line.split(" ")[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line != "":
+                family[1].append(line)
+    lines = []
+    for header, series in families.values():
+        lines.extend(header)
+        lines.extend(series)
+    return "\n".join(lines) + "\n"
+
+# Trace context of the request being handled: (trace id, id of the span new spans are children of)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# W3C trace context header: version-trace id-parent span id-flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+def parse_traceparent(value):
+    """Returns the (trace id, parent span id) of a traceparent header value, or None if it is missing or invalid."""
+    match = TRACEPARENT.match(value or "")
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+def format_traceparent(trace_id, span_id):
+    return "00-{}-{}-01".format(trace_id, span_id)
+
+class Tracer(object):
+    """
+    Keeps the last max_spans spans recorded by the service in a ring buffer,
+    to find out where the time of slow requests went. Spans are recorded from
+    the event loop and from other threads.
+    """
+
+    def __init__(self, service, max_spans, worker=0):
+        self.service = service
+        # Worker process recording the spans
+        self.worker = worker
+        self.enabled = max_spans > 0
+        # Appending to a bounded deque is thread-safe, and drops the oldest span once full
+        self.spans = collections.deque(maxlen=max_spans)
+
+    def record(self, trace, span_id, name, start, duration, **attributes):
+        """
+        Records a span of trace, a (trace id, parent span id) pair, started at start
+        (seconds since the epoch) and lasting duration seconds. Does nothing without a trace.
+        """
+        if not self.enabled or trace is None:
+            return
+        trace_id, parent_id = trace
+        self.spans.append({
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "service": self.service,
+            "worker": self.worker,
+            "name": name,
+            "start": int(start * 1e6),
+            "duration": int(duration * 1e6),
+            "attributes": attributes,
+        })
+
+    def get_spans(self, trace_id=None):
+        """Returns the recorded spans, oldest first, only those of trace_id if specified."""
+        spans = list(self.spans)
+        if trace_id is not None:
+            spans = [span for span in spans if span["trace_id"] == trace_id]
+        return spans
+
+    def to_chrome_trace(self, spans):
+        """
+        Returns spans in the Chrome trace event format, which chrome://tracing and Perfetto load.
+        The spans of each worker are shown as a process.
+        """
+        events = [
+            {"name": "process_name", "ph": "M", "pid": worker, "args": {"name": "{} worker {}".format(self.service, worker)}}
+            for worker in sorted({span["worker"] for span in spans})
+        ]
+        for span in spans:
+            events.append({
+                "name": span["name"],
+                "cat": span["service"],
+                "ph": "X",
+                "pid": span["worker"],
+                # One track per trace
+                "tid": int(span["trace_id"][:8], 16),
+                "ts": span["start"],
+                "dur": span["duration"],
+                "args": dict(span["attributes"], trace_id=span["trace_id"], span_id=span["span_id"], parent_id=span["parent_id"]),
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# Placeholder lists of "IN (?, ?, ...)" clauses, collapsed in the statement label of query metrics
+IN_PLACEHOLDERS = re.compile(r"IN \([?,\s]*\)")
+
+# Applied to every connection. The db itself is switched to WAL mode at startup,
+# so readers don't block the writer, and commits only fsync at checkpoints.
+DB_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+]
+
+class Database(object):
+    """
+    Runs SQLite statements off the event loop. Reads run on a bounded thread pool,
+    each thread with its own connection, while writes are serialized through a
+    single writer thread and connection. Methods return asyncio futures handlers can await.
+
+    With a group_commit_window (in seconds), the writer waits that long for more
+    writes after the first one and commits all of them in a single transaction.
+
+    Statement and commit durations are recorded in metrics, statements are also
+    recorded as spans of the trace they were run for in tracer.
+    """
+
+    def __init__(self, path, read_threads, group_commit_window=0, group_commit_max_size=256, metrics=None, tracer=None):
+        self.path = path
+        self.group_commit_window = group_commit_window
+        self.group_commit_max_size = group_commit_max_size
+        self.local = threading.local()
+        self.read_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=read_threads, thread_name_prefix="db-read"
+        )
+        self.write_queue = queue.Queue()
+
+        # Saturation metrics, updated from the event loop and the db threads
+        self.lock = threading.Lock()
+        self.stats = {
+            "reads": 0, "writes": 0, "write_transactions": 0,
+            "read_queue_depth": 0, "write_queue_depth": 0,
+            "read_wait_time": 0.0, "write_wait_time": 0.0,
+            "max_read_wait_time": 0.0, "max_write_wait_time": 0.0,
+        }
+        self.metrics = metrics or Metrics()
+        self.metrics.define("db_query_duration_seconds", "histogram",
+            "Time spent running SQL statements, excluding queue wait", ("statement",))
+        self.metrics.define("db_commit_duration_seconds", "histogram", "Time spent committing write transactions")
+        self.tracer = tracer or Tracer("db", 0)
+        # sql -> statement label
+        self.statement_labels = {}
+
+        self.writer = threading.Thread(target=self._write_loop, name="db-write", daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        # Rows are plain tuples, handlers map them to the columns they selected
+        db = sqlite3.connect(self.path)
+        for pragma in DB_PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def fetchall(self, sql, args=()):
+        """Returns a future resolving to the rows selected by sql."""
+        return self._read(sql, lambda db: db.execute(sql, args).fetchall())
+
+    def fetchone(self, sql, args=()):
+        """Returns a future resolving to the first row selected by sql, or None."""
+        return self._read(sql, lambda db: db.execute(sql, args).fetchone())
+
+    def execute_write(self, sql, args=()):
+        """Returns a future resolving to the lastrowid of sql, once committed."""
+        return self._write(sql, lambda db: db.execute(sql, args).lastrowid)
+
+    def executemany_write(self, sql, seq_of_args):
+        """
+        Returns a future resolving to the rowid of the last row inserted by sql, once committed.
+        Rows inserted in a single transaction get consecutive rowids.
+        """
+        def write(db):
+            db.executemany(sql, seq_of_args)
+            return db.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return self._write(sql, write)
+
+    def _read(self, sql, fn):
+        submitted_at = time.monotonic()
+        trace = current_trace.get()
+        with self.lock:
+            self.stats["read_queue_depth"] += 1
+
+        def run():
+            self._record_wait("read", submitted_at)
+            db = getattr(self.local, "db", None)
+            if db is None:
+                db = self.local.db = self.connect()
+            start = time.perf_counter()
+            try:
+                return fn(db)
+            finally:
+                self._record_query(sql, start, trace)
+
+        # Handing out asyncio futures, concurrent futures can't be awaited
+        return asyncio.wrap_future(self.read_executor.submit(run))
+
+    def _write(self, sql, fn):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.stats["write_queue_depth"] += 1
+        self.write_queue.put((sql, fn, future, time.monotonic(), current_trace.get()))
+        return asyncio.wrap_future(future)
+
+    def _write_loop(self):
+        db = self.connect()
+        # Transactions are managed explicitly
+        db.isolation_level = None
+        stopping = False
+        while not stopping:
+            job = self.write_queue.get()
+            if job is None:
+                break
+            jobs = [job]
+
+            # Collecting the writes arriving within the group commit window
+            if self.group_commit_window > 0:
+                deadline = time.monotonic() + self.group_commit_window
+                while len(jobs) < self.group_commit_max_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        job = self.write_queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    jobs.append(job)
+
+            try:
+                self._run_writes(db, jobs)
+            except Exception as e:
+                # The writer thread must survive: the writes of the batch fail instead of hanging
+                logging.exception("Error while running %d db writes", len(jobs))
+                self._abort_writes(db, jobs, e)
+        db.close()
+
+    def _abort_writes(self, db, jobs, error):
+        try:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+        except Exception:
+            logging.exception("Error while rolling back db writes")
+        for sql, fn, future, submitted_at, trace in jobs:
+            if not future.done():
+                future.set_exception(error)
+
+    def _run_writes(self, db, jobs):
+        # Each write runs in a savepoint, so a failing one doesn't abort the others of the transaction
+        results = []
+        for sql, fn, future, submitted_at, trace in jobs:
+            self._record_wait("write", submitted_at)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for sql, fn, future, submitted_at, trace in jobs:
+                future.set_exception(e)
+            return
+
+        for sql, fn, future, submitted_at, trace in jobs:
+            db.execute("SAVEPOINT write")
+            start = time.perf_counter()
+            try:
+                result = fn(db)
+            except Exception as e:
+                db.execute("ROLLBACK TO write")
+                results.append((future, None, e))
+            else:
+                results.append((future, result, None))
+            self._record_query(sql, start, trace)
+            db.execute("RELEASE write")
+
+        start = time.perf_counter()
+        try:
+            db.execute("COMMIT")
+            self.metrics.observe("db_commit_duration_seconds", (), time.perf_counter() - start)
+        except Exception as e:
+            db.execute("ROLLBACK")
+            results = [(future, None, e) for future, _, _ in results]
+        with self.lock:
+            self.stats["write_transactions"] += 1
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _record_wait(self, kind, submitted_at):
+        wait_time = time.monotonic() - submitted_at
+        with self.lock:
+            self.stats[kind + "_queue_depth"] -= 1
+            self.stats[kind + "s"] += 1
+            self.stats[kind + "_wait_time"] += wait_time
+            self.stats["max_" + kind + "_wait_time"] = max(self.stats["max_" + kind + "_wait_time"], wait_time)
+
+    def _record_query(self, sql, start, trace):
+        duration = time.perf_counter() - start
+        label = self.statement_labels.get(sql)
+        if label is None:
+            label = self.statement_labels[sql] = " ".join(IN_PLACEHOLDERS.sub("IN (...)", sql).split())
+        self.metrics.observe("db_query_duration_seconds", (label,), duration)
+        self.tracer.record(trace, new_span_id(), "sql", time.time() - duration, duration, statement=label)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        self.write_queue.put(None)
+        self.writer.join()
+        self.read_executor.shutdown()
+
+def init_db(db_path):
+    db = sqlite3.connect(db_path)
+    try:
+        # WAL mode is persistent, it only needs to be set once
+        db.execute("PRAGMA journal_mode=WAL")
+
+        # Create or upgrade tables and indexes
+        migrate(db)
+
+        start = time.monotonic()
+        rebuild_counts(db)
+        logging.info("Rebuilt user counts in {:.2f}s".format(time.monotonic() - start))
+
+        for query in check_query_plans(db):
+            logging.warning("Query is not served by an index: {}".format(query))
+    finally:
+        db.close()
+
+# Number of user ids read and written at a time by id dumps
+ID_DUMP_CHUNK_SIZE = 10000
 
 class App(tornado.web.Application):
 
-    def __init__(self, handlers, **kwargs):
+    def __init__(self, handlers, db_path, db_read_threads, group_commit_window, trace_buffer_size, db_initialized=False,
+                 **kwargs):
         super().__init__(handlers, **kwargs)
+        # Metrics and spans are recorded per worker process
+        worker = tornado.process.task_id() or 0
+        self.metrics = Metrics(worker)
+        self.metrics.define("http_request_duration_seconds", "histogram",
+            "Time spent serving requests", ("handler", "method", "status"))
+        self.tracer = Tracer("users", trace_buffer_size, worker)
+        # Whether a request is being profiled, a single one can be at a time
+        self.profiling = False
 
-        # Initialising db connection
-        self.db = sqlite3.connect("users.db")
-        self.db.row_factory = sqlite3.Row
-        self.init_db()
-
-    def init_db(self):
-        cursor = self.db.cursor()
-
-        # Create table
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS 'users' ("
-            + "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
-            + "name TEXT NOT NULL,"
-            + "created_at INTEGER NOT NULL,"
-            + "updated_at INTEGER NOT NULL"
-            + ");"
-        )
-        self.db.commit()
+        # Initialising db access, migrating the db unless the entry point already did before forking workers
+        if not db_initialized:
+            init_db(db_path)
+        self.db = Database(db_path, db_read_threads, group_commit_window, metrics=self.metrics, tracer=self.tracer)
+
+    def close(self):
+        self.db.close()
 
 class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self):
+        # Continuing the trace of the caller's traceparent header, or starting a new one
+        trace = parse_traceparent(self.request.headers.get("traceparent"))
+        if trace is not None:
+            self.trace_id, self.parent_span_id = trace
+        else:
+            self.trace_id, self.parent_span_id = new_trace_id(), None
+        self.span_id = new_span_id()
+        self.profile = None
+
+    def prepare(self):
+        # Spans recorded while handling the request, on the event loop and in other threads, are children of its span
+        current_trace.set((self.trace_id, self.span_id))
+        self.set_header("X-Trace-Id", self.trace_id)
+
+        # Profiling the request when asked to with __profile=1, if profiling is enabled.
+        # The profiler sees everything the event loop runs meanwhile, including other requests
+        if self.settings["profile_dir"] is not None and self.get_query_argument("__profile", None) == "1":
+            if self.application.profiling:
+                logging.warning("Not profiling {}, another request is being profiled".format(self.request.uri))
+            else:
+                self.application.profiling = True
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+
+    def on_finish(self):
+        request_time = self.request.request_time()
+        self.application.metrics.observe(
+            "http_request_duration_seconds",
+            (type(self).__name__, self.request.method, self.get_status()),
+            request_time
+        )
+        self.application.tracer.record(
+            (self.trace_id, self.parent_span_id), self.span_id, type(self).__name__,
+            time.time() - request_time, request_time,
+            method=self.request.method, path=self.request.path, status=self.get_status()
+        )
+        self.stop_profile()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self.stop_profile()
+
+    def stop_profile(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.application.profiling = False
+        path = os.path.join(self.settings["profile_dir"], "{}-{}.prof".format(type(self).__name__, self.trace_id))
+        self.profile.dump_stats(path)
+        self.profile = None
+        logging.info("Profile of {} written to {}".format(self.request.uri, path))
+
+    def record_span(self, name, start, **attributes):
+        # Records a span of the request, from start (a time.perf_counter() value) to now
+        duration = time.perf_counter() - start
+        self.application.tracer.record(
+            (self.trace_id, self.span_id), new_span_id(), name, time.time() - duration, duration, **attributes
+        )
+
     def write_json(self, obj, status_code=200):
         self.set_header("Content-Type", "application/json")
         self.set_status(status_code)
-        self.write(json.dumps(obj))
+        start = time.perf_counter()
+        body = json_dumps(obj)
+        self.record_span("serialize", start, bytes=len(body))
+        self.write(body)
 
 # /users
 class UsersHandler(BaseHandler):
-    @tornado.gen.coroutine
-    def get(self):
+    async def get(self):
         # Parsing pagination params
         page_num = self.get_argument("page_num", 1)
         page_size = self.get_argument("page_size", 10)
@@ -57,31 +700,102 @@ class UsersHandler(BaseHandler):
             logging.exception("Error while parsing page_size: {}".format(page_size))
             self.write_json({"result": False, "errors": "invalid page_size"}, status_code=400)
             return
-        
+
+        # Incremental sync when updated_since is specified: the users updated after (updated_since, updated_since_id),
+        # in update order. Callers pass the updated_at and id of the last user they got to get the next ones
+        updated_since = self.get_argument("updated_since", None)
+        if updated_since is not None:
+            try:
+                updated_since = int(updated_since)
+                updated_since_id = int(self.get_argument("updated_since_id", 0))
+            except:
+                self.write_json({"result": False, "errors": "invalid updated_since"}, status_code=400)
+                return
+            results = await self.application.db.fetchall(
+                SELECT_USERS + " WHERE (updated_at, id) > (?, ?) ORDER BY updated_at, id LIMIT ?",
+                (updated_since, updated_since_id, page_size)
+            )
+            self.write_json({"result": True, "users": [dict(zip(USER_COLUMNS, row)) for row in results]})
+            return
+
+        # Batch lookup by id when the ids param is specified
+        ids = self.get_argument("ids", None)
+        if ids is not None:
+            try:
+                ids = [int(id) for id in ids.split(",") if id.strip() != ""]
+            except:
+                self.write_json({"result": False, "errors": "invalid ids"}, status_code=400)
+                return
+            users = await self._get_users_by_ids(ids)
+            self.write_json({"result": True, "users": users})
+            return
+
+        # Parsing cursor param, seeks past the previous page instead of using page_num when specified
+        page_cursor = self.get_argument("cursor", None)
+        if page_cursor is not None:
+            try:
+                page_cursor = decode_cursor(page_cursor)
+            except:
+                self.write_json({"result": False, "errors": "invalid cursor"}, status_code=400)
+                return
+
+        # Parsing include_total param, adding the total number of users and whether there is a next page
+        include_total = self.get_argument("include_total", "false").lower() in {"1", "true"}
+        total = None
+        if include_total:
+            row = await self.application.db.fetchone("SELECT count FROM counts WHERE name='users'")
+            total = row[0] if row is not None else 0
+
         # Building select statement
-        select_stmt = "SELECT * FROM users"
-        
-        # Order by and pagination
-        limit = page_size
-        offset = (page_num - 1) * page_size
-        select_stmt += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-
-        args = (limit, offset)
-        cursor = self.application.db.cursor()
-        results = cursor.execute(select_stmt, args)
-
-        users = []
-        for row in results:
-            fields = ["id", "name", "created_at", "updated_at"]
-            user = {
-                field: row[field] for field in fields
-            }
-            users.append(user)
-        
-        self.write_json({"result": True, "users": users})
+        select_stmt = SELECT_USERS
+        args = []
+        # Adding keyset clause if cursor is specified
+        if page_cursor is not None:
+            select_stmt += " WHERE (created_at, id) < (?, ?)"
+            args.extend(page_cursor)
+
+        # Order by and pagination, with one more user when including the total to tell whether there is a next page
+        select_stmt += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        args.append(page_size + 1 if include_total and page_size >= 0 else page_size)
+        if page_cursor is None:
+            select_stmt += " OFFSET ?"
+            args.append((page_num - 1) * page_size)
+
+        results = await self.application.db.fetchall(select_stmt, args)
+        has_more = len(results) > page_size >= 0
+        if has_more:
+            results = results[:page_size]
+
+        users = [dict(zip(USER_COLUMNS, row)) for row in results]
 
-    @tornado.gen.coroutine
-    def post(self):
+        # Handing out a cursor to the next page unless this one was the last
+        next_cursor = None
+        if len(users) == page_size and page_size > 0 and (has_more or not include_total):
+            next_cursor = encode_cursor(users[-1]["created_at"], users[-1]["id"])
+
+        page = {"result": True, "users": users, "next_cursor": next_cursor}
+        if include_total:
+            page["total"] = total
+            page["has_more"] = has_more
+        self.write_json(page)
+
+    async def _get_users_by_ids(self, ids):
+        # Deduplicating ids while preserving the order they were requested in
+        ids = list(dict.fromkeys(ids))
+
+        # Querying in chunks to stay under SQLite's bound parameter limit
+        users_by_id = {}
+        for i in range(0, len(ids), MAX_IDS_PER_QUERY):
+            chunk = ids[i:i + MAX_IDS_PER_QUERY]
+            select_stmt = SELECT_USERS + " WHERE id IN ({})".format(",".join("?" * len(chunk)))
+            results = await self.application.db.fetchall(select_stmt, chunk)
+            for row in results:
+                users_by_id[row[0]] = dict(zip(USER_COLUMNS, row))
+
+        # Ids with no matching user are left out of the response
+        return [users_by_id[id] for id in ids if id in users_by_id]
+
+    async def post(self):
         # Collecting required params
         name = self.get_argument("name")
         
@@ -96,22 +810,20 @@ class UsersHandler(BaseHandler):
             return
 
         # Proceed to store the listing in our db
-        cursor = self.application.db.cursor()
-        cursor.execute(
+        lastrowid = await self.application.db.execute_write(
             "INSERT INTO 'users' "
             + "('name', 'created_at', 'updated_at') "
             + "VALUES (?, ?, ?)",
             (name, time_now, time_now)
         )
-        self.application.db.commit()
 
         # Error out if we fail to retrieve the newly created user
-        if cursor.lastrowid is None:
+        if lastrowid is None:
             self.write_json({"result": False, "errors": ["Error while adding user to db"]}, status_code=500)
             return
 
         user = dict(
-            id=cursor.lastrowid,
+            id=lastrowid,
             name=name,
             created_at=time_now,
             updated_at=time_now
@@ -130,8 +842,7 @@ class UsersHandler(BaseHandler):
 
 # /users/{id}
 class UserHandler(BaseHandler):
-    @tornado.gen.coroutine
-    def get(self, id):
+    async def get(self, id):
         # Parsing id 
         if id is not None:
             try:
@@ -141,16 +852,8 @@ class UserHandler(BaseHandler):
                 return
         
         args = (id,)
-        cursor = self.application.db.cursor()
-        results = cursor.execute("SELECT * FROM users WHERE id=?", args)
-
-        users = []
-        for row in results:
-            fields = ["id", "name", "created_at", "updated_at"]
-            user = {
-                field: row[field] for field in fields
-            }
-            users.append(user)
+        results = await self.application.db.fetchall(SELECT_USERS + " WHERE id=?", args)
+        users = [dict(zip(USER_COLUMNS, row)) for row in results]
 
         if len(users) == 0:
             self.write_json({"result": False, "errors": "no user found under the id"}, status_code=404)
@@ -161,24 +864,204 @@ class UserHandler(BaseHandler):
         
         self.write_json({"result": True, "user": users[0]})
 
+    async def head(self, id):
+        # Existence check without a body: 200 if the user exists, 404 otherwise
+        row = await self.application.db.fetchone("SELECT 1 FROM users WHERE id=?", (int(id),))
+        if row is None:
+            self.set_status(404)
+
+# /users/ids
+class UserIdsHandler(BaseHandler):
+    """
+    Streams the ids of the users with an id greater than after_id, in id order,
+    one per line, reading ID_DUMP_CHUNK_SIZE of them at a time. Meant for
+    callers keeping track of which users exist.
+    """
+
+    async def get(self):
+        try:
+            after_id = int(self.get_argument("after_id", 0))
+        except:
+            self.write_json({"result": False, "errors": "invalid after_id"}, status_code=400)
+            return
+
+        self.set_header("Content-Type", "text/plain")
+        while True:
+            results = await self.application.db.fetchall(
+                "SELECT id FROM users WHERE id>? ORDER BY id LIMIT ?", (after_id, ID_DUMP_CHUNK_SIZE)
+            )
+            if len(results) == 0:
+                break
+            self.write(b"".join(b"%d\n" % row[0] for row in results))
+            # Waiting for the chunk to be sent before reading the next one
+            await self.flush()
+            after_id = results[-1][0]
+            if len(results) < ID_DUMP_CHUNK_SIZE:
+                break
+
+async def fetch_from_workers(ports, path):
+    """Returns the bodies of path fetched from the metrics port of every worker, leaving out workers that failed to respond."""
+    client = AsyncHTTPClient()
+    responses = await asyncio.gather(*[
+        client.fetch("http://127.0.0.1:{}{}".format(port, path)) for port in ports
+    ], return_exceptions=True)
+    bodies = []
+    for port, response in zip(ports, responses):
+        if isinstance(response, Exception):
+            logging.warning("Worker metrics port {} failed to respond: {}".format(port, response))
+            continue
+        bodies.append(response.body)
+    return bodies
+
+# /users/traces
+class TracesHandler(BaseHandler):
+    async def get(self):
+        export_format = self.get_argument("format", "json")
+        if export_format not in {"json", "chrome"}:
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'json', 'chrome'"}, status_code=400)
+            return
+        tracer = self.application.tracer
+        trace_id = self.get_argument("trace_id", None)
+        worker_ports = self.settings.get("worker_ports")
+        if worker_ports is None:
+            spans = tracer.get_spans(trace_id)
+        else:
+            # Spans of every worker, from their metrics ports
+            path = url_concat("/users/traces", {"trace_id": trace_id} if trace_id is not None else None)
+            spans = []
+            for body in await fetch_from_workers(worker_ports, path):
+                spans.extend(json.loads(body)["spans"])
+            spans.sort(key=lambda span: span["start"])
+        if export_format == "chrome":
+            self.write_json(tracer.to_chrome_trace(spans))
+        else:
+            self.write_json({"result": True, "spans": spans})
+
+# /metrics
+class MetricsHandler(BaseHandler):
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        worker_ports = self.settings.get("worker_ports")
+        if worker_ports is None:
+            self.write(self.application.metrics.render())
+            return
+        # Series of every worker, from their metrics ports
+        bodies = await fetch_from_workers(worker_ports, "/metrics")
+        self.write(merge_metrics([body.decode("utf-8") for body in bodies]))
+
+# /users/stats
+class StatsHandler(BaseHandler):
+    async def get(self):
+        self.write_json({"result": True, "db": self.application.db.get_stats()})
+
+class WorkerApp(tornado.web.Application):
+    """Serves the metrics and spans recorded by app, those of this worker alone, on the metrics port of the worker."""
+
+    def __init__(self, app):
+        super().__init__([
+            (r"/users/traces", TracesHandler),
+            (r"/metrics", MetricsHandler),
+        ], profile_dir=None)
+        self.metrics = app.metrics
+        self.tracer = app.tracer
+        self.profiling = False
+
 # Path to the request handler
-def make_app(options):
+def make_app(options, db_initialized=False):
     return App([
         (r"/users", UsersHandler),
+        (r"/users/stats", StatsHandler),
+        (r"/users/ids", UserIdsHandler),
+        (r"/users/traces", TracesHandler),
+        (r"/metrics", MetricsHandler),
         (r"/users/([0-9]+)", UserHandler)
-    ], debug=options.debug)
+    ], options.db_path, options.db_read_threads,
+        options.group_commit_window / 1000.0, options.trace_buffer_size, db_initialized,
+        debug=options.debug, profile_dir=options.profile_dir,
+        worker_ports=[options.metrics_port + worker for worker in range(options.workers or 1)] if options.metrics_port is not None else None,
+        transforms=[GZipContentEncoding] if options.compress_response else [])
+
+def define_options(options):
+    options.define("port", default=6001)
+    # Debug mode restarts the app on file changes, it requires a single worker
+    # Defaults to on with a single worker, off otherwise
+    options.define("debug", default=None, type=bool)
+    # Number of worker processes sharing the port (0 starts one per CPU)
+    options.define("workers", default=0)
+    # Number of threads (each with its own db connection) running read queries
+    options.define("db_read_threads", default=4)
+    # Milliseconds the db writer waits for more writes to commit together in one transaction (0 disables it)
+    options.define("group_commit_window", default=0.0)
+    # Path of the SQLite db file
+    options.define("db_path", default="users.db")
+    # Gzip responses for clients that accept it
+    options.define("compress_response", default=True)
+    # Number of recent spans kept for GET /users/traces (0 disables tracing)
+    options.define("trace_buffer_size", default=10000)
+    # Base of the ports workers serve their own /metrics and /users/traces on, worker i on metrics_port + i.
+    # /metrics and /users/traces on port then merge those of every worker, unset they only cover the worker serving the request
+    options.define("metrics_port", default=None, type=int)
+    # Directory the profiles of requests made with __profile=1 are written to, profiling is disabled unless set
+    options.define("profile_dir", default=None, type=str)
+    # Run on uvloop instead of the default asyncio event loop, if installed
+    options.define("uvloop", default=False)
+
+async def serve(options, sockets, db_initialized=False):
+    """
+    Serves the app on sockets until cancelled, stopping the db threads once it stops.
+    The db is initialized first unless db_initialized.
+    """
+    app = make_app(options, db_initialized)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    # Serving the metrics and spans of this worker alone on its own port
+    worker_server = None
+    if options.metrics_port is not None:
+        worker_server = tornado.httpserver.HTTPServer(WorkerApp(app))
+        worker_server.listen(options.metrics_port + (tornado.process.task_id() or 0))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        if worker_server is not None:
+            worker_server.stop()
+        app.close()
+
+def run(options, sockets, db_initialized=False):
+    """Runs serve() on a new event loop, a uvloop one with the uvloop option."""
+    if options.uvloop:
+        if uvloop is None:
+            logging.warning("uvloop is not installed, running on the default asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(serve(options, sockets, db_initialized))
 
 if __name__ == "__main__":
-    tornado.options.define("port", default=6001)
-    tornado.options.define("debug", default=True)
+    define_options(tornado.options.options)
     tornado.options.parse_command_line()
     options = tornado.options.options
+    workers = options.workers or os.cpu_count() or 1
+    if not hasattr(os, "fork"):
+        workers = 1
+    if options.debug is None:
+        options.debug = workers == 1
+    elif options.debug and workers != 1:
+        logging.warning("Debug mode runs a single worker")
+        workers = 1
+    options.workers = workers
+    if workers != 1 and options.metrics_port is None:
+        logging.warning("/metrics and /users/traces only cover the worker serving the request, set metrics_port to merge those of every worker")
 
-    # Create web app
-    app = make_app(options)
-    app.listen(options.port)
-    logging.info("Starting user service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
+    # Migrating the db once, before workers start
+    init_db(options.db_path)
 
-    # Start event loop
-    tornado.ioloop.IOLoop.instance().start()
+    # Binding the port before forking, so workers accept connections on the same sockets
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if workers != 1:
+        logging.info("Starting {} user service workers".format(workers))
+        tornado.process.fork_processes(workers)
+
+    # Serving the app, each worker opening its own db connections and threads
+    logging.info("Starting user service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
+    run(options, sockets, db_initialized=True)
     
\ No newline at end of file
@@ -0,0 +1,45 @@
+import os
+import sys
+import contextlib
+import importlib.util
+import pytest
+import tornado.httpserver
+import tornado.netutil
+import tornado.options
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "services", "listings"))
+sys.path.append(os.path.join(ROOT, "services", "users"))
+
+def load_public_api():
+    # public-api.py can't be imported by name
+    spec = importlib.util.spec_from_file_location(
+        "public_api", os.path.join(ROOT, "services", "public-api", "public-api.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def service_options(service, **values):
+    """Returns the command-line options of service, with their defaults overridden by values."""
+    options = tornado.options.OptionParser()
+    service.define_options(options)
+    for name, value in values.items():
+        setattr(options, name, value)
+    return options
+
+@pytest.fixture(scope="session")
+def public_api():
+    return load_public_api()
+
+@contextlib.asynccontextmanager
+async def serving(app):
+    """Serves app on a free local port until exit, yielding its base URL. The app is closed on exit."""
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    try:
+        yield "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+    finally:
+        server.stop()
+        app.close()
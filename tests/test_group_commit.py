@@ -0,0 +1,87 @@
+import sqlite3
+import asyncio
+import pytest
+import listing_service
+import user_service
+
+# Insert statement of each service's table, taking a single distinct value per row
+INSERTS = {
+    "listings": (listing_service, "INSERT INTO listings (user_id, listing_type, price, created_at, updated_at) VALUES (?, 'rent', 1, 0, 0)",
+        "SELECT user_id FROM listings WHERE id=?"),
+    "users": (user_service, "INSERT INTO users (name, created_at, updated_at) VALUES (?, 0, 0)",
+        "SELECT name FROM users WHERE id=?"),
+}
+
+@pytest.fixture(params=sorted(INSERTS))
+def service_db(request, tmp_path):
+    service, insert_sql, select_sql = INSERTS[request.param]
+    db_path = str(tmp_path / "test.db")
+    db = sqlite3.connect(db_path)
+    service.migrate(db)
+    db.close()
+    return service, db_path, insert_sql, select_sql
+
+def test_grouped_writes_get_their_own_lastrowid(service_db):
+    service, db_path, insert_sql, select_sql = service_db
+    values = [str(i) if service is user_service else i for i in range(100)]
+
+    async def write():
+        db = service.Database(db_path, 1, group_commit_window=0.05)
+        try:
+            # A failing write in the middle of the group only fails its own caller
+            futures = [db.execute_write(insert_sql, (value,)) for value in values[:50]]
+            failing = db.execute_write("INSERT INTO missing_table VALUES (1)")
+            futures += [db.execute_write(insert_sql, (value,)) for value in values[50:]]
+            ids = await asyncio.gather(*futures)
+            with pytest.raises(sqlite3.OperationalError):
+                await failing
+            return ids, db.get_stats()
+        finally:
+            db.close()
+    ids, stats = asyncio.run(write())
+
+    assert stats["write_transactions"] < len(values)
+    assert len(set(ids)) == len(values)
+    db = sqlite3.connect(db_path)
+    assert [db.execute(select_sql, (id,)).fetchone()[0] for id in ids] == values
+    db.close()
+
+def test_grouped_executemany_gets_consecutive_ids(service_db):
+    service, db_path, insert_sql, select_sql = service_db
+    values = [str(i) if service is user_service else i for i in range(30)]
+
+    async def write():
+        db = service.Database(db_path, 1, group_commit_window=0.05)
+        try:
+            return await asyncio.gather(
+                db.execute_write(insert_sql, (values[0],)),
+                db.executemany_write(insert_sql, [(value,) for value in values[1:]]),
+            )
+        finally:
+            db.close()
+    first_id, last_id = asyncio.run(write())
+
+    db = sqlite3.connect(db_path)
+    assert db.execute(select_sql, (first_id,)).fetchone()[0] == values[0]
+    many_ids = range(last_id - len(values) + 2, last_id + 1)
+    assert [db.execute(select_sql, (id,)).fetchone()[0] for id in many_ids] == values[1:]
+    db.close()
+
+def test_writer_survives_a_broken_transaction(service_db):
+    service, db_path, insert_sql, select_sql = service_db
+    value = "1" if service is user_service else 1
+
+    async def write():
+        db = service.Database(db_path, 1, group_commit_window=0.05)
+        try:
+            # Ending the transaction from within a write makes releasing its savepoint fail
+            with pytest.raises(sqlite3.OperationalError):
+                await asyncio.wait_for(db.execute_write("COMMIT"), 5)
+            return await asyncio.wait_for(db.execute_write(insert_sql, (value,)), 5)
+        finally:
+            db.close()
+    id = asyncio.run(write())
+
+    db = sqlite3.connect(db_path)
+    assert db.execute(select_sql, (id,)).fetchone()[0] == value
+    db.close()
@@ -0,0 +1,104 @@
+import json
+import asyncio
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+import listing_service
+import user_service
+from conftest import service_options, serving
+from test_public_api_streaming import create_dbs
+
+@pytest.fixture(params=["listings", "public-api"])
+def parser_class(request, public_api):
+    # Both services have their own copy of the parser
+    if request.param == "listings":
+        return listing_service.JSONItemsParser
+    return public_api.JSONItemsParser
+
+def parse(parser_class, body, chunk_size):
+    parser = parser_class()
+    items = []
+    for i in range(0, len(body), chunk_size):
+        items.extend(parser.feed(body[i:i + chunk_size]))
+    items.extend(parser.close())
+    return items
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_array_and_ndjson(parser_class, chunk_size):
+    items = [{"user_id": i, "listing_type": "rent", "price": "é{}".format(i)} for i in range(5)]
+    assert parse(parser_class, json.dumps(items).encode("utf-8"), chunk_size) == items
+    ndjson = "\n".join(json.dumps(item) for item in items).encode("utf-8")
+    assert parse(parser_class, ndjson, chunk_size) == items
+    assert parse(parser_class, ndjson + b"\r\n", chunk_size) == items
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_invalid_ndjson_line_resumes_at_next_line(parser_class, chunk_size):
+    body = b'{"a": 1}\n{"a": 2, oops\n{"a": 3}\n'
+    items = parse(parser_class, body, chunk_size)
+    assert items[0] == {"a": 1}
+    assert isinstance(items[1], ValueError)
+    assert "invalid JSON" in str(items[1])
+    assert items[2] == {"a": 3}
+    assert len(items) == 3
+
+def test_invalid_ndjson_line_is_reported_once_complete(parser_class):
+    parser = parser_class()
+    assert parser.feed(b'{"a": 1}\n{"a": oops') == [{"a": 1}]
+    items = parser.feed(b'\n{"a": 3}')
+    assert len(items) == 1 and isinstance(items[0], ValueError)
+    assert parser.close() == [{"a": 3}]
+
+def test_truncated_body(parser_class):
+    ndjson = parse(parser_class, b'{"a": 1}\n{"a": 2', 1000)
+    assert ndjson[0] == {"a": 1} and isinstance(ndjson[1], ValueError)
+    array = parse(parser_class, b'[{"a": 1}, {"a": 2', 1000)
+    assert array[0] == {"a": 1} and isinstance(array[1], ValueError)
+
+def test_bulk_create_continues_after_invalid_line(tmp_path):
+    body = b"\n".join([
+        json.dumps({"user_id": 1, "listing_type": "rent", "price": 100}).encode("utf-8"),
+        b'{"user_id": 2, "listing_type": ',
+        json.dumps({"user_id": 3, "listing_type": "sale", "price": 300}).encode("utf-8"),
+    ])
+
+    async def create():
+        options = service_options(listing_service, db_path=str(tmp_path / "listings.db"), debug=False)
+        async with serving(listing_service.make_app(options)) as url:
+            return await AsyncHTTPClient().fetch(url + "/listings/bulk", method="POST", body=body)
+
+    response = asyncio.run(create())
+    results = {result["index"]: result for result in map(json.loads, response.body.splitlines())}
+    assert sorted(results) == [0, 1, 2]
+    assert results[0]["result"] and results[0]["listing"]["user_id"] == 1
+    assert not results[1]["result"] and "invalid JSON" in results[1]["errors"][0]
+    assert results[2]["result"] and results[2]["listing"]["user_id"] == 3
+
+@pytest.mark.parametrize("service", ["listings", "public-api"])
+def test_bulk_results_are_in_item_order(public_api, tmp_path, monkeypatch, service):
+    # Rejected items are interleaved with created ones, results come back in item order all the same
+    create_dbs(tmp_path)
+    for name in ["LISTINGS_URL", "USERS_URL"]:
+        monkeypatch.setattr(public_api, name, getattr(public_api, name))
+    body = b"\n".join([
+        b'{"user_id": 2, "listing_type": ',
+        json.dumps({"user_id": 1, "listing_type": "rent", "price": 100}).encode("utf-8"),
+        json.dumps({"user_id": 1000, "listing_type": "rent", "price": 100}).encode("utf-8"),
+        json.dumps({"user_id": 2, "listing_type": "flat", "price": 100}).encode("utf-8"),
+        b'{"user_id": 3, oops',
+        json.dumps({"user_id": 3, "listing_type": "sale", "price": 300}).encode("utf-8"),
+    ])
+
+    async def create():
+        listings_options = service_options(listing_service, db_path=str(tmp_path / "listings.db"), debug=False)
+        users_options = service_options(user_service, db_path=str(tmp_path / "users.db"), debug=False)
+        async with serving(listing_service.make_app(listings_options)) as listings_url, \
+                serving(user_service.make_app(users_options)) as users_url:
+            if service == "listings":
+                return await AsyncHTTPClient().fetch(listings_url + "/listings/bulk", method="POST", body=body)
+            public_api.LISTINGS_URL = listings_url + "/listings"
+            public_api.USERS_URL = users_url + "/users"
+            async with serving(public_api.make_app(service_options(public_api, debug=False))) as url:
+                return await AsyncHTTPClient().fetch(url + "/public-api/listings/bulk", method="POST", body=body)
+
+    results = [json.loads(line) for line in asyncio.run(create()).body.splitlines()]
+    assert [result["index"] for result in results] == list(range(6))
+    assert [result["result"] for result in results] == [False, True, service == "listings", False, False, True]
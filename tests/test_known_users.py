@@ -0,0 +1,35 @@
+import json
+import urllib.parse
+from test_response_cache import run_public_api
+
+def test_membership(public_api):
+    known_users = public_api.KnownUsers()
+    for user_id in [1, 8, 9, 1000]:
+        known_users.add(user_id)
+    known_users.add(8)
+    assert [user_id for user_id in range(1100) if user_id in known_users] == [1, 8, 9, 1000]
+    assert known_users.size == 4
+
+def test_out_of_range_ids(public_api, monkeypatch):
+    monkeypatch.setattr(public_api, "KNOWN_USERS_MAX_ID", 8000)
+    known_users = public_api.KnownUsers()
+    known_users.add(-1)
+    known_users.add(8001)
+    assert -1 not in known_users and -9 not in known_users and 8001 not in known_users
+    assert known_users.size == 0 and len(known_users.bits) == 0
+
+    # Growth stops at the byte of the highest id kept
+    known_users.add(7000)
+    known_users.add(8000)
+    assert 7000 in known_users and 8000 in known_users
+    assert len(known_users.bits) == 8000 // 8 + 1
+
+def test_missing_users_are_rejected(public_api, tmp_path, monkeypatch):
+    # create_dbs creates users 1 to 5, anything else is a 404 of the HEAD lookup
+    missing, created = run_public_api(public_api, tmp_path, monkeypatch, [
+        ("POST", "/public-api/listings", None, urllib.parse.urlencode({"user_id": 1000, "listing_type": "rent", "price": 5})),
+        ("POST", "/public-api/listings", None, urllib.parse.urlencode({"user_id": 5, "listing_type": "rent", "price": 5})),
+    ])
+    assert missing.code == 400
+    assert json.loads(missing.body) == {"result": False, "errors": "User does not exist"}
+    assert created.code == 200 and json.loads(created.body)["listing"]["user_id"] == 5
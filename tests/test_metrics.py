@@ -0,0 +1,20 @@
+import listing_service
+
+def test_merged_metrics_have_every_worker_under_one_header():
+    texts = []
+    for worker in range(3):
+        metrics = listing_service.Metrics(worker)
+        metrics.define("requests_total", "counter", "Requests", ("handler",))
+        metrics.define("request_duration_seconds", "histogram", "Request durations")
+        metrics.inc("requests_total", ("ListingsHandler",), worker + 1)
+        metrics.observe("request_duration_seconds", (), 0.01)
+        texts.append(metrics.render())
+
+    lines = listing_service.merge_metrics(texts).splitlines()
+    assert lines.count("# HELP requests_total Requests") == 1
+    assert lines.count("# TYPE request_duration_seconds histogram") == 1
+    for worker in range(3):
+        assert 'requests_total{{worker="{}",handler="ListingsHandler"}} {}'.format(worker, worker + 1) in lines
+        assert 'request_duration_seconds_count{{worker="{}"}} 1'.format(worker) in lines
+    # Series follow the header of their metric
+    assert lines.index('requests_total{worker="2",handler="ListingsHandler"} 3') < lines.index("# HELP request_duration_seconds Request durations")
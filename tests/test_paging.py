@@ -0,0 +1,141 @@
+import json
+import random
+import sqlite3
+import asyncio
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+import listing_service
+import user_service
+from conftest import service_options, serving
+
+LISTING_COUNT = 50
+
+def create_listings(db_path, shards=1):
+    """Inserts LISTING_COUNT listings of 5 users, several created at the same time, returns them in feed order."""
+    listing_service.init_shards(db_path, shards)
+    rng = random.Random(1)
+    listings = []
+    for i in range(LISTING_COUNT):
+        # Few distinct created_at values, so pages are cut between listings created at the same time
+        created_at = rng.randrange(10)
+        listings.append({
+            "user_id": rng.randrange(1, 6), "listing_type": rng.choice(["rent", "sale"]),
+            "price": rng.randrange(1000), "created_at": created_at, "updated_at": created_at,
+        })
+    for shard in range(shards):
+        db = sqlite3.connect(listing_service.shard_path(db_path, shard, shards))
+        for listing in listings:
+            if listing_service.shard_of(listing["user_id"], shards) == shard:
+                listing["id"] = db.execute(
+                    "INSERT INTO listings (user_id, listing_type, price, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (listing["user_id"], listing["listing_type"], listing["price"], listing["created_at"], listing["updated_at"])
+                ).lastrowid
+        db.commit()
+        db.close()
+    return sorted(listings, key=lambda listing: (listing["created_at"], listing["id"]), reverse=True)
+
+async def get_pages(url, params):
+    """Returns the pages of url, following next_cursor from the first one until there is none."""
+    client = AsyncHTTPClient()
+    pages = []
+    cursor = None
+    while True:
+        page_params = dict(params, cursor=cursor) if cursor is not None else params
+        response = await client.fetch(url_concat(url, page_params))
+        pages.append(json.loads(response.body))
+        cursor = pages[-1]["next_cursor"]
+        if cursor is None:
+            return pages
+
+def walk_listings(db_path, params, shards=1):
+    async def walk():
+        options = service_options(listing_service, db_path=db_path, shards=shards, debug=False)
+        async with serving(listing_service.make_app(options)) as url:
+            return await get_pages(url + "/listings", params)
+    return asyncio.run(walk())
+
+@pytest.mark.parametrize("page_size", [1, 7, 10, 100])
+@pytest.mark.parametrize("include_total", [False, True])
+def test_listing_cursor_pages(tmp_path, page_size, include_total):
+    listings = create_listings(str(tmp_path / "listings.db"))
+    pages = walk_listings(str(tmp_path / "listings.db"), {"page_size": page_size, "include_total": include_total})
+    assert [listing for page in pages for listing in page["listings"]] == listings
+    assert all(len(page["listings"]) == page_size for page in pages[:-1])
+    if include_total:
+        # Only the last page has no next one, and it ends with the last listing
+        assert [page["has_more"] for page in pages] == [True] * (len(pages) - 1) + [False]
+        assert all(page["total"] == LISTING_COUNT for page in pages)
+        assert len(pages) == -(-LISTING_COUNT // page_size)
+
+def test_listing_page_num_pages_match_cursor_pages(tmp_path):
+    db_path = str(tmp_path / "listings.db")
+    listings = create_listings(db_path)
+    pages = walk_listings(db_path, {"page_size": 7, "include_total": True})
+
+    async def get_numbered_pages():
+        options = service_options(listing_service, db_path=db_path, debug=False)
+        async with serving(listing_service.make_app(options)) as url:
+            client = AsyncHTTPClient()
+            responses = await asyncio.gather(*[
+                client.fetch(url_concat(url + "/listings", {"page_size": 7, "page_num": i + 1, "include_total": True}))
+                for i in range(len(pages))
+            ])
+            return [json.loads(response.body) for response in responses]
+    assert asyncio.run(get_numbered_pages()) == pages
+
+def test_user_listing_cursor_pages(tmp_path):
+    listings = create_listings(str(tmp_path / "listings.db"))
+    pages = walk_listings(str(tmp_path / "listings.db"), {"page_size": 3, "user_id": 2, "include_total": True})
+    user_listings = [listing for listing in listings if listing["user_id"] == 2]
+    assert [listing for page in pages for listing in page["listings"]] == user_listings
+    assert pages[0]["total"] == len(user_listings)
+
+@pytest.mark.parametrize("include_total", [False, True])
+def test_streamed_listing_pages(tmp_path, monkeypatch, include_total):
+    # Pages larger than STREAM_CHUNK_SIZE are fetched and written a chunk at a time
+    monkeypatch.setattr(listing_service, "STREAM_CHUNK_SIZE", 4)
+    listings = create_listings(str(tmp_path / "listings.db"))
+    pages = walk_listings(str(tmp_path / "listings.db"), {"page_size": 10, "include_total": include_total})
+    assert [listing for page in pages for listing in page["listings"]] == listings
+    if include_total:
+        assert [page["has_more"] for page in pages] == [True] * 4 + [False]
+
+@pytest.mark.parametrize("include_total", [False, True])
+def test_streamed_all_listings(tmp_path, monkeypatch, include_total):
+    # A negative page_size streams every listing in a single page
+    monkeypatch.setattr(listing_service, "STREAM_CHUNK_SIZE", 4)
+    limits = []
+    select_listings = listing_service.ListingsHandler._select_listings
+    def spy(self, dbs, conditions, args, limit, *rest):
+        limits.append(limit)
+        return select_listings(self, dbs, conditions, args, limit, *rest)
+    monkeypatch.setattr(listing_service.ListingsHandler, "_select_listings", spy)
+    listings = create_listings(str(tmp_path / "listings.db"))
+    pages = walk_listings(str(tmp_path / "listings.db"), {"page_size": -1, "include_total": include_total})
+    assert 0 < max(limits) <= 4
+    assert len(pages) == 1
+    assert pages[0]["listings"] == listings
+    if include_total:
+        assert pages[0]["total"] == len(listings)
+        assert pages[0]["has_more"] is False
+
+@pytest.mark.parametrize("page_size", [1, 4, 100])
+def test_user_cursor_pages(tmp_path, page_size):
+    db_path = str(tmp_path / "users.db")
+    user_service.init_db(db_path)
+    db = sqlite3.connect(db_path)
+    for i in range(20):
+        db.execute("INSERT INTO users (name, created_at, updated_at) VALUES (?, ?, ?)", ("user {}".format(i), i // 3, i // 3))
+    db.commit()
+    ids = [row[0] for row in db.execute("SELECT id FROM users ORDER BY created_at DESC, id DESC")]
+    db.close()
+
+    async def walk():
+        options = service_options(user_service, db_path=db_path, debug=False)
+        async with serving(user_service.make_app(options)) as url:
+            return await get_pages(url + "/users", {"page_size": page_size, "include_total": True})
+    pages = asyncio.run(walk())
+    assert [user["id"] for page in pages for user in page["users"]] == ids
+    assert [page["has_more"] for page in pages] == [True] * (len(pages) - 1) + [False]
+    assert all(page["total"] == 20 for page in pages)
@@ -0,0 +1,64 @@
+import json
+import sqlite3
+import asyncio
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+import listing_service
+import user_service
+from conftest import service_options, serving
+from test_paging import create_listings
+
+QUERIES = [
+    {"page_size": 10},
+    {"page_size": 10, "page_num": 3, "include_total": "true"},
+    {"page_size": 7, "user_id": 2, "include_total": "true"},
+    {"page_size": 10, "listing_type": "rent"},
+    {"page_size": 100, "include_total": "true"},
+    {"page_size": 10, "user_id": 1000},
+]
+
+async def get_pages(public_api, tmp_path, queries, stream_chunk_size):
+    listings_options = service_options(listing_service, db_path=str(tmp_path / "listings.db"), debug=False)
+    users_options = service_options(user_service, db_path=str(tmp_path / "users.db"), debug=False)
+    async with serving(listing_service.make_app(listings_options)) as listings_url, \
+            serving(user_service.make_app(users_options)) as users_url:
+        public_api.LISTINGS_URL = listings_url + "/listings"
+        public_api.USERS_URL = users_url + "/users"
+        public_api.STREAM_CHUNK_SIZE = stream_chunk_size
+        options = service_options(public_api, debug=False, response_cache_size=0)
+        async with serving(public_api.make_app(options)) as url:
+            client = AsyncHTTPClient()
+            pages = []
+            for query in queries:
+                response = await client.fetch(url_concat(url + "/public-api/listings", query), raise_error=False)
+                pages.append((response.code, json.loads(response.body)))
+                # Following the cursor of the page too
+                cursor = pages[-1][1].get("next_cursor")
+                if cursor is not None:
+                    response = await client.fetch(url_concat(url + "/public-api/listings", dict(query, cursor=cursor)))
+                    pages.append((response.code, json.loads(response.body)))
+            return pages
+
+def create_dbs(tmp_path):
+    """Creates the listings and users dbs of the services in tmp_path."""
+    create_listings(str(tmp_path / "listings.db"))
+    user_service.init_db(str(tmp_path / "users.db"))
+    db = sqlite3.connect(str(tmp_path / "users.db"))
+    db.executemany("INSERT INTO users (name, created_at, updated_at) VALUES (?, 0, 0)", [("user {}".format(i),) for i in range(5)])
+    db.commit()
+    db.close()
+
+def test_streamed_pages_match_whole_pages(public_api, tmp_path, monkeypatch):
+    create_dbs(tmp_path)
+    for name in ["LISTINGS_URL", "USERS_URL", "STREAM_CHUNK_SIZE"]:
+        monkeypatch.setattr(public_api, name, getattr(public_api, name))
+
+    whole = asyncio.run(get_pages(public_api, tmp_path, QUERIES, 1000))
+    streamed = asyncio.run(get_pages(public_api, tmp_path, QUERIES, 3))
+    assert streamed == whole
+    assert [code for code, page in whole].count(400) == 1
+    assert all("user" in listing for code, page in whole if code == 200 for listing in page["listings"])
+
+    # Unbounded pages are streamed
+    everything = asyncio.run(get_pages(public_api, tmp_path, [{"page_size": -1}], 3))
+    assert len(everything[0][1]["listings"]) == 50
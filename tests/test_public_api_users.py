@@ -0,0 +1,14 @@
+import asyncio
+from test_public_api_streaming import QUERIES, create_dbs, get_pages
+
+def test_users_looked_up_in_chunks_match_single_lookup(public_api, tmp_path, monkeypatch):
+    create_dbs(tmp_path)
+    for name in ["LISTINGS_URL", "USERS_URL", "STREAM_CHUNK_SIZE", "MAX_IDS_PER_QUERY"]:
+        monkeypatch.setattr(public_api, name, getattr(public_api, name))
+
+    single = asyncio.run(get_pages(public_api, tmp_path, QUERIES, 1000))
+    # Pages have up to 5 distinct users, looked up 2 at a time
+    public_api.MAX_IDS_PER_QUERY = 2
+    chunked = asyncio.run(get_pages(public_api, tmp_path, QUERIES, 1000))
+    assert chunked == single
+    assert all("user" in listing for code, page in chunked if code == 200 for listing in page["listings"])
@@ -0,0 +1,13 @@
+import sqlite3
+import pytest
+import listing_service
+import user_service
+
+@pytest.mark.parametrize("service", [listing_service, user_service], ids=["listings", "users"])
+def test_hot_queries_use_indexes(service, tmp_path):
+    db = sqlite3.connect(str(tmp_path / "test.db"))
+    try:
+        service.migrate(db)
+        assert service.check_query_plans(db) == []
+    finally:
+        db.close()
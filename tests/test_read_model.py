@@ -0,0 +1,43 @@
+import asyncio
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+class FakeUpstream(object):
+    """Answers read model syncs with the rows of each table updated after updated_since."""
+
+    def __init__(self, public_api):
+        self.public_api = public_api
+        self.rows = {"users": [], "listings": []}
+
+    async def fetch(self, upstream, url):
+        params = dict(param.split("=") for param in url.split("?")[1].split("&"))
+        since = (int(params["updated_since"]), int(params["updated_since_id"]))
+        rows = sorted(
+            (row for row in self.rows[upstream] if (row["updated_at"], row["id"]) > since),
+            key=lambda row: (row["updated_at"], row["id"])
+        )[:int(params["page_size"])]
+        return FakeResponse(self.public_api.json_dumps({"result": True, upstream: rows}))
+
+def test_sync_reports_users_changed_since_previous_sync(public_api):
+    upstream = FakeUpstream(public_api)
+    read_model = public_api.ReadModel(upstream, 1.0)
+    changed = []
+    read_model.on_user_change = changed.append
+
+    upstream.rows["users"] = [{"id": 1, "name": "a", "created_at": 10, "updated_at": 10}]
+    asyncio.run(read_model.sync())
+    assert changed == [1]
+
+    # Users synced before are fetched again by the sync overlap, only the new ones are reported
+    upstream.rows["users"].append({"id": 2, "name": "b", "created_at": 11, "updated_at": 11})
+    asyncio.run(read_model.sync())
+    assert changed == [1, 2]
+
+def test_changed_users_are_looked_up_again(public_api):
+    cache = public_api.UserCache(10, 60.0, 5.0)
+    cache.set(2, None)
+    assert cache.get(2) == (True, None)
+    cache.invalidate(2)
+    assert cache.get(2) == (False, None)
@@ -0,0 +1,76 @@
+import gzip
+import json
+import asyncio
+import urllib.parse
+from tornado.httpclient import AsyncHTTPClient
+import listing_service
+import user_service
+from conftest import service_options, serving
+from test_public_api_streaming import create_dbs
+
+def run_public_api(public_api, tmp_path, monkeypatch, requests, **values):
+    """
+    Sends requests, (method, path, headers, body) tuples, to the public API in turn and returns their
+    responses. {ETAG} in a header value is replaced by the ETag of the first response.
+    """
+    create_dbs(tmp_path)
+    for name in ["LISTINGS_URL", "USERS_URL"]:
+        monkeypatch.setattr(public_api, name, getattr(public_api, name))
+
+    async def send():
+        listings_options = service_options(listing_service, db_path=str(tmp_path / "listings.db"), debug=False)
+        users_options = service_options(user_service, db_path=str(tmp_path / "users.db"), debug=False)
+        async with serving(listing_service.make_app(listings_options)) as listings_url, \
+                serving(user_service.make_app(users_options)) as users_url:
+            public_api.LISTINGS_URL = listings_url + "/listings"
+            public_api.USERS_URL = users_url + "/users"
+            async with serving(public_api.make_app(service_options(public_api, debug=False, **values))) as url:
+                client = AsyncHTTPClient()
+                responses = []
+                for method, path, headers, body in requests:
+                    if headers is not None and len(responses) > 0:
+                        etag = responses[0].headers["Etag"]
+                        headers = {name: value.replace("{ETAG}", etag) for name, value in headers.items()}
+                    responses.append(await client.fetch(
+                        url + path, method=method, headers=headers, body=body, decompress_response=False, raise_error=False
+                    ))
+                return responses
+    return asyncio.run(send())
+
+def test_etag_and_invalidation(public_api, tmp_path, monkeypatch):
+    page = "/public-api/listings?page_size=10"
+    post = urllib.parse.urlencode({"user_id": 1, "listing_type": "rent", "price": 5})
+    first, gzipped, not_modified, created, changed, stale = run_public_api(public_api, tmp_path, monkeypatch, [
+        ("GET", page, None, None),
+        ("GET", page, {"Accept-Encoding": "gzip"}, None),
+        ("GET", page, {"If-None-Match": "{ETAG}"}, None),
+        ("POST", "/public-api/listings", None, post),
+        ("GET", page, None, None),
+        ("GET", page, {"If-None-Match": "{ETAG}"}, None),
+    ])
+    etag = first.headers["Etag"]
+    assert first.code == 200 and first.headers["X-Cache"] == "MISS"
+    assert gzipped.headers["X-Cache"] == "HIT" and gzipped.headers["Etag"] == etag
+    assert gzipped.headers["Content-Encoding"] == "gzip" and gzip.decompress(gzipped.body) == first.body
+    assert not_modified.code == 304 and not_modified.body == b""
+
+    # The new listing is first of the feed, the cached page was dropped
+    assert created.code == 200
+    assert changed.headers["X-Cache"] == "MISS" and changed.headers["Etag"] != etag
+    assert json.loads(changed.body)["listings"][0]["id"] == json.loads(created.body)["listing"]["id"]
+    assert stale.code == 200 and stale.headers["X-Cache"] == "HIT"
+
+def test_uncached_pages_are_not_gzipped_ahead(public_api, tmp_path, monkeypatch):
+    compressed = []
+    compress = gzip.compress
+    def spy(data, *args, **kwargs):
+        compressed.append(len(data))
+        return compress(data, *args, **kwargs)
+    monkeypatch.setattr(public_api.gzip, "compress", spy)
+    response, = run_public_api(public_api, tmp_path, monkeypatch, [
+        ("GET", "/public-api/listings?page_size=10", {"Accept-Encoding": "gzip"}, None),
+    ], response_cache_size=0)
+    assert compressed == []
+    # The response is gzipped on the way out instead
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(response.body))["listings"]) == 10
@@ -0,0 +1,106 @@
+import os
+import json
+import random
+import sqlite3
+import asyncio
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+import listing_service
+from conftest import service_options, serving
+
+SHARDS = 3
+
+# Pages compared between the sharded and unsharded services
+QUERIES = [
+    {"page_size": 10},
+    {"page_size": 10, "page_num": 4},
+    {"page_size": 7, "page_num": 3, "include_total": True},
+    {"page_size": 1000, "include_total": True},
+    {"page_size": -1},
+    {"page_size": 10, "listing_type": "sale", "min_price": 100, "max_price": 800},
+    {"page_size": 5, "user_id": 4, "include_total": True},
+    {"page_size": 10, "user_id": 1000},
+    {"page_size": 25, "updated_since": 5},
+    {"page_size": 25, "updated_since": 5, "updated_since_id": 3 << listing_service.SHARD_ID_BITS},
+]
+
+@pytest.fixture
+def db_paths(tmp_path):
+    """Returns the paths of sharded listings dbs, and of an unsharded db holding the same listings with the same ids."""
+    sharded_path = str(tmp_path / "sharded" / "listings.db")
+    unsharded_path = str(tmp_path / "unsharded" / "listings.db")
+    os.makedirs(os.path.dirname(sharded_path))
+    os.makedirs(os.path.dirname(unsharded_path))
+    listing_service.init_shards(sharded_path, SHARDS)
+    listing_service.init_shards(unsharded_path, 1)
+
+    rng = random.Random(1)
+    unsharded = sqlite3.connect(unsharded_path)
+    shards = [sqlite3.connect(listing_service.shard_path(sharded_path, shard, SHARDS)) for shard in range(SHARDS)]
+    for i in range(200):
+        user_id = rng.randrange(1, 10)
+        # Few distinct times, so pages are cut between listings of different shards created at the same time
+        created_at = rng.randrange(20)
+        row = (user_id, rng.choice(["rent", "sale"]), rng.randrange(1000), created_at, created_at + rng.randrange(5))
+        id = shards[listing_service.shard_of(user_id, SHARDS)].execute(
+            "INSERT INTO listings (user_id, listing_type, price, created_at, updated_at) VALUES (?, ?, ?, ?, ?)", row
+        ).lastrowid
+        unsharded.execute(
+            "INSERT INTO listings (id, user_id, listing_type, price, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)", (id,) + row
+        )
+    for db in shards + [unsharded]:
+        db.commit()
+        db.close()
+    return sharded_path, unsharded_path
+
+async def get_pages(db_path, shards, queries):
+    options = service_options(listing_service, db_path=db_path, shards=shards, debug=False)
+    async with serving(listing_service.make_app(options)) as url:
+        client = AsyncHTTPClient()
+        pages = []
+        for query in queries:
+            page = json.loads((await client.fetch(url_concat(url + "/listings", query))).body)
+            pages.append(page)
+            # Following the cursor of the page too
+            if page.get("next_cursor") is not None:
+                pages.append(json.loads((await client.fetch(url_concat(url + "/listings", dict(query, cursor=page["next_cursor"])))).body))
+        return pages
+
+def test_sharded_pages_match_unsharded(db_paths):
+    sharded_path, unsharded_path = db_paths
+    sharded = asyncio.run(get_pages(sharded_path, SHARDS, QUERIES))
+    unsharded = asyncio.run(get_pages(unsharded_path, 1, QUERIES))
+    assert len(sharded) == len(unsharded)
+    assert all(page["result"] for page in sharded)
+    for query_sharded, query_unsharded in zip(sharded, unsharded):
+        assert query_sharded == query_unsharded
+    # The listings of several shards were merged
+    assert len({listing["id"] >> listing_service.SHARD_ID_BITS for listing in sharded[0]["listings"]}) > 1
+
+def test_streamed_sharded_pages_match_unsharded(db_paths, monkeypatch):
+    monkeypatch.setattr(listing_service, "STREAM_CHUNK_SIZE", 8)
+    sharded_path, unsharded_path = db_paths
+    queries = [{"page_size": 30, "page_num": 2, "include_total": True}, {"page_size": 150, "listing_type": "rent"}]
+    assert asyncio.run(get_pages(sharded_path, SHARDS, queries)) == asyncio.run(get_pages(unsharded_path, 1, queries))
+
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize("limit,offset", [(10, None), (10, 0), (7, 13), (-1, 5), (0, 0), (500, 0)])
+def test_fetch_merged_matches_single_query(db_paths, reverse, limit, offset):
+    sharded_path, unsharded_path = db_paths
+    order = "DESC" if reverse else "ASC"
+    sql = "SELECT id, user_id, listing_type, price, created_at, updated_at FROM listings WHERE price < ? " \
+        + "ORDER BY created_at {0}, id {0}".format(order)
+
+    async def fetch():
+        dbs = [listing_service.Database(listing_service.shard_path(sharded_path, shard, SHARDS), 1) for shard in range(SHARDS)]
+        try:
+            return await listing_service.fetch_merged(dbs, sql, (600,), limit, offset, key=listing_service.FEED_ORDER, reverse=reverse)
+        finally:
+            for db in dbs:
+                db.close()
+
+    db = sqlite3.connect(unsharded_path)
+    expected = db.execute(sql + " LIMIT ? OFFSET ?", (600, limit, offset or 0)).fetchall()
+    db.close()
+    assert asyncio.run(fetch()) == expected
@@ -0,0 +1,123 @@
+import asyncio
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class FakeResponse(object):
+    def __init__(self, code):
+        self.code = code
+
+class FakeHTTPClient(object):
+    """Answers the n-th fetch after delays[n] seconds with codes[n], or raises it if it is an exception."""
+
+    def __init__(self, delays, codes):
+        self.delays = delays
+        self.codes = codes
+        self.calls = 0
+        self.cancelled = []
+
+    async def fetch(self, url, raise_error=False, **kwargs):
+        call = self.calls
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delays[call])
+        except asyncio.CancelledError:
+            self.cancelled.append(call)
+            raise
+        if isinstance(self.codes[call], Exception):
+            raise self.codes[call]
+        return FakeResponse(self.codes[call])
+
+def test_circuit_breaker_states(public_api, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(public_api.time, "monotonic", clock)
+    breaker = public_api.CircuitBreaker(3, 5.0)
+    for i in range(2):
+        breaker.record_failure()
+        assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+    # A single trial call once reset_timeout went by, its failure opens the circuit again
+    clock.now += 5.0
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    clock.now += 4.9
+    assert not breaker.allow()
+
+    # A successful trial call closes it
+    clock.now += 0.1
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+def make_client(public_api, delays=None, codes=None):
+    client = public_api.UpstreamClient(10, {"listings": (1, 1)}, public_api.Metrics(), failure_threshold=2, hedge_requests=True)
+    client.http_client = FakeHTTPClient(delays, codes)
+    return client
+
+def hedged_fetch(public_api, delays, codes):
+    """Returns the client and the outcome of a hedged fetch answered after delays with codes."""
+    async def fetch():
+        # The http client of the UpstreamClient is created on the event loop
+        client = make_client(public_api, delays, codes)
+        client.hedge_delays["listings"] = 0.05
+        try:
+            return client, await client.fetch("listings", "http://listings", hedge=True)
+        except Exception as e:
+            return client, e
+    return asyncio.run(fetch())
+
+def test_hedged_loser_is_cancelled(public_api):
+    client, response = hedged_fetch(public_api, [10, 0], [200, 200])
+    assert response.code == 200
+    assert client.http_client.cancelled == [0]
+    stats = client.get_stats()["listings"]
+    assert stats["hedged"] == 1 and stats["errors"] == 0 and stats["in_flight"] == 0
+    assert client.breakers["listings"].failures == 0
+    assert 'status="cancelled"' in client.metrics.render()
+
+def test_hedged_failures_count_once(public_api):
+    # The first request fails after the second was sent, which wins
+    client, response = hedged_fetch(public_api, [0.1, 0.2], [500, 200])
+    assert response.code == 200
+    assert client.get_stats()["listings"]["errors"] == 1
+    assert client.breakers["listings"].state == client.breakers["listings"].CLOSED
+
+    # Both fail: a single failure of the breaker, which opens after two
+    client, error = hedged_fetch(public_api, [0.1, 0.2], [ConnectionError("first"), ConnectionError("second")])
+    assert isinstance(error, ConnectionError)
+    assert client.get_stats()["listings"]["errors"] == 2
+    assert client.breakers["listings"].failures == 1
+    assert client.breakers["listings"].state == client.breakers["listings"].CLOSED
+
+def test_hedge_delay_follows_every_latency(public_api):
+    async def create():
+        return make_client(public_api)
+    client = asyncio.run(create())
+    for i in range(public_api.HEDGE_MIN_SAMPLES - 1):
+        client._record_latency("listings", 0.01)
+    assert client.hedge_delays["listings"] is None
+    client._record_latency("listings", 0.01)
+    assert client.hedge_delays["listings"] == 0.01
+
+    # Slower calls raise it right away, without waiting for more samples
+    for i in range(10):
+        client._record_latency("listings", 0.5)
+    assert client.hedge_delays["listings"] == 0.5
+
+    # Once the sample is full, the oldest latencies make way for the new ones
+    for i in range(public_api.HEDGE_SAMPLE_SIZE):
+        client._record_latency("listings", 0.02)
+    assert client.sorted_latencies["listings"] == [0.02] * public_api.HEDGE_SAMPLE_SIZE
+    assert client.hedge_delays["listings"] == 0.02
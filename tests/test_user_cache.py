@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+from test_upstream_client import FakeClock
+
+class FakeUsers(object):
+    """fetch_users of UserCache.resolve, answering with users after yielding to the event loop, or failing with error."""
+
+    def __init__(self, users, error=None):
+        self.users = users
+        self.error = error
+        self.lookups = []
+
+    async def __call__(self, user_ids):
+        self.lookups.append(list(user_ids))
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return {user_id: self.users[user_id] for user_id in user_ids if user_id in self.users}
+
+def test_least_recently_used_users_are_evicted(public_api):
+    cache = public_api.UserCache(2, 60.0, 5.0)
+    cache.set(1, {"id": 1})
+    cache.set(2, {"id": 2})
+    assert cache.get(1) == (True, {"id": 1})
+    cache.set(3, {"id": 3})
+    assert cache.get(2) == (False, None)
+    assert cache.get(1) == (True, {"id": 1}) and cache.get(3) == (True, {"id": 3})
+    assert cache.stats["evictions"] == 1
+
+def test_users_expire(public_api, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(public_api.time, "monotonic", clock)
+    cache = public_api.UserCache(10, 60.0, 5.0)
+    cache.set(1, {"id": 1})
+    # Missing users are cached for negative_ttl only
+    cache.set(2, None)
+    assert cache.get(2) == (True, None)
+    clock.now += 5.1
+    assert cache.get(2) == (False, None)
+    assert cache.get(1) == (True, {"id": 1})
+    clock.now += 55
+    assert cache.get(1) == (False, None)
+    assert cache.stats["expirations"] == 2
+
+def test_missing_users_are_cached(public_api):
+    cache = public_api.UserCache(10, 60.0, 5.0)
+    fetch_users = FakeUsers({1: {"id": 1}})
+    assert asyncio.run(cache.resolve([2, 1], fetch_users)) == {2: None, 1: {"id": 1}}
+    assert asyncio.run(cache.resolve([1, 2], fetch_users)) == {1: {"id": 1}, 2: None}
+    assert fetch_users.lookups == [[2, 1]]
+    assert cache.stats["hits"] == 2 and cache.stats["misses"] == 2
+
+def test_concurrent_misses_share_a_lookup(public_api):
+    cache = public_api.UserCache(10, 60.0, 5.0)
+    fetch_users = FakeUsers({1: {"id": 1}, 2: {"id": 2}})
+
+    async def resolve():
+        return await asyncio.gather(cache.resolve([1], fetch_users), cache.resolve([1, 2], fetch_users))
+    assert asyncio.run(resolve()) == [{1: {"id": 1}}, {1: {"id": 1}, 2: {"id": 2}}]
+    assert fetch_users.lookups == [[1], [2]]
+    assert cache.stats["coalesced"] == 1
+
+@pytest.mark.parametrize("cancel", [False, True])
+def test_failed_lookups_are_not_kept(public_api, cancel):
+    cache = public_api.UserCache(10, 60.0, 5.0)
+    failing = FakeUsers({}, error=ConnectionError("users down"))
+
+    async def resolve():
+        first = asyncio.ensure_future(cache.resolve([1], failing))
+        await asyncio.sleep(0)
+        # Waiting on the lookup of the first call, which fails or is cancelled
+        second = asyncio.ensure_future(cache.resolve([1], failing))
+        await asyncio.sleep(0)
+        if cancel:
+            first.cancel()
+        return await asyncio.wait_for(asyncio.gather(first, second, return_exceptions=True), 5)
+    first, second = asyncio.run(resolve())
+    expected = asyncio.CancelledError if cancel else ConnectionError
+    assert isinstance(first, expected) and isinstance(second, expected)
+    assert failing.lookups == [[1]]
+    assert cache.pending == {} and cache.get(1) == (False, None)
+
+    # The next miss looks the user up again
+    fetch_users = FakeUsers({1: {"id": 1}})
+    assert asyncio.run(cache.resolve([1], fetch_users)) == {1: {"id": 1}}
+    assert fetch_users.lookups == [[1]]